@@ -0,0 +1,194 @@
+"""
+Helpers for the benchmark management commands: seeded synthetic catalogs,
+images and feature histograms, and a small latency/throughput/memory
+harness.
+"""
+
+import os
+import random
+import time
+import tracemalloc
+from decimal import Decimal
+
+import numpy as np
+
+from .models import Products
+
+NAME_WORDS = [
+    "Align", "Swiftly", "Define", "Cates", "Love", "Ebb", "Metal", "Vent",
+    "License", "Fast", "Free", "Trail", "Soft", "Jersey", "Classic", "Everyday",
+    "Studio", "Balance", "Wunder", "Pace", "Breeze", "Tech", "Commission", "Zeroed",
+]
+
+# BGR colours used to draw the synthetic product images, so that visual
+# search has something colour-correlated to find.
+COLOR_BGR = {
+    "Khaki": (140, 180, 195),
+    "Neon": (20, 255, 57),
+    "Printed": (200, 100, 180),
+    "Black": (20, 20, 20),
+    "Blue": (200, 80, 30),
+    "Brown": (40, 70, 120),
+    "Burgundy": (50, 20, 128),
+    "Green": (60, 160, 40),
+    "Grey": (128, 128, 128),
+    "Navy": (90, 30, 10),
+    "Olive": (30, 128, 128),
+    "Orange": (0, 140, 255),
+    "Pink": (180, 150, 255),
+    "Purple": (140, 40, 120),
+    "Red": (30, 30, 210),
+    "White": (245, 245, 245),
+    "Yellow": (0, 220, 240),
+}
+
+
+def _choices(choices):
+    return [value for value, _ in choices]
+
+
+def synthetic_products(count, seed=0):
+    """
+    Yield ``count`` unsaved ``Products`` built from the model ``*_CHOICES``,
+    with descriptions in the same format as the real catalog.
+    """
+    rng = random.Random(seed)
+    attributes = {
+        "color": _choices(Products.COLOR_CHOICES),
+        "gender": _choices(Products.GENDER_CHOICES),
+        "category": _choices(Products.CATEGORY_CHOICES),
+        "length": _choices(Products.LENGTH_CHOICES),
+        "fit": _choices(Products.FIT_CHOICES),
+        "activity": _choices(Products.ACTIVITY_CHOICES),
+        "fabric": _choices(Products.FABRIC_CHOICES),
+    }
+    for _ in range(count):
+        values = {field: rng.choice(options) for field, options in attributes.items()}
+        price = Decimal(rng.randrange(3800, 19800)) / 100
+        name = " ".join(rng.sample(NAME_WORDS, 2)) + " " + values["category"].rstrip("s")
+        description = (
+            f"Name: {name}, Color: {values['color']}, Gender: {values['gender']}, "
+            f"Price: {price}, Category: {values['category']}, Length: {values['length']}, "
+            f"Fit: {values['fit']}, Activity: {values['activity']}, Fabric: {values['fabric']}"
+        )
+        yield Products(name=name, price=price, description=description, **values)
+
+
+def create_synthetic_catalog(count, seed=0, batch_size=5000):
+    """
+    Insert ``count`` synthetic products.
+    :return: Ids of the created products.
+    """
+    batch = []
+    for product in synthetic_products(count, seed):
+        batch.append(product)
+        if len(batch) == batch_size:
+            Products.objects.bulk_create(batch)
+            batch = []
+    if batch:
+        Products.objects.bulk_create(batch)
+    return list(Products.objects.order_by("-id").values_list("id", flat=True)[:count])
+
+
+def write_synthetic_images(products, folder, seed=0, images_per_product=3):
+    """
+    Draw simple garment-like images named like ``core/product_images``
+    (``product_<id>_image<n>.jpg``): a coloured shape on a black background.
+    :return: Paths of the written images.
+    """
+    import cv2
+
+    rng = np.random.default_rng(seed)
+    os.makedirs(folder, exist_ok=True)
+    paths = []
+    for product in products:
+        color = COLOR_BGR.get(product.color, (128, 128, 128))
+        for n in range(1, images_per_product + 1):
+            image = np.zeros((320, 240, 3), dtype=np.uint8)
+            x, y = rng.integers(20, 60, size=2)
+            jitter = rng.integers(-20, 20, size=3)
+            shade = tuple(int(np.clip(c + j, 0, 255)) for c, j in zip(color, jitter))
+            cv2.rectangle(image, (int(x), int(y)), (int(240 - x), int(320 - y // 2)), shade, -1)
+            path = os.path.join(folder, f"product_{product.id}_image{n}.jpg")
+            cv2.imwrite(path, image)
+            paths.append(path)
+    return paths
+
+
+def synthetic_histograms(count, dim, seed=0, clusters=64, active=48):
+    """
+    Sparse, clustered, L2-normalised vectors shaped like the colour
+    histograms: most bins empty, images of a product close together.
+    """
+    rng = np.random.default_rng(seed)
+    centers = np.zeros((clusters, dim), dtype=np.float32)
+    for center in centers:
+        center[rng.choice(dim, active, replace=False)] = rng.random(active)
+    features = centers[rng.integers(clusters, size=count)]
+    noise_rows = np.repeat(np.arange(count), active // 4)
+    noise_cols = rng.integers(dim, size=noise_rows.size)
+    features[noise_rows, noise_cols] += rng.random(noise_rows.size).astype(np.float32) * 0.5
+    features /= np.linalg.norm(features, axis=1, keepdims=True)
+    return features
+
+
+def perturbed_queries(features, count, seed=0, noise=0.01):
+    """
+    Query histograms near random rows of ``features``, like a new photo of
+    a stocked item.
+    """
+    rng = np.random.default_rng(seed)
+    queries = features[np.sort(rng.integers(len(features), size=count))]
+    queries = queries + rng.normal(0, noise, size=queries.shape)
+    return (queries / np.linalg.norm(queries, axis=1, keepdims=True)).astype(np.float32)
+
+
+def synthetic_queries(count, seed=0):
+    rng = random.Random(seed)
+    pools = [
+        _choices(Products.COLOR_CHOICES),
+        _choices(Products.GENDER_CHOICES),
+        _choices(Products.CATEGORY_CHOICES),
+        _choices(Products.FIT_CHOICES),
+        _choices(Products.ACTIVITY_CHOICES),
+        NAME_WORDS,
+    ]
+    return [
+        " ".join(rng.choice(pool) for pool in rng.sample(pools, rng.randint(1, 3)))
+        for _ in range(count)
+    ]
+
+
+def measure(function, inputs):
+    """
+    Call ``function`` once per item of ``inputs``.
+
+    The calls are timed without tracing; peak Python heap usage comes from a
+    separate traced call on the first input, so tracing does not distort the
+    latencies.
+    :return: Dict of latency percentiles (ms), throughput and peak memory.
+    """
+    inputs = list(inputs)
+    tracemalloc.start()
+    function(inputs[0])
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    latencies = []
+    started = time.perf_counter()
+    for item in inputs:
+        call_started = time.perf_counter()
+        function(item)
+        latencies.append(time.perf_counter() - call_started)
+    elapsed = time.perf_counter() - started
+
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) * 1000
+    return {
+        "calls": len(inputs),
+        "p50_ms": round(float(p50), 3),
+        "p95_ms": round(float(p95), 3),
+        "p99_ms": round(float(p99), 3),
+        "mean_ms": round(float(np.mean(latencies)) * 1000, 3),
+        "throughput_per_s": round(len(inputs) / elapsed, 2) if elapsed else None,
+        "peak_memory_kb": round(peak / 1024, 1),
+    }
@@ -0,0 +1,138 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    Thread-safe LRU cache with an optional time-to-live per entry.
+
+    Keeps hit/miss counters so callers can report how well it is doing.
+    """
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                value, expires = entry
+                if expires is None or expires > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def get_nearest(self, key, distance, max_distance, default=None):
+        """
+        Like ``get``, but falls back to the live entry whose key is closest
+        to ``key`` under ``distance``, if that is at most ``max_distance``.
+        The fallback scans every entry, so keep such caches small.
+        """
+        with self._lock:
+            now = time.monotonic()
+            best, best_distance = None, None
+            if key in self._data:
+                best, best_distance = key, 0
+            else:
+                for candidate, (_, expires) in self._data.items():
+                    if expires is not None and expires <= now:
+                        continue
+                    d = distance(key, candidate)
+                    if d <= max_distance and (best_distance is None or d < best_distance):
+                        best, best_distance = candidate, d
+            if best is not None:
+                value, expires = self._data[best]
+                if expires is None or expires > now:
+                    self._data.move_to_end(best)
+                    self.hits += 1
+                    return value
+                del self._data[best]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, None)
+        return default if entry is None else entry[0]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+class StampCheck:
+    """
+    Tells a long-lived in-memory structure when its source changed behind
+    its back, e.g. in another worker process.
+
+    ``stamp()`` is a cheap summary of the source. It is compared with the
+    one taken at the last build at most every ``interval`` seconds, and the
+    structure expires ``max_age`` seconds after its build whatever the stamp
+    says, for changes the stamp cannot see.
+    """
+
+    def __init__(self, stamp, interval=2.0, max_age=300.0):
+        self.stamp = stamp
+        self.interval = interval
+        self.max_age = max_age
+        self.current = None
+        self.built_at = self.checked_at = time.monotonic()
+
+    def take(self):
+        """
+        :return: The source's stamp now; take it before reading the source.
+        """
+        return self.stamp()
+
+    def mark(self, stamp):
+        """
+        Record that the structure was just built from the source at ``stamp``.
+        """
+        self.current = stamp
+        self.built_at = self.checked_at = time.monotonic()
+
+    def refresh(self):
+        """
+        Accept the source's present stamp after applying a change locally.
+        """
+        self.current = self.stamp()
+        self.checked_at = time.monotonic()
+
+    def expired(self):
+        now = time.monotonic()
+        if now - self.built_at > self.max_age:
+            return True
+        if now - self.checked_at < self.interval:
+            return False
+        self.checked_at = now
+        return self.stamp() != self.current
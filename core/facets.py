@@ -0,0 +1,224 @@
+import threading
+
+import numpy as np
+from django.conf import settings
+
+from .cache import StampCheck
+from .models import Products, catalog_stamp
+
+FACET_FIELDS = ("color", "gender", "category", "fit", "activity", "fabric", "length")
+
+
+class FacetIndex:
+    """
+    In-memory inverted index over the categorical ``Products`` attributes.
+
+    Every facet value maps to a sorted array of product ids, so attribute
+    filters are answered by intersecting arrays instead of scanning rows, and
+    facet counts are just array lengths.
+
+    ``postings`` is copy-on-write: writers build a new mapping under a lock
+    and swap it in, so readers never see it change underneath them. Changes
+    made by other processes are noticed by ``freshness`` and trigger a
+    rebuild.
+    """
+
+    _instance = None
+    _lock = threading.Lock()
+    _initialized = False
+
+    def __new__(cls):
+        if cls._instance is None:
+            with cls._lock:
+                if cls._instance is None:
+                    cls._instance = super(FacetIndex, cls).__new__(cls)
+        return cls._instance
+
+    def __init__(self):
+        if self._initialized:
+            return
+        self._build_lock = threading.RLock()
+        self.postings = {}
+        self.product_values = {}
+        self.built = False
+        self.freshness = StampCheck(
+            catalog_stamp,
+            interval=getattr(settings, "CATALOG_CHECK_INTERVAL", 2.0),
+            max_age=getattr(settings, "CATALOG_INDEX_MAX_AGE", 300),
+        )
+        self._initialized = True
+
+    def build(self):
+        with self._build_lock:
+            stamp = self.freshness.take()
+            rows = Products.objects.order_by("id").values_list("id", *FACET_FIELDS)
+            grouped = {field: {} for field in FACET_FIELDS}
+            product_values = {}
+            for pk, *values in rows:
+                product_values[pk] = tuple(values)
+                for field, value in zip(FACET_FIELDS, values):
+                    if value:
+                        grouped[field].setdefault(value, []).append(pk)
+            self.postings = {
+                field: {
+                    value: np.array(ids, dtype=np.int64)
+                    for value, ids in values.items()
+                }
+                for field, values in grouped.items()
+            }
+            self.product_values = product_values
+            self.built = True
+            self.freshness.mark(stamp)
+
+    def ensure_built(self):
+        expired = self.built and self.freshness.expired()
+        if expired or not self.built:
+            with self._build_lock:
+                if expired or not self.built:
+                    self.build()
+
+    def reset(self):
+        with self._build_lock:
+            self.built = False
+
+    def update_product(self, product):
+        with self._build_lock:
+            if not self.built:
+                return
+            postings = {field: dict(values) for field, values in self.postings.items()}
+            self._discard(postings, product.pk)
+            values = tuple(getattr(product, field) for field in FACET_FIELDS)
+            for field, value in zip(FACET_FIELDS, values):
+                if value:
+                    ids = postings[field].get(value, np.empty(0, dtype=np.int64))
+                    position = np.searchsorted(ids, product.pk)
+                    postings[field][value] = np.insert(ids, position, product.pk)
+            self.product_values[product.pk] = values
+            self.postings = postings
+            self.freshness.refresh()
+
+    def remove_product(self, product_id):
+        with self._build_lock:
+            if not self.built:
+                return
+            postings = {field: dict(values) for field, values in self.postings.items()}
+            self._discard(postings, product_id)
+            self.postings = postings
+            self.freshness.refresh()
+
+    def _discard(self, postings, product_id):
+        values = self.product_values.pop(product_id, None)
+        if values is None:
+            return
+        for field, value in zip(FACET_FIELDS, values):
+            ids = postings[field].get(value)
+            if ids is not None:
+                ids = ids[ids != product_id]
+                if len(ids):
+                    postings[field][value] = ids
+                else:
+                    del postings[field][value]
+
+    def values(self, fields=FACET_FIELDS):
+        """
+        :return: Every facet value currently used by at least one product.
+        """
+        self.ensure_built()
+        postings = self.postings
+        return {value for field in fields for value in postings[field]}
+
+    def candidates(self, filters, postings=None):
+        """
+        Resolve attribute filters to the ids of the matching products.
+
+        Values of the same field are OR-ed together, different fields are
+        AND-ed. Values are matched case-insensitively.
+        :param filters: Mapping of facet field to a value or list of values.
+        :return: Sorted array of product ids, or ``None`` if ``filters`` is empty.
+        """
+        self.ensure_built()
+        postings = postings or self.postings
+        result = None
+        for field, wanted in filters.items():
+            if isinstance(wanted, str):
+                wanted = [wanted]
+            wanted = {value.lower() for value in wanted}
+            arrays = [
+                ids for value, ids in postings[field].items() if value.lower() in wanted
+            ]
+            ids = np.unique(np.concatenate(arrays)) if arrays else np.empty(0, dtype=np.int64)
+            result = ids if result is None else np.intersect1d(result, ids, assume_unique=True)
+        return result
+
+    def counts(self, filters=None):
+        """
+        Count products per facet value.
+
+        Each field is counted against the products matching the filters on
+        the *other* fields, so a client can see how a selection would change.
+        :return: ``{field: {value: count}}``.
+        """
+        self.ensure_built()
+        postings = self.postings
+        filters = filters or {}
+        counts = {}
+        for field in FACET_FIELDS:
+            others = {f: v for f, v in filters.items() if f != field}
+            scope = self.candidates(others, postings)
+            counts[field] = {
+                value: int(
+                    len(ids) if scope is None
+                    else len(np.intersect1d(ids, scope, assume_unique=True))
+                )
+                for value, ids in postings[field].items()
+            }
+        return counts
+
+
+def filters_from_querydict(querydict):
+    """
+    Pick facet filters out of request parameters, e.g. ``?color=Black&gender=Women``.
+    """
+    return {
+        field: querydict.getlist(field)
+        for field in FACET_FIELDS
+        if querydict.getlist(field)
+    }
+
+
+def clean_filters(filters):
+    """
+    Validate facet filters taken from a JSON body. Query-string filters come
+    from ``filters_from_querydict`` and need no checking.
+    :return: ``{field: [value, ...]}`` without empty selections.
+    :raises ValueError: If ``filters`` is not a mapping of known facet fields
+        to a string or a list of strings.
+    """
+    if filters is None:
+        return {}
+    if not isinstance(filters, dict):
+        raise ValueError("filters must be an object mapping facet fields to values")
+    unknown = sorted(set(filters) - set(FACET_FIELDS))
+    if unknown:
+        raise ValueError(f"Unknown facet fields {unknown}, expected among {list(FACET_FIELDS)}")
+    cleaned = {}
+    for field, values in filters.items():
+        if isinstance(values, str):
+            values = [values]
+        if not isinstance(values, list) or not all(isinstance(value, str) for value in values):
+            raise ValueError(f"filters.{field} must be a string or a list of strings")
+        if values:
+            cleaned[field] = values
+    return cleaned
+
+
+def filters_key(filters):
+    """
+    Hashable, order-independent form of a filters mapping, for cache keys.
+    """
+    key = []
+    for field, values in (filters or {}).items():
+        if isinstance(values, str):
+            values = [values]
+        key.append((field, tuple(sorted(value.lower() for value in values))))
+    return tuple(sorted(key))
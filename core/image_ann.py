@@ -0,0 +1,291 @@
+"""
+Approximate nearest-neighbour search over the image feature store.
+
+Backed by faiss; the index kind is chosen with ``IMAGE_SEARCH_BACKEND``:
+
+    exact     brute-force ``cdist`` over the feature matrix (no faiss needed)
+    flat      exact faiss L2 scan
+    flat-ip   exact faiss inner-product scan (histograms are L2-normalised,
+              so this ranks the same as L2)
+    ivf       inverted file over ``IMAGE_ANN_NLIST`` k-means cells,
+              ``IMAGE_ANN_NPROBE`` of them probed per query
+    hnsw      HNSW graph with ``IMAGE_ANN_HNSW_M`` links per node,
+              ``IMAGE_ANN_EF_SEARCH`` candidates per query
+
+Indexes are saved next to the feature store they were built from, tagged
+with the store version, so a rebuilt store never serves a stale index.
+"""
+
+import threading
+
+import numpy as np
+from django.conf import settings
+from scipy.spatial.distance import cdist
+
+from .facets import FacetIndex
+from .image_descriptors import load_descriptors
+from .image_features import FeatureStore, load_feature_store, product_table
+
+try:
+    import faiss
+except ImportError:  # Visual search falls back to the exact path without faiss.
+    faiss = None
+
+ANN_KINDS = ("flat", "flat-ip", "ivf", "hnsw")
+
+
+class AnnIndex:
+    """
+    A faiss index over feature rows; ``search`` returns Euclidean distances
+    like the exact ``cdist`` path does.
+    """
+
+    def __init__(self, index, kind):
+        self.index = index
+        self.kind = kind
+        self.configure()
+
+    @classmethod
+    def build(cls, features, kind):
+        if faiss is None:
+            raise RuntimeError("faiss is not installed")
+        if kind not in ANN_KINDS:
+            raise ValueError(f"Unknown ANN index kind {kind!r}, expected one of {ANN_KINDS}")
+        features = np.ascontiguousarray(features, dtype=np.float32)
+        count, dim = features.shape
+        if kind == "flat":
+            index = faiss.IndexFlatL2(dim)
+        elif kind == "flat-ip":
+            index = faiss.IndexFlatIP(dim)
+        elif kind == "ivf":
+            nlist = getattr(settings, "IMAGE_ANN_NLIST", None) or int(4 * np.sqrt(count))
+            nlist = max(1, min(nlist, count))
+            index = faiss.IndexIVFFlat(faiss.IndexFlatL2(dim), dim, nlist)
+            index.train(features)
+        else:
+            index = faiss.IndexHNSWFlat(dim, getattr(settings, "IMAGE_ANN_HNSW_M", 32))
+        index.add(features)
+        return cls(index, kind)
+
+    def configure(self):
+        if self.kind == "ivf":
+            self.index.nprobe = getattr(settings, "IMAGE_ANN_NPROBE", 8)
+        elif self.kind == "hnsw":
+            self.index.hnsw.efSearch = getattr(settings, "IMAGE_ANN_EF_SEARCH", 64)
+
+    def save(self, path):
+        faiss.write_index(self.index, str(path))
+
+    @classmethod
+    def load(cls, path, kind):
+        try:
+            index = faiss.read_index(str(path), faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+        except RuntimeError:
+            # Not every index type can be memory-mapped.
+            index = faiss.read_index(str(path))
+        return cls(index, kind)
+
+    def search_parameters(self, rows):
+        """
+        faiss search parameters that only admit ``rows``, keeping the
+        index's own nprobe/efSearch (parameters override them otherwise).
+        """
+        selector = faiss.IDSelectorBatch(np.asarray(rows, dtype=np.int64))
+        if self.kind == "ivf":
+            params = faiss.SearchParametersIVF(sel=selector, nprobe=self.index.nprobe)
+        elif self.kind == "hnsw":
+            params = faiss.SearchParametersHNSW(sel=selector, efSearch=self.index.hnsw.efSearch)
+        else:
+            params = faiss.SearchParameters(sel=selector)
+        params.selector_ref = selector  # keep the selector alive with params
+        return params
+
+    def search(self, queries, k, rows=None):
+        """
+        :param queries: float32 array of shape ``(n, dim)``.
+        :param rows: Only return neighbours among these rows.
+        :return: ``(distances, rows)``, each ``(n, k)``; missing neighbours
+            have row ``-1``.
+        """
+        queries = np.ascontiguousarray(queries, dtype=np.float32)
+        k = min(k, self.index.ntotal)
+        if rows is None:
+            scores, rows = self.index.search(queries, k)
+        else:
+            scores, rows = self.index.search(queries, k, params=self.search_parameters(rows))
+        if self.kind == "flat-ip":
+            # |a - b|^2 = 2 - 2 a.b for unit vectors.
+            distances = np.sqrt(np.maximum(2.0 - 2.0 * scores, 0.0))
+        else:
+            distances = np.sqrt(np.maximum(scores, 0.0))
+        return distances, rows
+
+
+_loaded = {}
+_loaded_lock = threading.Lock()
+
+
+def load_ann_index(image_folder, kind, bins=(16, 16, 16)):
+    """
+    Process-wide ANN index for the feature store of ``image_folder``, built
+    and saved on first use if the store has none for its current version.
+    :return: ``(manifest, features, ann_index)``.
+    """
+    manifest, features = load_feature_store(image_folder, bins)
+    store = FeatureStore(image_folder)
+    if not len(features):
+        return manifest, features, None
+    path = store.directory / f"ann-{kind}-{manifest['version']}.faiss"
+    with _loaded_lock:
+        cached = _loaded.get((store.directory, kind))
+        if cached is not None and cached[0] == path:
+            return manifest, features, cached[1]
+        if path.exists():
+            ann = AnnIndex.load(path, kind)
+        else:
+            ann = build_ann_index(store, kind, manifest, features)
+        _loaded[(store.directory, kind)] = (path, ann)
+        return manifest, features, ann
+
+
+def build_ann_index(store, kind, manifest=None, features=None):
+    """
+    Build and save the ``kind`` index for ``store``, removing indexes of
+    older store versions.
+    """
+    if manifest is None:
+        manifest, features = store.load()
+    ann = AnnIndex.build(features, kind)
+    path = store.directory / f"ann-{kind}-{manifest['version']}.faiss"
+    tmp = path.with_suffix(".tmp")
+    ann.save(tmp)
+    tmp.replace(path)
+    for stale in store.directory.glob(f"ann-{kind}-*.faiss"):
+        if stale != path:
+            stale.unlink(missing_ok=True)
+    return ann
+
+
+def nearest_images(
+    image_folder, query_features, k, bins=(16, 16, 16), backend=None, rows=None
+):
+    """
+    Top-``k`` stored images for one query histogram, using the backend from
+    ``IMAGE_SEARCH_BACKEND`` unless ``backend`` is given.
+    :param rows: Only consider these feature rows.
+    :return: ``(manifest, [(row, distance), ...])`` sorted by distance.
+    """
+    if backend is None:
+        backend = getattr(settings, "IMAGE_SEARCH_BACKEND", "exact")
+    if backend == "exact" or faiss is None:
+        manifest, features = load_feature_store(image_folder, bins)
+        if not len(features):
+            return manifest, []
+        if rows is None:
+            rows = np.arange(len(features))
+        distances = cdist([query_features], features[rows], metric="euclidean")[0]
+        order = np.argsort(distances)[:k]
+        return manifest, [(int(rows[i]), float(distances[i])) for i in order]
+
+    manifest, features, ann = load_ann_index(image_folder, backend, bins)
+    if not len(features):
+        return manifest, []
+    distances, rows = ann.search(np.asarray([query_features], dtype=np.float32), k, rows)
+    return manifest, [
+        (int(row), float(distance))
+        for row, distance in zip(rows[0], distances[0])
+        if row >= 0
+    ]
+
+
+def nearest_products(
+    image_folder,
+    query_features,
+    k,
+    bins=(16, 16, 16),
+    aggregate=None,
+    backend=None,
+    filters=None,
+):
+    """
+    Top-``k`` distinct products for one query histogram.
+
+    A product's score aggregates the distances of all its images, either
+    their ``min`` or ``mean`` (``IMAGE_SEARCH_AGGREGATE`` by default). With
+    an ANN backend the index only nominates candidate products. Scores are
+    computed from the ``IMAGE_DESCRIPTOR`` encoding of the stored features.
+
+    ``filters`` (facet field -> value(s), as for text search) restricts the
+    search to matching products before any distance is computed. Subsets of
+    at most ``IMAGE_SEARCH_PREFILTER_EXACT_ROWS`` images are scanned exactly;
+    larger ones go through the ANN index with a row selector.
+    :return: ``[(product_id, score), ...]`` sorted by score.
+    """
+    if aggregate is None:
+        aggregate = getattr(settings, "IMAGE_SEARCH_AGGREGATE", "min")
+    if aggregate not in ("min", "mean"):
+        raise ValueError(f"Unknown aggregate {aggregate!r}, expected 'min' or 'mean'")
+    if backend is None:
+        backend = getattr(settings, "IMAGE_SEARCH_BACKEND", "exact")
+
+    manifest, descriptors = load_descriptors(image_folder, bins=bins)
+    table = product_table(manifest)
+    if not len(table.product_ids):
+        return []
+    allowed = None
+    if filters:
+        allowed = np.isin(
+            table.product_ids, FacetIndex().candidates(filters), assume_unique=True
+        )
+        allowed_rows = table.rows[allowed[table.codes[table.rows]]]
+        if not len(allowed_rows):
+            return []
+        if len(allowed_rows) <= getattr(settings, "IMAGE_SEARCH_PREFILTER_EXACT_ROWS", 50000):
+            backend = "exact"
+
+    if backend == "exact" or faiss is None:
+        if allowed is None:
+            rows = table.rows
+            distances = descriptors.distances(query_features)[rows]
+        else:
+            rows = allowed_rows
+            distances = descriptors.distances(query_features, rows)
+    else:
+        # Enough neighbours to cover k products even if each contributes
+        # all of its images.
+        per_product = int(np.diff(table.indptr).max())
+        _, neighbours = nearest_images(
+            image_folder,
+            query_features,
+            k * per_product,
+            bins,
+            backend,
+            rows=None if allowed is None else allowed_rows,
+        )
+        codes = np.unique(table.codes[[row for row, _ in neighbours]])
+        codes = codes[codes >= 0]
+        if allowed is not None and len(codes) < k:
+            # Selective filters can leave the probed IVF cells (or the HNSW
+            # neighbourhood) without enough matches; scan the subset instead.
+            rows = allowed_rows
+        else:
+            rows = table.product_rows(codes)
+        if not len(rows):
+            return []
+        distances = descriptors.distances(query_features, rows)
+
+    codes = table.codes[rows]
+    if aggregate == "min":
+        scores = np.full(len(table.product_ids), np.inf)
+        np.minimum.at(scores, codes, distances)
+    else:
+        counts = np.bincount(codes, minlength=len(table.product_ids))
+        sums = np.bincount(codes, weights=distances, minlength=len(table.product_ids))
+        scores = np.where(counts > 0, sums / np.maximum(counts, 1), np.inf)
+
+    k = min(k, int(np.isfinite(scores).sum()))
+    if not k:
+        return []
+    top = np.argpartition(scores, k - 1)[:k]
+    top = top[np.argsort(scores[top], kind="stable")]
+    return [(int(table.product_ids[code]), float(scores[code])) for code in top]
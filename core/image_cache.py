@@ -0,0 +1,98 @@
+"""
+Result cache for visual search, keyed by a perceptual hash of the query.
+
+Re-uploads, screenshots and catalog images hash to the same or nearly the
+same 64-bit pHash, so a query within ``IMAGE_QUERY_CACHE_MAX_DISTANCE`` bits
+of a recent one reuses its results without scanning the catalog. The pHash
+is computed in greyscale, while the search ranks colour histograms: a
+recoloured image hashes like the original. A near hit is therefore only
+served if the query's histogram is within
+``IMAGE_QUERY_CACHE_MAX_FEATURE_DISTANCE`` of the one the results were
+ranked for. Entries are tied to the feature-store version they were
+computed against and dropped when the store is rebuilt.
+"""
+
+import threading
+
+import cv2
+import numpy as np
+from django.conf import settings
+
+from .cache import LRUCache
+
+
+def perceptual_hash(image):
+    """
+    64-bit pHash: the signs of the lowest 8x8 DCT frequencies of a 32x32
+    greyscale thumbnail, relative to their median.
+    :param image: Decoded BGR image.
+    """
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    small = cv2.resize(gray, (32, 32), interpolation=cv2.INTER_AREA).astype(np.float32)
+    low = cv2.dct(small)[:8, :8].flatten()
+    bits = low > np.median(low[1:])
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+def hamming_distance(a, b):
+    """
+    Bits that differ between two ``(context, hash)`` cache keys; keys from
+    different contexts never match.
+    """
+    if a[0] != b[0]:
+        return float("inf")
+    return (a[1] ^ b[1]).bit_count()
+
+
+class VisualQueryCache:
+    _instance = None
+    _lock = threading.Lock()
+    _initialized = False
+
+    def __new__(cls):
+        if cls._instance is None:
+            with cls._lock:
+                if cls._instance is None:
+                    cls._instance = super(VisualQueryCache, cls).__new__(cls)
+        return cls._instance
+
+    def __init__(self):
+        if self._initialized:
+            return
+        self.cache = LRUCache(
+            maxsize=getattr(settings, "IMAGE_QUERY_CACHE_SIZE", 1024),
+            ttl=getattr(settings, "IMAGE_QUERY_CACHE_TTL", 3600),
+        )
+        self.max_distance = getattr(settings, "IMAGE_QUERY_CACHE_MAX_DISTANCE", 4)
+        self.max_feature_distance = getattr(
+            settings, "IMAGE_QUERY_CACHE_MAX_FEATURE_DISTANCE", 0.02
+        )
+        self.versions = {}
+        self._initialized = True
+
+    def _check_version(self, image_folder, version):
+        # A rebuilt store invalidates everything computed against the old one.
+        if self.versions.get(image_folder) != version:
+            if image_folder in self.versions:
+                self.cache.clear()
+            self.versions[image_folder] = version
+
+    def get(self, image_folder, version, context, image_hash, features):
+        """
+        :param features: The query's histogram, as passed to the search.
+        :return: Cached results for a query that looks the same, or ``None``.
+        """
+        self._check_version(image_folder, version)
+        entry = self.cache.get_nearest(
+            ((image_folder, version, context), image_hash), hamming_distance, self.max_distance
+        )
+        if entry is None:
+            return None
+        results, cached_features = entry
+        if np.linalg.norm(features - cached_features) > self.max_feature_distance:
+            return None
+        return results
+
+    def set(self, image_folder, version, context, image_hash, features, results):
+        self._check_version(image_folder, version)
+        self.cache.set(((image_folder, version, context), image_hash), (results, features))
@@ -0,0 +1,138 @@
+"""
+Derived images, computed once per source image and stored by content.
+
+For a catalog image whose sha1 is ``<digest>`` the pipeline writes, under
+``IMAGE_DERIVATIVE_DIR/<digest[:2]>/<digest>/``::
+
+    analysis.png       background removed, 256x256; the input of feature
+                       extraction
+    w<width>.webp      display thumbnails, one pair per entry of
+    w<width>.jpg       IMAGE_THUMBNAIL_WIDTHS
+
+Paths depend only on the image content, so a file never changes once it is
+written and can be served with far-future cache headers.
+"""
+
+import os
+import re
+from pathlib import Path
+
+import cv2
+from django.conf import settings
+from django.urls import reverse
+
+ANALYSIS_SIZE = (256, 256)
+ANALYSIS_NAME = "analysis.png"
+DIGEST_RE = re.compile(r"^[0-9a-f]{40}$")
+THUMBNAIL_RE = re.compile(r"^w(\d+)\.(webp|jpg)$")
+THUMBNAIL_FORMATS = {
+    "webp": ([cv2.IMWRITE_WEBP_QUALITY, 80], "image/webp"),
+    "jpg": ([cv2.IMWRITE_JPEG_QUALITY, 82, cv2.IMWRITE_JPEG_PROGRESSIVE, 1], "image/jpeg"),
+}
+
+
+def remove_background(image):
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    _, mask = cv2.threshold(gray, 1, 255, cv2.THRESH_BINARY)
+    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (5, 5))
+    mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, kernel)
+    mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, kernel)
+    result = cv2.bitwise_and(image, image, mask=mask)
+    return result
+
+
+def analysis_image(image):
+    """
+    :param image: Decoded BGR image.
+    :return: The background-removed, 256x256 image features are computed on.
+    """
+    return cv2.resize(remove_background(image), ANALYSIS_SIZE)
+
+
+def derivative_root():
+    return Path(getattr(settings, "IMAGE_DERIVATIVE_DIR", settings.BASE_DIR / "image_derivatives"))
+
+
+def thumbnail_widths():
+    return tuple(getattr(settings, "IMAGE_THUMBNAIL_WIDTHS", (160, 320, 640)))
+
+
+def derivative_names(widths):
+    return {ANALYSIS_NAME} | {
+        f"w{width}.{extension}" for width in widths for extension in THUMBNAIL_FORMATS
+    }
+
+
+def derivative_dir(root, digest):
+    return Path(root) / digest[:2] / digest
+
+
+def has_derivatives(root, digest, widths):
+    try:
+        present = set(os.listdir(derivative_dir(root, digest)))
+    except OSError:
+        return False
+    return derivative_names(widths) <= present
+
+
+def _write_atomic(path, data):
+    tmp = path.with_name(f".{path.name}.tmp")
+    tmp.write_bytes(data)
+    os.replace(tmp, path)
+
+
+def write_derivatives(root, digest, image, widths):
+    """
+    Write the analysis image and thumbnails of one decoded source image.
+    Runs in the feature-extraction pool, so it takes its configuration as
+    arguments rather than reading settings.
+    :return: The analysis image.
+    """
+    directory = derivative_dir(root, digest)
+    directory.mkdir(parents=True, exist_ok=True)
+    analysis = analysis_image(image)
+    _write_atomic(directory / ANALYSIS_NAME, cv2.imencode(".png", analysis)[1].tobytes())
+
+    height, width = image.shape[:2]
+    for target in widths:
+        if width > target:
+            size = (target, max(1, round(height * target / width)))
+            thumbnail = cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+        else:
+            thumbnail = image
+        for extension, (params, _) in THUMBNAIL_FORMATS.items():
+            encoded = cv2.imencode(f".{extension}", thumbnail, params)[1].tobytes()
+            _write_atomic(directory / f"w{target}.{extension}", encoded)
+    return analysis
+
+
+def read_analysis(root, digest):
+    """
+    :return: The stored analysis image, or ``None`` if it is missing.
+    """
+    return cv2.imread(str(derivative_dir(root, digest) / ANALYSIS_NAME))
+
+
+def thumbnail_path(digest, name):
+    """
+    Resolve a requested thumbnail; analysis images are not served.
+    :return: Path and content type, or ``None`` for anything else.
+    """
+    match = THUMBNAIL_RE.match(name)
+    if not DIGEST_RE.match(digest) or not match:
+        return None
+    path = derivative_dir(derivative_root(), digest) / name
+    return path, THUMBNAIL_FORMATS[match.group(2)][1]
+
+
+def thumbnail_urls(digest):
+    """
+    :return: ``{"webp": {"320": url, ...}, "jpg": {...}}`` for one image.
+    """
+    return {
+        extension: {
+            str(width): reverse("product_image", args=[digest, f"w{width}.{extension}"])
+            for width in thumbnail_widths()
+        }
+        for extension in THUMBNAIL_FORMATS
+    }
@@ -0,0 +1,328 @@
+"""
+Compact encodings of the image feature matrix.
+
+The stored features are float32 colour histograms, 4096 values (16 KB) per
+image. The encodings here trade a little ranking accuracy for memory:
+
+    float32   the stored features as they are (the reference)
+    float16   half precision, 2x smaller
+    uint8     one byte per bin plus a float32 scale per image, 4x smaller
+    pca       projection onto the top ``IMAGE_DESCRIPTOR_PCA_DIM`` principal
+              components
+    sparse    CSR matrix of the bins above ``IMAGE_DESCRIPTOR_SPARSE_THRESHOLD``;
+              most bins of a background-removed histogram are empty
+
+``IMAGE_DESCRIPTOR`` selects the encoding visual search ranks with. Encoded
+arrays are saved next to the feature store as ``.npy`` files tagged with the
+store version and memory-mapped by workers, like the features themselves.
+"""
+
+import shutil
+import threading
+from abc import ABC, abstractmethod
+
+import numpy as np
+import scipy.sparse as sp
+from django.conf import settings
+from scipy.spatial.distance import cdist
+
+from .image_features import FeatureStore, load_feature_store
+
+CHUNK_ROWS = 8192
+
+
+def _chunked_cdist(query, data):
+    distances = np.empty(len(data), dtype=np.float64)
+    for start in range(0, len(data), CHUNK_ROWS):
+        chunk = np.asarray(data[start : start + CHUNK_ROWS], dtype=np.float32)
+        distances[start : start + len(chunk)] = cdist([query], chunk, metric="euclidean")[0]
+    return distances
+
+
+def _dot_distances(query, data, norms, scale=None):
+    """
+    Euclidean distances as ``sqrt(|q|^2 + |x|^2 - 2 q.x)``, decoding at most
+    ``CHUNK_ROWS`` rows of ``data`` to float32 at a time.
+    :param norms: Squared norms of the decoded rows.
+    :param scale: Optional per-row factor applied to ``q.x``.
+    """
+    query = np.asarray(query, dtype=np.float32)
+    dots = np.empty(len(data), dtype=np.float32)
+    for start in range(0, len(data), CHUNK_ROWS):
+        chunk = data[start : start + CHUNK_ROWS].astype(np.float32)
+        dots[start : start + len(chunk)] = chunk @ query
+    if scale is not None:
+        dots *= scale
+    return np.sqrt(np.maximum(float(query @ query) + norms - 2 * dots, 0))
+
+
+def _squared_norms(data):
+    return np.concatenate(
+        [
+            np.einsum("ij,ij->i", chunk, chunk)
+            for chunk in (
+                data[start : start + CHUNK_ROWS].astype(np.float32)
+                for start in range(0, len(data), CHUNK_ROWS)
+            )
+        ]
+        or [np.empty(0, dtype=np.float32)]
+    ).astype(np.float32)
+
+
+class Descriptors(ABC):
+    """
+    Base class: a named set of arrays that can answer distance queries.
+    Encodings implement ``__len__``, ``encode`` and ``distances``.
+    """
+
+    kind = None
+
+    def __init__(self, **arrays):
+        self.arrays = arrays
+
+    @abstractmethod
+    def __len__(self):
+        pass
+
+    @classmethod
+    @abstractmethod
+    def encode(cls, features, **options):
+        """
+        :param features: float32 feature matrix, one row per image.
+        :return: The encoded descriptors.
+        """
+
+    @abstractmethod
+    def distances(self, query, rows=None):
+        """
+        :param query: float32 histogram.
+        :param rows: Only score these rows (default: all, in order).
+        :return: Approximate Euclidean distances, one per row.
+        """
+
+    @property
+    def nbytes(self):
+        return sum(array.nbytes for array in self.arrays.values())
+
+    def save(self, directory):
+        directory.mkdir(parents=True, exist_ok=True)
+        for name, array in self.arrays.items():
+            np.save(directory / f"{name}.npy", array)
+
+    @classmethod
+    def load(cls, directory):
+        return cls(**{path.stem: np.load(path, mmap_mode="r") for path in directory.glob("*.npy")})
+
+
+class Float32Descriptors(Descriptors):
+    kind = "float32"
+
+    def __len__(self):
+        return len(self.arrays["data"])
+
+    @classmethod
+    def encode(cls, features, **options):
+        return cls(data=np.asarray(features, dtype=np.float32))
+
+    def distances(self, query, rows=None):
+        data = self.arrays["data"]
+        return _chunked_cdist(query, data if rows is None else data[rows])
+
+
+class Float16Descriptors(Descriptors):
+    kind = "float16"
+
+    def __len__(self):
+        return len(self.arrays["data"])
+
+    @classmethod
+    def encode(cls, features, **options):
+        data = np.asarray(features, dtype=np.float16)
+        return cls(data=data, norms=_squared_norms(data))
+
+    def distances(self, query, rows=None):
+        data, norms = self.arrays["data"], self.arrays["norms"]
+        if rows is not None:
+            data, norms = data[rows], norms[rows]
+        return _dot_distances(query, data, norms)
+
+
+class Uint8Descriptors(Descriptors):
+    """
+    Each row is scaled so its largest bin maps to 255; ``step`` is the
+    per-row value of one code unit.
+    """
+
+    kind = "uint8"
+
+    def __len__(self):
+        return len(self.arrays["codes"])
+
+    @classmethod
+    def encode(cls, features, **options):
+        features = np.asarray(features, dtype=np.float32)
+        scale = features.max(axis=1) if len(features) else np.empty(0, dtype=np.float32)
+        scale = np.where(scale > 0, scale, 1.0).astype(np.float32)
+        codes = np.rint(features / scale[:, None] * 255).astype(np.uint8)
+        step = scale / 255
+        return cls(codes=codes, step=step, norms=_squared_norms(codes) * step**2)
+
+    def distances(self, query, rows=None):
+        codes, step, norms = self.arrays["codes"], self.arrays["step"], self.arrays["norms"]
+        if rows is not None:
+            codes, step, norms = codes[rows], step[rows], norms[rows]
+        return _dot_distances(query, codes, norms, scale=step)
+
+
+class PCADescriptors(Descriptors):
+    kind = "pca"
+
+    def __len__(self):
+        return len(self.arrays["data"])
+
+    @classmethod
+    def encode(cls, features, dim=128, sample=20000, seed=0, **options):
+        from sklearn.decomposition import PCA
+
+        features = np.asarray(features, dtype=np.float32)
+        dim = max(1, min(dim, *features.shape))
+        rng = np.random.default_rng(seed)
+        fit_rows = (
+            np.sort(rng.choice(len(features), sample, replace=False))
+            if len(features) > sample
+            else slice(None)
+        )
+        pca = PCA(n_components=dim, svd_solver="randomized", random_state=seed)
+        pca.fit(features[fit_rows])
+        mean = pca.mean_.astype(np.float32)
+        components = pca.components_.astype(np.float32)
+        data = np.vstack(
+            [
+                (features[start : start + CHUNK_ROWS] - mean) @ components.T
+                for start in range(0, len(features), CHUNK_ROWS)
+            ]
+            or [np.empty((0, dim), dtype=np.float32)]
+        )
+        return cls(data=data, mean=mean, components=components)
+
+    def distances(self, query, rows=None):
+        projected = (np.asarray(query, dtype=np.float32) - self.arrays["mean"]) @ self.arrays[
+            "components"
+        ].T
+        data = self.arrays["data"]
+        return _chunked_cdist(projected, data if rows is None else data[rows])
+
+
+class SparseDescriptors(Descriptors):
+    """
+    Bins below ``threshold`` are dropped; distances use
+    ``|q|^2 + |x|^2 - 2 q.x`` with the squared norms of the kept bins.
+    """
+
+    kind = "sparse"
+
+    def __init__(self, **arrays):
+        super().__init__(**arrays)
+        self.matrix = sp.csr_matrix(
+            (arrays["data"], arrays["indices"], arrays["indptr"]),
+            shape=tuple(arrays["shape"]),
+        )
+
+    def __len__(self):
+        return self.matrix.shape[0]
+
+    @classmethod
+    def encode(cls, features, threshold=1e-3, **options):
+        blocks = []
+        for start in range(0, len(features), CHUNK_ROWS):
+            chunk = np.asarray(features[start : start + CHUNK_ROWS], dtype=np.float32)
+            blocks.append(sp.csr_matrix(np.where(chunk >= threshold, chunk, 0)))
+        matrix = (
+            sp.vstack(blocks, format="csr")
+            if blocks
+            else sp.csr_matrix((0, features.shape[1]), dtype=np.float32)
+        )
+        # Same dtype for both so loading can keep the memory maps as-is.
+        index_dtype = np.int32 if matrix.nnz < np.iinfo(np.int32).max else np.int64
+        return cls(
+            data=matrix.data.astype(np.float32),
+            indices=matrix.indices.astype(index_dtype),
+            indptr=matrix.indptr.astype(index_dtype),
+            shape=np.array(matrix.shape, dtype=np.int64),
+            norms=np.asarray(matrix.multiply(matrix).sum(axis=1), dtype=np.float32).ravel(),
+        )
+
+    def distances(self, query, rows=None):
+        matrix, norms = self.matrix, self.arrays["norms"]
+        if rows is not None:
+            matrix, norms = matrix[rows], norms[rows]
+        query = np.asarray(query, dtype=np.float32)
+        squared = float(query @ query) + norms - 2 * (matrix @ query)
+        return np.sqrt(np.maximum(squared, 0))
+
+
+DESCRIPTOR_KINDS = {
+    cls.kind: cls
+    for cls in (
+        Float32Descriptors,
+        Float16Descriptors,
+        Uint8Descriptors,
+        PCADescriptors,
+        SparseDescriptors,
+    )
+}
+
+
+def encode_options(kind):
+    if kind == "pca":
+        return {"dim": getattr(settings, "IMAGE_DESCRIPTOR_PCA_DIM", 128)}
+    if kind == "sparse":
+        return {"threshold": getattr(settings, "IMAGE_DESCRIPTOR_SPARSE_THRESHOLD", 1e-3)}
+    return {}
+
+
+_loaded = {}
+_loaded_lock = threading.Lock()
+
+
+def load_descriptors(image_folder, kind=None, bins=(16, 16, 16)):
+    """
+    Process-wide ``kind`` descriptors (``IMAGE_DESCRIPTOR`` by default) for
+    the feature store of ``image_folder``, encoded and saved on first use.
+    :return: ``(manifest, descriptors)``.
+    """
+    if kind is None:
+        kind = getattr(settings, "IMAGE_DESCRIPTOR", "float32")
+    manifest, features = load_feature_store(image_folder, bins)
+    if kind == "float32":
+        return manifest, Float32Descriptors(data=features)
+
+    store = FeatureStore(image_folder)
+    directory = store.directory / f"descriptors-{kind}-{manifest['version']}"
+    with _loaded_lock:
+        cached = _loaded.get((store.directory, kind))
+        if cached is not None and cached[0] == directory:
+            return manifest, cached[1]
+        if not (directory / "done").exists():
+            build_descriptors(store, kind, manifest, features)
+        descriptors = DESCRIPTOR_KINDS[kind].load(directory)
+        _loaded[(store.directory, kind)] = (directory, descriptors)
+        return manifest, descriptors
+
+
+def build_descriptors(store, kind, manifest=None, features=None):
+    """
+    Encode and save the ``kind`` descriptors of ``store``, removing those of
+    older store versions.
+    """
+    if manifest is None:
+        manifest, features = store.load()
+    descriptors = DESCRIPTOR_KINDS[kind].encode(features, **encode_options(kind))
+    directory = store.directory / f"descriptors-{kind}-{manifest['version']}"
+    shutil.rmtree(directory, ignore_errors=True)
+    descriptors.save(directory)
+    (directory / "done").touch()
+    for stale in store.directory.glob(f"descriptors-{kind}-*"):
+        if stale != directory:
+            shutil.rmtree(stale, ignore_errors=True)
+    return descriptors
@@ -0,0 +1,503 @@
+"""
+Colour-histogram features for visual search, and a persistent store for
+the catalog's features.
+
+The store for an image folder lives in its own directory under
+``IMAGE_FEATURE_DIR``::
+
+    features-<version>.f32   float32[N x D], row i belongs to images[i]
+    manifest.json            format, bins, version, the features file name and
+                             one entry per image with its path, product id,
+                             mtime, size and sha1
+
+Workers map the features file read-only, so a query only has to extract the
+uploaded image and compute distances. While a build runs, finished chunks
+are checkpointed under ``pending/`` so an interrupted build can resume.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+import cv2
+import numpy as np
+from django.conf import settings
+
+from .image_derivatives import (
+    analysis_image,
+    derivative_root,
+    has_derivatives,
+    read_analysis,
+    thumbnail_widths,
+    write_derivatives,
+)
+
+FORMAT_VERSION = 1
+PRODUCT_IMAGE_RE = re.compile(r"product_(\d+)_image(\d+)\.jpg$")
+
+logger = logging.getLogger(__name__)
+
+
+def histogram(analysis, bins=(16, 16, 16)):
+    """
+    :param analysis: An ``analysis_image``.
+    :return: L2-normalised 3D colour histogram, flattened to float32.
+    """
+    hist = cv2.calcHist([analysis], [0, 1, 2], None, bins, [0, 256, 0, 256, 0, 256])
+    hist = cv2.normalize(hist, hist).flatten()
+    return hist
+
+
+def image_features(image, bins=(16, 16, 16)):
+    """
+    :param image: Decoded BGR image.
+    :return: L2-normalised 3D colour histogram, flattened to float32.
+    """
+    return histogram(analysis_image(image), bins)
+
+
+def decode_image(data):
+    """
+    :param data: Encoded image bytes (JPEG, PNG, ...).
+    :return: Decoded BGR image, or ``None`` if the bytes are not an image.
+    """
+    buffer = np.frombuffer(data, dtype=np.uint8)
+    if not buffer.size:
+        return None
+    return cv2.imdecode(buffer, cv2.IMREAD_COLOR)
+
+
+def extract_features(image_path, bins=(16, 16, 16)):
+    image = cv2.imread(image_path)
+    if image is None:
+        logger.warning("Error reading image: %s", image_path)
+        return None
+    return image_features(image, bins)
+
+
+def _init_worker():
+    # One OpenCV thread per process; the pool provides the parallelism.
+    cv2.setNumThreads(1)
+
+
+def extract_chunk(paths, bins=(16, 16, 16), digests=None, derivatives=None):
+    """
+    Extract features for a chunk of image paths (runs in pool workers).
+
+    With ``derivatives`` (``(root, widths)``) and the images' ``digests``,
+    features come from the stored analysis image when there is one, and
+    otherwise the source is decoded once to write all derivatives.
+    :return: ``(features, ok)``; ``ok[i]`` is false for unreadable images.
+    """
+    features = np.zeros((len(paths), int(np.prod(bins))), dtype=np.float32)
+    ok = np.zeros(len(paths), dtype=bool)
+    for i, path in enumerate(paths):
+        analysis = None
+        if derivatives is not None:
+            root, widths = derivatives
+            if has_derivatives(root, digests[i], widths):
+                analysis = read_analysis(root, digests[i])
+        if analysis is None:
+            image = cv2.imread(path)
+            if image is None:
+                continue
+            if derivatives is not None:
+                analysis = write_derivatives(root, digests[i], image, widths)
+            else:
+                analysis = analysis_image(image)
+        features[i] = histogram(analysis, bins)
+        ok[i] = True
+    return features, ok
+
+
+def product_id_for_path(path):
+    match = PRODUCT_IMAGE_RE.search(os.path.basename(path))
+    return int(match.group(1)) if match else None
+
+
+def file_sha1(path):
+    digest = hashlib.sha1()
+    with open(path, "rb") as handle:
+        for block in iter(lambda: handle.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def list_images(image_folder):
+    return sorted(
+        os.path.join(image_folder, filename)
+        for filename in os.listdir(image_folder)
+        if filename.endswith(".jpg")
+    )
+
+
+class FeatureStore:
+    """
+    Persistent feature matrix for one image folder.
+    """
+
+    def __init__(self, image_folder, directory=None):
+        self.image_folder = str(image_folder)
+        if directory is None:
+            key = hashlib.sha1(os.path.abspath(self.image_folder).encode()).hexdigest()
+            directory = Path(
+                getattr(settings, "IMAGE_FEATURE_DIR", settings.BASE_DIR / "image_features")
+            ) / key[:12]
+        self.directory = Path(directory)
+
+    @property
+    def manifest_path(self):
+        return self.directory / "manifest.json"
+
+    def read_manifest(self):
+        try:
+            manifest = json.loads(self.manifest_path.read_text())
+        except (OSError, ValueError):
+            return None
+        if manifest.get("format") != FORMAT_VERSION:
+            return None
+        return manifest
+
+    def load(self):
+        """
+        Map the stored features read-only.
+        :return: ``(manifest, features)`` or ``None`` if nothing is stored.
+        """
+        manifest = self.read_manifest()
+        if manifest is None:
+            return None
+        count, dim = len(manifest["images"]), manifest["dim"]
+        if not count:
+            return manifest, np.empty((0, dim), dtype=np.float32)
+        features = np.memmap(
+            self.directory / manifest["features"], dtype=np.float32, mode="r", shape=(count, dim)
+        )
+        return manifest, features
+
+    @property
+    def checkpoint_dir(self):
+        return self.directory / "pending"
+
+    def build(self, bins=(16, 16, 16), full=False, workers=1, chunk_size=256, progress=None):
+        """
+        Bring the store in line with the image folder.
+
+        Images whose mtime and size (or, failing that, sha1) match the
+        manifest keep their stored row; only new or changed images are
+        decoded, in chunks spread over ``workers`` processes. Each finished
+        chunk is checkpointed, so a build that crashes resumes where it
+        stopped. Files are replaced atomically, so workers mapping the
+        previous version are unaffected.
+
+        Unless ``IMAGE_DERIVATIVES`` is off, every image also gets its
+        derivatives (see ``image_derivatives``); images that already have
+        them are extracted from the small analysis image, not the original.
+        :param progress: Called as ``progress(done, total)`` after each chunk.
+        :return: Dict with ``total``, ``reused``, ``resumed``, ``extracted``
+            and ``failed`` counts.
+        """
+        bins = list(bins)
+        dim = int(np.prod(bins))
+        previous = None if full else self.load()
+        if previous is not None and previous[0]["bins"] != bins:
+            previous = None
+        by_path, by_sha1 = {}, {}
+        if previous is not None:
+            for row, entry in enumerate(previous[0]["images"]):
+                by_path[entry["path"]] = (row, entry)
+                by_sha1[entry["sha1"]] = row
+        checkpointed = self._read_checkpoints(bins)
+        derivatives = (
+            (str(derivative_root()), thumbnail_widths())
+            if getattr(settings, "IMAGE_DERIVATIVES", True)
+            else None
+        )
+
+        entries, sources, todo = [], [], []
+        reused = resumed = 0
+        for path in list_images(self.image_folder):
+            stat = os.stat(path)
+            cached = by_path.get(path)
+            unchanged = (
+                cached is not None
+                and cached[1]["mtime"] == stat.st_mtime_ns
+                and cached[1]["size"] == stat.st_size
+            )
+            resuming = False
+            if unchanged:
+                sha1, source = cached[1]["sha1"], previous[1][cached[0]]
+            else:
+                sha1 = file_sha1(path)
+                if sha1 in by_sha1:
+                    source = previous[1][by_sha1[sha1]]
+                elif sha1 in checkpointed:
+                    source, resuming = checkpointed[sha1], True
+                else:
+                    source = None
+            if source is not None and derivatives and not has_derivatives(derivatives[0], sha1, derivatives[1]):
+                # Decode the source once more to write its derivatives.
+                source = None
+            if source is None:
+                todo.append(len(entries))
+            elif resuming:
+                resumed += 1
+            else:
+                reused += 1
+            sources.append(source)
+            entries.append(
+                {
+                    "path": path,
+                    "product_id": product_id_for_path(path),
+                    "mtime": stat.st_mtime_ns,
+                    "size": stat.st_size,
+                    "sha1": sha1,
+                }
+            )
+
+        # Rows go straight into the new features file, never into one big
+        # in-memory matrix.
+        version = time.time_ns()
+        features_name = f"features-{version}.f32"
+        features = self._allocate(features_name, len(entries), dim)
+        for row, source in enumerate(sources):
+            if source is not None:
+                features[row] = source
+        del sources
+
+        ok = np.ones(len(entries), dtype=bool)
+        done = 0
+        for chunk, (extracted, chunk_ok) in self._extract(
+            [entries[i]["path"] for i in todo],
+            [entries[i]["sha1"] for i in todo],
+            bins,
+            derivatives,
+            workers,
+            chunk_size,
+        ):
+            rows = np.array([todo[i] for i in chunk], dtype=np.int64)
+            features[rows] = extracted
+            ok[rows] = chunk_ok
+            self._write_checkpoint(
+                [entries[row]["sha1"] for row in rows[chunk_ok]], extracted[chunk_ok], bins
+            )
+            done += len(chunk)
+            if progress:
+                progress(done, len(todo))
+
+        failed = int((~ok).sum())
+        if failed:
+            # Drop unreadable images by compacting the rows in place.
+            kept = np.flatnonzero(ok)
+            for target, row in enumerate(kept):
+                if target != row:
+                    features[target] = features[row]
+            entries = [entries[row] for row in kept]
+        if features is not None:
+            features.flush()
+            del features
+        if failed:
+            os.truncate(self.directory / features_name, len(entries) * dim * 4)
+
+        self._publish(features_name, version, entries, bins)
+        shutil.rmtree(self.checkpoint_dir, ignore_errors=True)
+        return {
+            "total": len(entries),
+            "reused": reused,
+            "resumed": resumed,
+            "extracted": len(todo) - failed,
+            "failed": failed,
+        }
+
+    def _allocate(self, features_name, count, dim):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = self.directory / features_name
+        if not count:
+            path.touch()
+            return None
+        return np.memmap(path, dtype=np.float32, mode="w+", shape=(count, dim))
+
+    @staticmethod
+    def _extract(paths, digests, bins, derivatives, workers, chunk_size):
+        """
+        Yield ``(chunk_indices, (features, ok))`` as chunks of ``paths``
+        finish, in completion order.
+        """
+        chunks = [range(i, min(i + chunk_size, len(paths))) for i in range(0, len(paths), chunk_size)]
+        if workers <= 1 or len(chunks) <= 1:
+            for chunk in chunks:
+                yield chunk, extract_chunk(
+                    [paths[i] for i in chunk], tuple(bins), [digests[i] for i in chunk], derivatives
+                )
+            return
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as pool:
+            futures = {
+                pool.submit(
+                    extract_chunk,
+                    [paths[i] for i in chunk],
+                    tuple(bins),
+                    [digests[i] for i in chunk],
+                    derivatives,
+                ): chunk
+                for chunk in chunks
+            }
+            for future in as_completed(futures):
+                yield futures[future], future.result()
+
+    def _read_checkpoints(self, bins):
+        """
+        :return: ``{sha1: feature}`` saved by an earlier, interrupted build.
+        """
+        features = {}
+        for path in self.checkpoint_dir.glob("chunk-*.npz"):
+            try:
+                with np.load(path) as chunk:
+                    if chunk["bins"].tolist() != bins:
+                        continue
+                    features.update(zip(chunk["sha1"].tolist(), chunk["features"]))
+            except (OSError, ValueError, KeyError):
+                continue
+        return features
+
+    def _write_checkpoint(self, sha1s, features, bins):
+        if not sha1s:
+            return
+        self.checkpoint_dir.mkdir(parents=True, exist_ok=True)
+        name = hashlib.sha1("".join(sha1s).encode()).hexdigest()
+        tmp = self.checkpoint_dir / f"{name}.tmp.npz"
+        np.savez(tmp, sha1=np.array(sha1s), features=features, bins=np.array(bins))
+        os.replace(tmp, self.checkpoint_dir / f"chunk-{name}.npz")
+
+    def _publish(self, features_name, version, entries, bins):
+        previous = self.read_manifest()
+        manifest = {
+            "format": FORMAT_VERSION,
+            "image_folder": self.image_folder,
+            "bins": list(bins),
+            "dim": int(np.prod(bins)),
+            "version": version,
+            "features": features_name,
+            "images": entries,
+        }
+        tmp_manifest = self.manifest_path.with_suffix(".json.tmp")
+        tmp_manifest.write_text(json.dumps(manifest))
+        os.replace(tmp_manifest, self.manifest_path)
+
+        # Keep the previous file for readers holding the old manifest; workers
+        # that already map an older one keep their mapping after unlink.
+        keep = {features_name, previous and previous.get("features")}
+        for stale in self.directory.glob("features-*.f32"):
+            if stale.name not in keep:
+                stale.unlink(missing_ok=True)
+
+
+class ProductTable:
+    """
+    Image row -> product mapping for one store version, from the product ids
+    recorded in the manifest.
+
+    ``codes[row]`` indexes ``product_ids`` (``-1`` for images that belong to
+    no product); the rows of product ``code`` are
+    ``rows[indptr[code]:indptr[code + 1]]``.
+    """
+
+    def __init__(self, manifest):
+        ids = np.array(
+            [-1 if entry["product_id"] is None else entry["product_id"] for entry in manifest["images"]],
+            dtype=np.int64,
+        )
+        self.product_ids, codes = np.unique(ids[ids >= 0], return_inverse=True)
+        self.codes = np.full(len(ids), -1, dtype=np.int64)
+        self.codes[ids >= 0] = codes
+        self.rows = np.argsort(self.codes, kind="stable")
+        self.rows = self.rows[self.codes[self.rows] >= 0]
+        self.indptr = np.concatenate(
+            ([0], np.cumsum(np.bincount(codes, minlength=len(self.product_ids))))
+        ).astype(np.int64)
+
+    def product_rows(self, codes):
+        return np.concatenate(
+            [self.rows[self.indptr[code] : self.indptr[code + 1]] for code in codes]
+            or [np.empty(0, dtype=np.int64)]
+        )
+
+
+_tables = {}
+
+
+def product_table(manifest):
+    """
+    :return: The ``ProductTable`` of this manifest, built once per version.
+    """
+    key = (manifest["image_folder"], manifest["version"])
+    table = _tables.get(key)
+    if table is None:
+        table = ProductTable(manifest)
+        _tables.clear()
+        _tables[key] = table
+    return table
+
+
+_thumbnails = {}
+
+
+def catalog_thumbnails():
+    """
+    Image digests of each product in ``PRODUCT_IMAGE_DIR``, for linking to
+    their derivatives. Re-read when the store's manifest changes.
+    :return: ``(stamp, {product_id: [digest, ...]})``; the stamp changes
+        whenever the mapping may have.
+    """
+    if not getattr(settings, "IMAGE_DERIVATIVES", True):
+        return None, {}
+    store = FeatureStore(settings.PRODUCT_IMAGE_DIR)
+    try:
+        stamp = store.manifest_path.stat().st_mtime_ns
+    except OSError:
+        return None, {}
+    cached = _thumbnails.get(store.directory)
+    if cached is None or cached[0] != stamp:
+        digests = {}
+        for entry in (store.read_manifest() or {}).get("images", []):
+            if entry["product_id"] is not None:
+                digests.setdefault(entry["product_id"], []).append(entry["sha1"])
+        cached = (stamp, digests)
+        _thumbnails[store.directory] = cached
+    return cached
+
+
+_loaded = {}
+_loaded_lock = threading.Lock()
+
+
+def load_feature_store(image_folder, bins=(16, 16, 16)):
+    """
+    Process-wide access to the feature store of ``image_folder``.
+
+    The mapped matrix is reused until the manifest on disk changes. If no
+    store exists yet (or it was built with other bins) it is built first.
+    :return: ``(manifest, features)``.
+    """
+    store = FeatureStore(image_folder)
+    try:
+        stamp = store.manifest_path.stat().st_mtime_ns
+    except OSError:
+        stamp = None
+    key = store.directory
+    with _loaded_lock:
+        cached = _loaded.get(key)
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+        loaded = store.load() if stamp is not None else None
+        if loaded is None or loaded[0]["bins"] != list(bins):
+            store.build(bins)
+            stamp = store.manifest_path.stat().st_mtime_ns
+            loaded = store.load()
+        _loaded[key] = (stamp, loaded)
+        return loaded
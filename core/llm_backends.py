@@ -0,0 +1,285 @@
+"""
+Language model backends behind the shopping assistant.
+
+A backend is stateless: every call gets the whole conversation as a list
+of ``{"role": "user" | "assistant", "content": text}`` messages plus an
+optional system instruction, and conversation state lives with the
+caller. ``LLM_BACKEND`` picks one:
+
+    gemini    Google Gemini (``LLM_MODEL``, default gemini-1.5-flash), with
+              the key from ``GEMINI_API_KEY``
+    ollama    a local ollama server (``OLLAMA_HOST``, ``OLLAMA_MODEL``)
+    fake      no model at all: a deterministic reply delivered with the
+              latency and token rate of ``LLM_FAKE_PROFILE``, for load tests
+"""
+
+import asyncio
+import os
+import random
+import time
+import zlib
+from abc import ABC, abstractmethod
+
+from django.conf import settings
+
+try:
+    import google.generativeai as genai
+except ImportError:
+    genai = None
+
+try:
+    import ollama
+except ImportError:
+    ollama = None
+
+
+class LLMBackend(ABC):
+    """
+    Base class of the backends. ``complete`` returns the whole reply,
+    ``stream`` yields it in text chunks as they are generated; the async
+    variants do the same without blocking the event loop. ``astream`` is a
+    coroutine so that opening the stream (up to the first chunk) can be
+    timed out and retried, and returns an async iterator of chunks.
+
+    Backends implement ``stream`` and ``astream``; ``complete`` and
+    ``acomplete`` join their chunks unless overridden.
+    """
+
+    name = None
+
+    def complete(self, messages, system=None):
+        return "".join(self.stream(messages, system))
+
+    @abstractmethod
+    def stream(self, messages, system=None):
+        pass
+
+    async def acomplete(self, messages, system=None):
+        return "".join([chunk async for chunk in await self.astream(messages, system)])
+
+    @abstractmethod
+    async def astream(self, messages, system=None):
+        pass
+
+
+class GeminiBackend(LLMBackend):
+    name = "gemini"
+
+    def __init__(self, model_name=None):
+        if genai is None:
+            raise RuntimeError("google-generativeai is not installed")
+        api_key = getattr(settings, "GEMINI_API_KEY", None) or os.environ.get("GEMINI_API_KEY")
+        if not api_key:
+            raise ValueError(
+                "Gemini API key not found in settings or environment variables"
+            )
+        genai.configure(api_key=api_key)
+        self.model_name = model_name or getattr(settings, "LLM_MODEL", "gemini-1.5-flash")
+        self._models = {}
+
+    def _model(self, system):
+        # One model object per system instruction; there are only a few.
+        model = self._models.get(system)
+        if model is None:
+            model = genai.GenerativeModel(
+                model_name=self.model_name, tools=[], system_instruction=system
+            )
+            self._models[system] = model
+        return model
+
+    @staticmethod
+    def _contents(messages):
+        return [
+            {
+                "role": "model" if message["role"] == "assistant" else "user",
+                "parts": [message["content"]],
+            }
+            for message in messages
+        ]
+
+    @staticmethod
+    def _text(chunk):
+        try:
+            return chunk.text
+        except ValueError:
+            # Chunks without text parts (e.g. only safety metadata).
+            return ""
+
+    def complete(self, messages, system=None):
+        return self._model(system).generate_content(self._contents(messages)).text
+
+    def stream(self, messages, system=None):
+        response = self._model(system).generate_content(self._contents(messages), stream=True)
+        for chunk in response:
+            text = self._text(chunk)
+            if text:
+                yield text
+
+    async def acomplete(self, messages, system=None):
+        response = await self._model(system).generate_content_async(self._contents(messages))
+        return response.text
+
+    async def astream(self, messages, system=None):
+        response = await self._model(system).generate_content_async(
+            self._contents(messages), stream=True
+        )
+
+        async def texts():
+            async for chunk in response:
+                text = self._text(chunk)
+                if text:
+                    yield text
+
+        return texts()
+
+
+class OllamaBackend(LLMBackend):
+    name = "ollama"
+
+    def __init__(self, model_name=None, host=None):
+        if ollama is None:
+            raise RuntimeError("ollama is not installed")
+        self.model_name = model_name or getattr(settings, "OLLAMA_MODEL", "llama3.2")
+        host = host or getattr(settings, "OLLAMA_HOST", None)
+        self.client = ollama.Client(host=host)
+        self.async_client = ollama.AsyncClient(host=host)
+
+    @staticmethod
+    def _messages(messages, system):
+        return ([{"role": "system", "content": system}] if system else []) + list(messages)
+
+    def complete(self, messages, system=None):
+        response = self.client.chat(model=self.model_name, messages=self._messages(messages, system))
+        return response["message"]["content"]
+
+    def stream(self, messages, system=None):
+        for part in self.client.chat(
+            model=self.model_name, messages=self._messages(messages, system), stream=True
+        ):
+            if part["message"]["content"]:
+                yield part["message"]["content"]
+
+    async def acomplete(self, messages, system=None):
+        response = await self.async_client.chat(
+            model=self.model_name, messages=self._messages(messages, system)
+        )
+        return response["message"]["content"]
+
+    async def astream(self, messages, system=None):
+        parts = await self.async_client.chat(
+            model=self.model_name, messages=self._messages(messages, system), stream=True
+        )
+
+        async def texts():
+            async for part in parts:
+                if part["message"]["content"]:
+                    yield part["message"]["content"]
+
+        return texts()
+
+
+# first_token: seconds before the first token; tokens_per_second: decoding
+# rate (None for all at once); reply_tokens: length of every reply; jitter:
+# +/- fraction applied to both times, seeded by the conversation.
+FAKE_PROFILES = {
+    "instant": {"first_token": 0.0, "tokens_per_second": None, "reply_tokens": 40, "jitter": 0.0},
+    "flash": {"first_token": 0.4, "tokens_per_second": 150.0, "reply_tokens": 40, "jitter": 0.0},
+    "slow": {"first_token": 1.5, "tokens_per_second": 30.0, "reply_tokens": 80, "jitter": 0.2},
+}
+
+FAKE_WORDS = (
+    "great choice this piece comes in several colors and fits true to size "
+    "would you like me to filter by color or show similar items from the new "
+    "collection it pairs well with denim and is perfect for everyday wear"
+).split()
+
+
+class FakeBackend(LLMBackend):
+    """
+    Deterministic stand-in for a real model: the same conversation always
+    gets the same reply, after the same simulated delay.
+    :param profile: Name of a ``FAKE_PROFILES`` entry or a dict of the same
+        shape; ``LLM_FAKE_PROFILE`` by default.
+    """
+
+    name = "fake"
+
+    def __init__(self, profile=None):
+        if profile is None:
+            profile = getattr(settings, "LLM_FAKE_PROFILE", "flash")
+        if isinstance(profile, str):
+            if profile not in FAKE_PROFILES:
+                raise ValueError(
+                    f"Unknown fake LLM profile {profile!r}, expected one of {tuple(FAKE_PROFILES)}"
+                )
+            profile = FAKE_PROFILES[profile]
+        self.profile = {**FAKE_PROFILES["instant"], **profile}
+
+    def plan(self, messages, system=None):
+        """
+        :return: ``(tokens, first_token_seconds, seconds_per_token)`` of the
+            reply to ``messages``.
+        """
+        seed = zlib.crc32(repr((system, messages)).encode())
+        rng = random.Random(seed)
+        words = [FAKE_WORDS[(seed + i) % len(FAKE_WORDS)] for i in range(self.profile["reply_tokens"])]
+        # A sentence every ten words, so streamed replies split like real ones.
+        tokens = [
+            word + ("." if i % 10 == 9 or i == len(words) - 1 else "") + " "
+            for i, word in enumerate(words)
+        ]
+        scale = 1.0 + rng.uniform(-1.0, 1.0) * self.profile["jitter"]
+        rate = self.profile["tokens_per_second"]
+        return tokens, self.profile["first_token"] * scale, (scale / rate if rate else 0.0)
+
+    def duration(self, messages, system=None):
+        """
+        :return: Simulated seconds until the whole reply is generated.
+        """
+        tokens, first_token, per_token = self.plan(messages, system)
+        return first_token + per_token * len(tokens)
+
+    def complete(self, messages, system=None):
+        tokens, _, _ = self.plan(messages, system)
+        time.sleep(self.duration(messages, system))
+        return "".join(tokens).strip()
+
+    def stream(self, messages, system=None):
+        tokens, first_token, per_token = self.plan(messages, system)
+        time.sleep(first_token)
+        for token in tokens:
+            if per_token:
+                time.sleep(per_token)
+            yield token
+
+    async def acomplete(self, messages, system=None):
+        tokens, _, _ = self.plan(messages, system)
+        await asyncio.sleep(self.duration(messages, system))
+        return "".join(tokens).strip()
+
+    async def astream(self, messages, system=None):
+        tokens, first_token, per_token = self.plan(messages, system)
+        await asyncio.sleep(first_token)
+
+        async def texts():
+            for token in tokens:
+                if per_token:
+                    await asyncio.sleep(per_token)
+                yield token
+
+        return texts()
+
+
+LLM_BACKENDS = {
+    backend.name: backend for backend in (GeminiBackend, OllamaBackend, FakeBackend)
+}
+
+
+def get_backend(name=None):
+    """
+    :return: A new instance of backend ``name`` (``LLM_BACKEND`` by default).
+    """
+    name = name or getattr(settings, "LLM_BACKEND", "gemini")
+    if name not in LLM_BACKENDS:
+        raise ValueError(f"Unknown LLM backend {name!r}, expected one of {tuple(LLM_BACKENDS)}")
+    return LLM_BACKENDS[name]()
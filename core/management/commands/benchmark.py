@@ -0,0 +1,150 @@
+import json
+import platform
+import subprocess
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.test import override_settings
+
+from core.benchmarks import (
+    create_synthetic_catalog,
+    measure,
+    synthetic_queries,
+    write_synthetic_images,
+)
+from core.facets import FacetIndex
+from core.models import Products
+from core.product_json import ProductJSONCache
+from core.tfidf import ProductIndex, tfidf_search
+from core.utils import filter_extractor, image_similarity_search, recommend_filters
+
+HOT_PATHS = ("search", "filter", "recommend", "image")
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark the search, filter, recommendation and image-similarity hot "
+        "paths against seeded synthetic catalogs. The catalog is created inside "
+        "a transaction that is rolled back, so the database is left untouched."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--sizes",
+            type=int,
+            nargs="+",
+            default=[1000, 10000],
+            help="Catalog sizes to run, e.g. --sizes 1000 10000 100000 1000000",
+        )
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--queries", type=int, default=200)
+        parser.add_argument(
+            "--paths", nargs="+", choices=HOT_PATHS, default=list(HOT_PATHS)
+        )
+        parser.add_argument(
+            "--max-images",
+            type=int,
+            default=300,
+            help="Products that get synthetic images for the image benchmark.",
+        )
+        parser.add_argument(
+            "--image-queries",
+            type=int,
+            default=3,
+            help="Image searches to time; each one is expensive.",
+        )
+        parser.add_argument(
+            "--output", help="Write the JSON results to this file for diffing."
+        )
+
+    def handle(self, *args, **options):
+        report = {
+            "commit": self._git_commit(),
+            "python": platform.python_version(),
+            "seed": options["seed"],
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "results": {},
+        }
+        for size in options["sizes"]:
+            self.stdout.write(f"Benchmarking a {size}-product catalog...")
+            with tempfile.TemporaryDirectory() as workdir, override_settings(
+                SEARCH_INDEX_DIR=f"{workdir}/search_index",
+                IMAGE_FEATURE_DIR=f"{workdir}/image_features",
+                IMAGE_DERIVATIVE_DIR=f"{workdir}/image_derivatives",
+            ):
+                report["results"][str(size)] = self._run(size, workdir, options)
+
+        output = json.dumps(report, indent=2)
+        if options["output"]:
+            with open(options["output"], "w") as handle:
+                handle.write(output + "\n")
+            self.stdout.write(self.style.SUCCESS(f"Wrote {options['output']}"))
+        else:
+            self.stdout.write(output)
+
+    def _run(self, size, workdir, options):
+        seed = options["seed"]
+        queries = synthetic_queries(options["queries"], seed)
+        results = {}
+        with transaction.atomic():
+            Products.objects.all().delete()
+            started = time.perf_counter()
+            create_synthetic_catalog(size, seed)
+            results["catalog_seconds"] = round(time.perf_counter() - started, 3)
+            self._reset_indexes()
+
+            if "search" in options["paths"]:
+                index = ProductIndex()
+                started = time.perf_counter()
+                index.build()
+                results["search_index_build_seconds"] = round(
+                    time.perf_counter() - started, 3
+                )
+                maxsize = index.cache.maxsize
+                index.cache.maxsize = 0  # time retrieval, not the result cache
+                try:
+                    results["search"] = measure(tfidf_search, queries)
+                finally:
+                    index.cache.maxsize = maxsize
+
+            if "filter" in options["paths"]:
+                results["filter"] = measure(lambda q: filter_extractor(q, []), queries)
+
+            if "recommend" in options["paths"]:
+                results["recommend"] = measure(
+                    lambda _: recommend_filters(), range(max(3, len(queries) // 20))
+                )
+
+            if "image" in options["paths"]:
+                folder = f"{workdir}/images"
+                products = Products.objects.order_by("id")[: options["max_images"]]
+                paths = write_synthetic_images(products, folder, seed)
+                query_paths = paths[:: max(1, len(paths) // options["image_queries"])]
+                results["image"] = measure(
+                    lambda path: image_similarity_search(
+                        image_folder=folder, query_image_path=path
+                    ),
+                    query_paths[: options["image_queries"]],
+                )
+                results["image"]["images"] = len(paths)
+
+            transaction.set_rollback(True)
+        self._reset_indexes()
+        return results
+
+    @staticmethod
+    def _reset_indexes():
+        ProductIndex().reset()
+        FacetIndex().reset()
+        ProductJSONCache().cache.clear()
+
+    @staticmethod
+    def _git_commit():
+        try:
+            return subprocess.run(
+                ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+            ).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
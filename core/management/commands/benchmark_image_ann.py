@@ -0,0 +1,103 @@
+import json
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+from django.test import override_settings
+from scipy.spatial.distance import cdist
+
+from core.benchmarks import measure, perturbed_queries, synthetic_histograms
+from core.image_ann import ANN_KINDS, AnnIndex, faiss
+from core.image_features import FeatureStore
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare the faiss image-search indexes with the exact cdist path: "
+        "build time, index size, query latency and recall@k, over the stored "
+        "features of an image folder or a synthetic feature matrix."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--folder", help="Use the feature store of this image folder.")
+        parser.add_argument(
+            "--size", type=int, default=20000, help="Synthetic images when --folder is not given."
+        )
+        parser.add_argument("--dim", type=int, default=4096)
+        parser.add_argument("--queries", type=int, default=100)
+        parser.add_argument("--k", type=int, default=10)
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--kinds", nargs="+", choices=ANN_KINDS, default=list(ANN_KINDS))
+        parser.add_argument(
+            "--nprobe", type=int, nargs="+", default=[1, 4, 8, 32], help="IVF cells probed."
+        )
+        parser.add_argument(
+            "--ef-search", type=int, nargs="+", default=[16, 64, 256], help="HNSW candidates."
+        )
+        parser.add_argument("--output", help="Write the JSON results to this file.")
+
+    def handle(self, *args, **options):
+        if faiss is None:
+            raise CommandError("faiss is not installed")
+        if options["folder"]:
+            loaded = FeatureStore(options["folder"]).load()
+            if loaded is None:
+                raise CommandError(
+                    f"No feature store for {options['folder']}; run build_image_features first."
+                )
+            features = np.asarray(loaded[1])
+        else:
+            features = synthetic_histograms(options["size"], options["dim"], options["seed"])
+        if not len(features):
+            raise CommandError("No features to benchmark.")
+
+        queries = perturbed_queries(features, options["queries"], options["seed"])
+        k = min(options["k"], len(features))
+
+        def exact(query):
+            distances = cdist([query], features, metric="euclidean")[0]
+            return np.argsort(distances)[:k]
+
+        truth = [set(exact(query).tolist()) for query in queries]
+        report = {
+            "images": len(features),
+            "dim": int(features.shape[1]),
+            "k": k,
+            "results": {"exact": measure(exact, queries)},
+        }
+        report["results"]["exact"]["recall"] = 1.0
+
+        for kind in options["kinds"]:
+            sweep = {
+                "ivf": ("IMAGE_ANN_NPROBE", "nprobe", options["nprobe"]),
+                "hnsw": ("IMAGE_ANN_EF_SEARCH", "ef_search", options["ef_search"]),
+            }.get(kind)
+            started = time.perf_counter()
+            ann = AnnIndex.build(features, kind)
+            build_seconds = round(time.perf_counter() - started, 3)
+            index_bytes = int(faiss.serialize_index(ann.index).size)
+            for value in sweep[2] if sweep else [None]:
+                name = f"{kind}[{sweep[1]}={value}]" if sweep else kind
+                with override_settings(**({sweep[0]: value} if sweep else {})):
+                    ann.configure()
+                search = lambda query: ann.search(query[None, :], k)[1][0]
+                result = measure(search, queries)
+                found = [set(search(query).tolist()) for query in queries]
+                result["recall"] = round(
+                    float(np.mean([len(f & t) / len(t) for f, t in zip(found, truth)])), 4
+                )
+                result["build_seconds"] = build_seconds
+                result["index_bytes"] = index_bytes
+                report["results"][name] = result
+                self.stdout.write(
+                    f"{name:>22}: recall@{k}={result['recall']:.3f} "
+                    f"p50={result['p50_ms']:.3f}ms p99={result['p99_ms']:.3f}ms"
+                )
+
+        output = json.dumps(report, indent=2)
+        if options["output"]:
+            with open(options["output"], "w") as handle:
+                handle.write(output + "\n")
+            self.stdout.write(self.style.SUCCESS(f"Wrote {options['output']}"))
+        else:
+            self.stdout.write(output)
@@ -0,0 +1,96 @@
+import json
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+
+from core.benchmarks import measure, perturbed_queries, synthetic_histograms
+from core.image_descriptors import DESCRIPTOR_KINDS
+from core.image_features import FeatureStore
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare the compact image descriptors with the float32 features: "
+        "memory, encode time, query latency and top-k overlap with the "
+        "exact float32 ranking."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--folder", help="Use the feature store of this image folder.")
+        parser.add_argument(
+            "--size", type=int, default=20000, help="Synthetic images when --folder is not given."
+        )
+        parser.add_argument("--dim", type=int, default=4096)
+        parser.add_argument("--queries", type=int, default=50)
+        parser.add_argument("--k", type=int, default=10)
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument(
+            "--kinds", nargs="+", choices=list(DESCRIPTOR_KINDS), default=list(DESCRIPTOR_KINDS)
+        )
+        parser.add_argument("--pca-dims", type=int, nargs="+", default=[32, 64, 128, 256])
+        parser.add_argument(
+            "--sparse-thresholds", type=float, nargs="+", default=[1e-3, 1e-2, 3e-2]
+        )
+        parser.add_argument("--output", help="Write the JSON results to this file.")
+
+    def handle(self, *args, **options):
+        if options["folder"]:
+            loaded = FeatureStore(options["folder"]).load()
+            if loaded is None:
+                raise CommandError(
+                    f"No feature store for {options['folder']}; run build_image_features first."
+                )
+            features = np.asarray(loaded[1])
+        else:
+            features = synthetic_histograms(options["size"], options["dim"], options["seed"])
+        if not len(features):
+            raise CommandError("No features to benchmark.")
+
+        queries = perturbed_queries(features, options["queries"], options["seed"])
+        k = min(options["k"], len(features))
+        reference = DESCRIPTOR_KINDS["float32"].encode(features)
+        truth = [set(np.argsort(reference.distances(query))[:k].tolist()) for query in queries]
+
+        variants = []
+        for kind in options["kinds"]:
+            if kind == "pca":
+                variants += [(f"pca[dim={dim}]", kind, {"dim": dim}) for dim in options["pca_dims"]]
+            elif kind == "sparse":
+                variants += [
+                    (f"sparse[threshold={threshold:g}]", kind, {"threshold": threshold})
+                    for threshold in options["sparse_thresholds"]
+                ]
+            else:
+                variants.append((kind, kind, {}))
+
+        report = {"images": len(features), "dim": int(features.shape[1]), "k": k, "results": {}}
+        for name, kind, encode_options in variants:
+            started = time.perf_counter()
+            descriptors = DESCRIPTOR_KINDS[kind].encode(features, **encode_options)
+            encode_seconds = round(time.perf_counter() - started, 3)
+
+            def search(query):
+                return np.argsort(descriptors.distances(query))[:k]
+
+            result = measure(search, queries)
+            found = [set(search(query).tolist()) for query in queries]
+            result["overlap"] = round(
+                float(np.mean([len(f & t) / k for f, t in zip(found, truth)])), 4
+            )
+            result["bytes"] = int(descriptors.nbytes)
+            result["bytes_per_image"] = round(descriptors.nbytes / len(features), 1)
+            result["encode_seconds"] = encode_seconds
+            report["results"][name] = result
+            self.stdout.write(
+                f"{name:>24}: {result['bytes_per_image']:>8.0f} B/image "
+                f"overlap@{k}={result['overlap']:.3f} p50={result['p50_ms']:.2f}ms"
+            )
+
+        output = json.dumps(report, indent=2)
+        if options["output"]:
+            with open(options["output"], "w") as handle:
+                handle.write(output + "\n")
+            self.stdout.write(self.style.SUCCESS(f"Wrote {options['output']}"))
+        else:
+            self.stdout.write(output)
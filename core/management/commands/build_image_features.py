@@ -0,0 +1,78 @@
+import os
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from core.image_ann import ANN_KINDS, build_ann_index
+from core.image_features import FeatureStore
+
+
+class Command(BaseCommand):
+    help = (
+        "Extract colour-histogram features for every product image into the "
+        "persistent feature store used by visual search. Only new or changed "
+        "images are processed unless --full is given."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--folder",
+            default=settings.PRODUCT_IMAGE_DIR,
+            help="Image folder to index (defaults to PRODUCT_IMAGE_DIR).",
+        )
+        parser.add_argument(
+            "--full", action="store_true", help="Re-extract every image."
+        )
+        parser.add_argument(
+            "--ann",
+            choices=ANN_KINDS,
+            nargs="+",
+            default=[],
+            help="Also build these faiss indexes over the stored features.",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=os.cpu_count() or 1,
+            help="Extraction processes (defaults to the number of CPUs).",
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=256,
+            help="Images per work unit; each finished chunk is checkpointed.",
+        )
+
+    def handle(self, *args, **options):
+        store = FeatureStore(options["folder"])
+        started = time.perf_counter()
+
+        def progress(done, total):
+            elapsed = time.perf_counter() - started
+            self.stdout.write(
+                f"Extracted {done}/{total} images ({done / elapsed:.1f} images/s)"
+            )
+
+        stats = store.build(
+            full=options["full"],
+            workers=options["workers"],
+            chunk_size=options["chunk_size"],
+            progress=progress,
+        )
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Indexed {stats['total']} images from {options['folder']} into "
+                f"{store.directory} ({stats['extracted']} extracted, "
+                f"{stats['resumed']} resumed, {stats['reused']} unchanged, "
+                f"{stats['failed']} unreadable) in {time.perf_counter() - started:.2f}s"
+            )
+        )
+        for kind in options["ann"] if stats["total"] else []:
+            started = time.perf_counter()
+            build_ann_index(store, kind)
+            self.stdout.write(
+                self.style.SUCCESS(
+                    f"Built the {kind} index in {time.perf_counter() - started:.2f}s"
+                )
+            )
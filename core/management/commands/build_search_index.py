@@ -0,0 +1,58 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from core.models import Products
+from core.search_index import fit_index, index_dir, load_index, save_index, update_index
+
+
+class Command(BaseCommand):
+    help = (
+        "Write the TF-IDF product index to SEARCH_INDEX_DIR so web workers can "
+        "memory-map it instead of fitting it on boot."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--incremental",
+            action="store_true",
+            help="Reuse the vocabulary and unchanged rows of the current index; "
+            "falls back to a full refit when too much of the catalog changed.",
+        )
+        parser.add_argument(
+            "--output",
+            default=None,
+            help="Index directory (defaults to SEARCH_INDEX_DIR).",
+        )
+
+    def handle(self, *args, **options):
+        directory = options["output"] or index_dir()
+        started = time.perf_counter()
+        rows = list(Products.objects.order_by("id").values_list("id", "description"))
+        if not rows:
+            self.stdout.write(self.style.WARNING("No products found, nothing to index."))
+            return
+
+        index = None
+        if options["incremental"]:
+            previous = load_index(directory)
+            if previous is None:
+                self.stdout.write("No existing index found, doing a full build.")
+            else:
+                ratio = getattr(settings, "SEARCH_INDEX_REFIT_RATIO", 0.1)
+                index = update_index(rows, previous, ratio)
+                if index is None:
+                    self.stdout.write("Too many products changed, doing a full build.")
+        mode = "incremental" if index is not None else "full"
+        index = index or fit_index(rows)
+
+        generation = save_index(*index, directory=directory)
+        vectorizer, postings = index[0], index[1]
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"Wrote {mode} index of {postings.shape[0]} products and "
+                f"{len(vectorizer.vocabulary_)} terms to {generation} "
+                f"in {time.perf_counter() - started:.2f}s"
+            )
+        )
@@ -0,0 +1,214 @@
+import asyncio
+import json
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.test import AsyncClient, Client
+from django.urls import reverse
+
+from core.ai_model import GeminiClient
+from core.llm_backends import FAKE_PROFILES, FakeBackend
+from core.models import Products
+
+# Endpoint -> (url name, query parameters for one query).
+ENDPOINTS = {
+    "home": ("home_page_conversationalist", lambda query: {}),
+    "product_list": ("product_list_page_conversationalist", lambda query: {"search": query}),
+    "filter": ("filter_conversationalist", lambda query: {"filterMsg": query}),
+    "product_details": ("product_details_page_conversationalist", lambda query: {"search": query}),
+    "product_description": (
+        "product_description_conversationalist",
+        lambda query: {"search": query},
+    ),
+}
+
+
+class Command(BaseCommand):
+    help = (
+        "Drive the assistant endpoints with concurrent requests against the fake "
+        "LLM backend and report latency percentiles. The fake's own simulated "
+        "generation time is known, so what remains is our overhead."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--endpoints", nargs="+", choices=tuple(ENDPOINTS), default=list(ENDPOINTS)
+        )
+        parser.add_argument("--profile", choices=tuple(FAKE_PROFILES), default="instant")
+        parser.add_argument(
+            "--mode",
+            choices=("sync", "async"),
+            default="sync",
+            help="Sync views from a thread pool, or the async views on one event loop.",
+        )
+        parser.add_argument("--stream", action="store_true", help="Request SSE replies.")
+        parser.add_argument("--requests", type=int, default=500)
+        parser.add_argument("--concurrency", type=int, default=16)
+        parser.add_argument(
+            "--sessions",
+            type=int,
+            default=50,
+            help="Distinct chat sessions the requests are spread over.",
+        )
+        parser.add_argument(
+            "--seed",
+            type=int,
+            default=0,
+            help="Seed of the product sample the queries are drawn from, so runs compare.",
+        )
+        parser.add_argument("--output", help="Write the JSON results to this file.")
+
+    def handle(self, *args, **options):
+        ai = GeminiClient()
+        fake = FakeBackend(options["profile"])
+        # Product names, so the description endpoint always finds its product;
+        # a seeded sample, so that every run sends the same queries.
+        names = list(Products.objects.order_by("id").values_list("name", flat=True))
+        queries = random.Random(options["seed"]).sample(names, min(options["requests"], len(names)))
+        if not queries:
+            raise CommandError("No products to build queries from.")
+        ai.backend = fake
+        report = {
+            "profile": options["profile"],
+            "mode": options["mode"],
+            "stream": options["stream"],
+            "concurrency": options["concurrency"],
+            "seed": options["seed"],
+            "results": {},
+        }
+        try:
+            for endpoint in options["endpoints"]:
+                plan = self._plan(endpoint, queries, options)
+                if options["mode"] == "sync":
+                    samples, elapsed = self._run_sync(plan, options)
+                else:
+                    samples, elapsed = asyncio.run(self._run_async(plan, options))
+                report["results"][endpoint] = self._summarise(samples, elapsed, fake, options)
+                # Largest history any session would send with its next turn.
+                report["results"][endpoint]["max_history_tokens"] = ai.sessions.stats()[
+                    "max_history_tokens"
+                ]
+                self._print(endpoint, report["results"][endpoint])
+                for i in range(options["sessions"]):
+                    ai.sessions.discard(f"client:load-{i}")
+        finally:
+            ai.backend = None  # back to LLM_BACKEND
+
+        if options["output"]:
+            with open(options["output"], "w") as handle:
+                handle.write(json.dumps(report, indent=2) + "\n")
+            self.stdout.write(self.style.SUCCESS(f"Wrote {options['output']}"))
+
+    def _plan(self, endpoint, queries, options):
+        name, params = ENDPOINTS[endpoint]
+        if options["mode"] == "async":
+            name += "_async"
+        url = reverse(name)
+        plan = []
+        for i in range(options["requests"]):
+            data = {**params(queries[i % len(queries)]), "session": f"load-{i % options['sessions']}"}
+            if options["stream"]:
+                data["stream"] = "1"
+            plan.append((url, data))
+        return plan
+
+    def _run_sync(self, plan, options):
+        local = threading.local()
+
+        def run(request):
+            url, data = request
+            if not hasattr(local, "client"):
+                local.client = Client(raise_request_exception=False)
+            try:
+                started = time.perf_counter()
+                response = local.client.get(url, data)
+                first = None
+                if response.streaming:
+                    for event in response.streaming_content:
+                        if first is None and b'"text"' in event:
+                            first = time.perf_counter() - started
+                else:
+                    response.content
+                return time.perf_counter() - started, first, response.status_code
+            finally:
+                connections.close_all()
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options["concurrency"]) as pool:
+            samples = list(pool.map(run, plan))
+        return samples, time.perf_counter() - started
+
+    async def _run_async(self, plan, options):
+        client = AsyncClient(raise_request_exception=False)
+        slots = asyncio.Semaphore(options["concurrency"])
+
+        async def run(request):
+            url, data = request
+            async with slots:
+                started = time.perf_counter()
+                response = await client.get(url, data)
+                first = None
+                if response.streaming:
+                    async for event in response.streaming_content:
+                        if first is None and b'"text"' in event:
+                            first = time.perf_counter() - started
+                return time.perf_counter() - started, first, response.status_code
+
+        started = time.perf_counter()
+        samples = await asyncio.gather(*(run(request) for request in plan))
+        return samples, time.perf_counter() - started
+
+    def _summarise(self, samples, elapsed, fake, options):
+        latencies = np.array([latency for latency, _, _ in samples])
+        errors = sum(status != 200 for _, _, status in samples)
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) * 1000
+        result = {
+            "requests": len(samples),
+            "errors": int(errors),
+            "seconds": round(elapsed, 3),
+            "throughput_per_s": round(len(samples) / elapsed, 1),
+            "p50_ms": round(p50, 2),
+            "p95_ms": round(p95, 2),
+            "p99_ms": round(p99, 2),
+        }
+        if fake.profile["jitter"] == 0:
+            # Every fake reply takes the same simulated time, so subtracting
+            # it leaves our own overhead (including queueing).
+            model_seconds = fake.duration([])
+            overhead = np.percentile(latencies - model_seconds, [50, 95, 99]) * 1000
+            result["model_ms"] = round(model_seconds * 1000, 2)
+            result.update(
+                {
+                    f"overhead_{name}_ms": round(value, 2)
+                    for name, value in zip(("p50", "p95", "p99"), overhead)
+                }
+            )
+        firsts = [first for _, first, _ in samples if first is not None]
+        if options["stream"] and firsts:
+            # Time to the first sentence, the latency a listener hears.
+            result["first_sentence_p50_ms"] = round(float(np.percentile(firsts, 50)) * 1000, 2)
+            result["first_sentence_p95_ms"] = round(float(np.percentile(firsts, 95)) * 1000, 2)
+        return result
+
+    def _print(self, endpoint, result):
+        line = (
+            f"{endpoint}: {result['requests']} requests in {result['seconds']:.2f}s "
+            f"({result['throughput_per_s']:.0f} req/s), latency p50={result['p50_ms']:.2f}ms "
+            f"p95={result['p95_ms']:.2f}ms p99={result['p99_ms']:.2f}ms"
+        )
+        if "overhead_p50_ms" in result:
+            line += (
+                f", overhead p50={result['overhead_p50_ms']:.2f}ms "
+                f"p95={result['overhead_p95_ms']:.2f}ms p99={result['overhead_p99_ms']:.2f}ms"
+            )
+        if "first_sentence_p50_ms" in result:
+            line += f", first sentence p50={result['first_sentence_p50_ms']:.2f}ms"
+        line += f", history <= {result['max_history_tokens']} tokens"
+        self.stdout.write(line)
+        if result["errors"]:
+            raise CommandError(f"{endpoint}: {result['errors']} requests failed")
@@ -0,0 +1,109 @@
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from core.models import Products
+from core.tfidf import ProductIndex, tfidf_search
+
+
+class Command(BaseCommand):
+    help = (
+        "Run many searches from concurrent threads and check that every "
+        "request gets exactly the results a serial run produced."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--threads", type=int, default=16)
+        parser.add_argument("--requests", type=int, default=2000)
+        parser.add_argument("--queries", type=int, default=200)
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument(
+            "--no-cache",
+            action="store_true",
+            help="Disable the search result cache so every request hits the index.",
+        )
+        parser.add_argument(
+            "--with-writes",
+            action="store_true",
+            help="Re-save unchanged products through the index while searching, "
+            "so snapshots are swapped under the readers.",
+        )
+
+    def handle(self, *args, **options):
+        rng = random.Random(options["seed"])
+        descriptions = [
+            d for d in Products.objects.values_list("description", flat=True) if d
+        ]
+        if not descriptions:
+            raise CommandError("No product descriptions to build queries from.")
+        queries = []
+        for _ in range(options["queries"]):
+            words = rng.choice(descriptions).split()
+            start = rng.randrange(len(words))
+            queries.append(" ".join(words[start:start + rng.randint(1, 4)]))
+        # Queries that match nothing must come back empty, not with someone
+        # else's results.
+        queries += [f"zzqx{i}" for i in range(max(1, options["queries"] // 10))]
+
+        index = ProductIndex()
+        if options["no_cache"]:
+            index.cache.maxsize = 0
+        expected = {query: self._ids(query) for query in queries}
+
+        stop = threading.Event()
+        writer = None
+        if options["with_writes"]:
+            products = list(Products.objects.all())
+
+            def write():
+                while not stop.is_set():
+                    index.update_product(rng.choice(products))
+                    time.sleep(0.001)
+
+            writer = threading.Thread(target=write, daemon=True)
+            writer.start()
+
+        plan = [rng.choice(queries) for _ in range(options["requests"])]
+        mismatches = []
+        latencies = []
+
+        def run(query):
+            try:
+                started = time.perf_counter()
+                ids = self._ids(query)
+                latencies.append(time.perf_counter() - started)
+                if ids != expected[query]:
+                    mismatches.append((query, expected[query], ids))
+            finally:
+                connections.close_all()
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options["threads"]) as pool:
+            list(pool.map(run, plan))
+        elapsed = time.perf_counter() - started
+        stop.set()
+        if writer is not None:
+            writer.join()
+
+        p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) * 1000
+        self.stdout.write(
+            f"{len(plan)} searches on {options['threads']} threads in {elapsed:.2f}s "
+            f"({len(plan) / elapsed:.0f} req/s), latency p50={p50:.2f}ms "
+            f"p95={p95:.2f}ms p99={p99:.2f}ms, cache {index.cache.stats()}"
+        )
+        if mismatches:
+            query, want, got = mismatches[0]
+            raise CommandError(
+                f"{len(mismatches)} searches returned another request's results, "
+                f"e.g. {query!r}: expected {want}, got {got}"
+            )
+        self.stdout.write(self.style.SUCCESS("Every search returned its own results."))
+
+    @staticmethod
+    def _ids(query):
+        return [product["id"] for product in tfidf_search(query)["results"]]
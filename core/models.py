@@ -1,4 +1,5 @@
 from django.db import models
+from django.db.models import Count, Max
 
 
 class Products(models.Model):
@@ -104,11 +105,22 @@ class Products(models.Model):
     image1_url = models.URLField(max_length=500, blank=True, null=True)
     image2_url = models.URLField(max_length=500, blank=True, null=True)
     image3_url = models.URLField(max_length=500, blank=True, null=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
 
     def __str__(self):
         return self.name
 
 
+def catalog_stamp():
+    """
+    Summary of the catalog that changes whenever a product is added, deleted
+    or saved, by any process.
+    :return: ``(count, highest id, latest updated_at)``.
+    """
+    stamp = Products.objects.aggregate(Count("id"), Max("id"), Max("updated_at"))
+    return tuple(stamp.values())
+
+
 class Cart(models.Model):
     product = models.ForeignKey(Products, on_delete=models.CASCADE)
 
@@ -0,0 +1,135 @@
+import json
+import threading
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import HttpResponse
+
+from .cache import LRUCache
+from .image_features import catalog_thumbnails
+from .models import Products
+from .serializers import ProductSerializer
+
+
+class RawJSON(bytes):
+    """
+    Already-encoded JSON that ``json_response`` splices in verbatim.
+    """
+
+
+def encode_json(value):
+    if isinstance(value, RawJSON):
+        return value
+    if isinstance(value, dict):
+        return (
+            b"{"
+            + b",".join(
+                json.dumps(str(key)).encode() + b":" + encode_json(item)
+                for key, item in value.items()
+            )
+            + b"}"
+        )
+    if isinstance(value, (list, tuple)):
+        return b"[" + b",".join(encode_json(item) for item in value) + b"]"
+    return json.dumps(value, cls=DjangoJSONEncoder).encode()
+
+
+def json_array(fragments):
+    return RawJSON(b"[" + b",".join(fragments) + b"]")
+
+
+def json_response(data, status=200):
+    """
+    Like ``JsonResponse``, but ``RawJSON`` values anywhere in ``data`` are
+    copied into the body as-is instead of being re-encoded.
+    """
+    return HttpResponse(encode_json(data), content_type="application/json", status=status)
+
+
+class ProductJSONCache:
+    """
+    Per-product cache of pre-rendered ``ProductSerializer`` JSON.
+
+    Responses are assembled by joining cached fragments, so a product is
+    serialized once per change instead of once per response. Entries are
+    dropped by the ``Products`` save/delete signals of this process; other
+    worker processes pick a change up once their entry outlives
+    ``PRODUCT_JSON_CACHE_TTL`` seconds. Products rendered with and without
+    their thumbnail links are cached separately.
+    """
+
+    _instance = None
+    _lock = threading.Lock()
+    _initialized = False
+
+    def __new__(cls):
+        if cls._instance is None:
+            with cls._lock:
+                if cls._instance is None:
+                    cls._instance = super(ProductJSONCache, cls).__new__(cls)
+        return cls._instance
+
+    def __init__(self):
+        if self._initialized:
+            return
+        self.cache = LRUCache(
+            maxsize=getattr(settings, "PRODUCT_JSON_CACHE_SIZE", 50000),
+            ttl=getattr(settings, "PRODUCT_JSON_CACHE_TTL", 60),
+        )
+        self.thumbnails_stamp = None
+        # Bumped on every invalidation, so a fragment rendered from a row
+        # read before it is not cached after it.
+        self.generation = 0
+        self._initialized = True
+
+    @staticmethod
+    def render(products, thumbnails=False):
+        """
+        :param thumbnails: Include each product's thumbnail links.
+        :return: ``{product_id: RawJSON}`` for the given product instances.
+        """
+        data = ProductSerializer(products, many=True, context={"thumbnails": thumbnails}).data
+        return {
+            item["id"]: RawJSON(json.dumps(item, cls=DjangoJSONEncoder).encode())
+            for item in data
+        }
+
+    def fragments(self, product_ids, thumbnails=False):
+        """
+        :param thumbnails: Render products with their thumbnail links.
+        :return: One ``RawJSON`` fragment per id, in the given order. Ids of
+            products that no longer exist are skipped; missing entries are
+            loaded with a single query.
+        """
+        product_ids = [int(pk) for pk in product_ids]
+        if thumbnails:
+            stamp, _ = catalog_thumbnails()
+            if stamp != self.thumbnails_stamp:
+                # Rendered fragments embed thumbnail links; rebuilt images
+                # may have new ones.
+                self.generation += 1
+                self.cache.clear()
+                self.thumbnails_stamp = stamp
+        found = {}
+        for pk in product_ids:
+            fragment = self.cache.get((pk, thumbnails))
+            if fragment is not None:
+                found[pk] = fragment
+        missing = [pk for pk in set(product_ids) if pk not in found]
+        if missing:
+            generation = self.generation
+            rendered = self.render(list(Products.objects.filter(id__in=missing)), thumbnails)
+            if self.generation == generation:
+                for pk, fragment in rendered.items():
+                    self.cache.set((pk, thumbnails), fragment)
+            found.update(rendered)
+        return [found[pk] for pk in product_ids if pk in found]
+
+    def fragment(self, product_id, thumbnails=False):
+        fragments = self.fragments([product_id], thumbnails)
+        return fragments[0] if fragments else None
+
+    def invalidate(self, product_id):
+        self.generation += 1
+        for thumbnails in (False, True):
+            self.cache.pop((product_id, thumbnails))
@@ -0,0 +1,189 @@
+"""
+On-disk format for the TF-IDF product index.
+
+A build is written as a directory of raw ``.npy`` arrays plus a JSON
+vocabulary, so every worker process can ``mmap`` the same files read-only
+instead of refitting from the database on boot::
+
+    search_index/
+        CURRENT                 name of the live generation
+        <generation>/
+            meta.json           format version, matrix shape, build time
+            vocabulary.json     term -> column
+            idf.npy             float64[V]
+            data.npy            CSC product matrix (N x V)
+            indices.npy
+            indptr.npy
+            product_ids.npy     int64[N], ascending; row i is product_ids[i]
+            digests.npy         uint64[N] description digests for incremental rebuilds
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import time
+from pathlib import Path
+
+import numpy as np
+import scipy.sparse as sp
+from django.conf import settings
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+FORMAT_VERSION = 1
+ARRAYS = ("idf", "data", "indices", "indptr", "product_ids", "digests")
+
+
+def index_dir():
+    return Path(getattr(settings, "SEARCH_INDEX_DIR", settings.BASE_DIR / "search_index"))
+
+
+def description_digest(description):
+    digest = hashlib.blake2b((description or "").encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "little")
+
+
+def fit_index(rows):
+    """
+    Fit a fresh index.
+    :param rows: ``(product_id, description)`` pairs sorted by id.
+    :return: ``(vectorizer, postings, product_ids, digests)``.
+    """
+    vectorizer = TfidfVectorizer()
+    postings = vectorizer.fit_transform(
+        [description or "" for _, description in rows]
+    ).tocsc()
+    product_ids = np.array([pk for pk, _ in rows], dtype=np.int64)
+    digests = np.array(
+        [description_digest(description) for _, description in rows], dtype=np.uint64
+    )
+    return vectorizer, postings, product_ids, digests
+
+
+def vectorizer_from_arrays(vocabulary, idf):
+    vectorizer = TfidfVectorizer(vocabulary=vocabulary)
+    vectorizer.idf_ = idf
+    return vectorizer
+
+
+def save_index(vectorizer, postings, product_ids, digests, directory=None):
+    """
+    Write a new generation and atomically point ``CURRENT`` at it.
+
+    Readers that still map the previous generation keep working; older
+    generations are removed.
+    :return: Path of the written generation.
+    """
+    directory = Path(directory or index_dir())
+    directory.mkdir(parents=True, exist_ok=True)
+    generation = directory / f"gen-{time.time_ns()}"
+    generation.mkdir()
+
+    postings = postings.tocsc()
+    arrays = {
+        "idf": np.asarray(vectorizer.idf_, dtype=np.float64),
+        "data": postings.data,
+        "indices": postings.indices,
+        "indptr": postings.indptr,
+        "product_ids": np.asarray(product_ids, dtype=np.int64),
+        "digests": np.asarray(digests, dtype=np.uint64),
+    }
+    for name, array in arrays.items():
+        np.save(generation / f"{name}.npy", array)
+    vocabulary = {term: int(column) for term, column in vectorizer.vocabulary_.items()}
+    (generation / "vocabulary.json").write_text(json.dumps(vocabulary))
+    (generation / "meta.json").write_text(
+        json.dumps(
+            {
+                "format": FORMAT_VERSION,
+                "shape": list(postings.shape),
+                "built_at": time.time(),
+            }
+        )
+    )
+
+    pointer = directory / "CURRENT.tmp"
+    pointer.write_text(generation.name)
+    os.replace(pointer, directory / "CURRENT")
+
+    for stale in directory.glob("gen-*"):
+        if stale != generation:
+            shutil.rmtree(stale, ignore_errors=True)
+    return generation
+
+
+def load_index(directory=None):
+    """
+    Map the current generation read-only.
+    :return: ``(vectorizer, postings, product_ids, digests)`` or ``None`` if
+        there is no usable index on disk.
+    """
+    directory = Path(directory or index_dir())
+    try:
+        generation = directory / (directory / "CURRENT").read_text().strip()
+        meta = json.loads((generation / "meta.json").read_text())
+        if meta.get("format") != FORMAT_VERSION:
+            return None
+        vocabulary = json.loads((generation / "vocabulary.json").read_text())
+        arrays = {
+            name: np.load(generation / f"{name}.npy", mmap_mode="r") for name in ARRAYS
+        }
+    except (OSError, ValueError):
+        return None
+
+    postings = sp.csc_matrix(
+        (arrays["data"], arrays["indices"], arrays["indptr"]), shape=tuple(meta["shape"])
+    )
+    vectorizer = vectorizer_from_arrays(vocabulary, np.asarray(arrays["idf"]))
+    return vectorizer, postings, arrays["product_ids"], arrays["digests"]
+
+
+def diff_index(rows, old_ids, old_digests):
+    """
+    Compare catalog rows against an existing index.
+    :param rows: ``(product_id, description)`` pairs sorted by id.
+    :return: ``(product_ids, digests, reused, positions)`` where ``reused``
+        marks rows whose indexed vector is still current and ``positions``
+        gives their row in the old index.
+    """
+    product_ids = np.array([pk for pk, _ in rows], dtype=np.int64)
+    digests = np.array(
+        [description_digest(description) for _, description in rows], dtype=np.uint64
+    )
+    positions = np.searchsorted(old_ids, product_ids)
+    positions = np.minimum(positions, max(len(old_ids) - 1, 0))
+    reused = np.zeros(len(product_ids), dtype=bool)
+    if len(old_ids):
+        reused = (np.asarray(old_ids)[positions] == product_ids) & (
+            np.asarray(old_digests)[positions] == digests
+        )
+    return product_ids, digests, reused, positions
+
+
+def update_index(rows, previous, max_changed_ratio=1.0):
+    """
+    Rebuild an index from ``previous`` without refitting the vocabulary.
+
+    Rows whose description digest is unchanged are copied over; new and
+    edited products are vectorized with the existing vocabulary and IDF.
+    :param rows: ``(product_id, description)`` pairs sorted by id.
+    :param previous: A ``(vectorizer, postings, product_ids, digests)`` tuple.
+    :return: A new index tuple, or ``None`` if more than ``max_changed_ratio``
+        of the catalog changed and a full refit is the better option.
+    """
+    vectorizer, postings, old_ids, old_digests = previous
+    if not rows:
+        return None
+    product_ids, digests, reused, positions = diff_index(rows, old_ids, old_digests)
+    changed = np.flatnonzero(~reused)
+    if len(changed) > max_changed_ratio * len(product_ids):
+        return None
+
+    kept_rows = postings.tocsr()[positions[reused]]
+    if len(changed):
+        new_rows = vectorizer.transform([rows[i][1] or "" for i in changed])
+    else:
+        new_rows = sp.csr_matrix((0, postings.shape[1]))
+    order = np.argsort(np.concatenate([np.flatnonzero(reused), changed]))
+    matrix = sp.vstack([kept_rows, new_rows]).tocsr()[order]
+    return vectorizer, matrix.tocsc(), product_ids, digests
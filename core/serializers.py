@@ -1,8 +1,30 @@
 from rest_framework import serializers
+from .image_derivatives import thumbnail_urls
+from .image_features import catalog_thumbnails
 from .models import Products
 
 
 class ProductSerializer(serializers.ModelSerializer):
+    """
+    ``thumbnails`` (several links per image) is only included when the
+    serializer context has ``thumbnails=True``.
+    """
+
+    thumbnails = serializers.SerializerMethodField()
+
     class Meta:
         model = Products
         fields = "__all__"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if not self.context.get("thumbnails", False):
+            self.fields.pop("thumbnails")
+
+    def get_thumbnails(self, product):
+        """
+        Locally served, cacheable thumbnails of the product's images, in
+        image order; empty if the catalog images have no derivatives.
+        """
+        _, digests = catalog_thumbnails()
+        return [thumbnail_urls(digest) for digest in digests.get(product.id, [])]
@@ -0,0 +1,34 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .facets import FacetIndex
+from .image_cache import VisualQueryCache
+from .models import Products
+from .product_json import ProductJSONCache
+from .tfidf import ProductIndex
+
+
+@receiver(post_save, sender=Products)
+def index_saved_product(sender, instance, **kwargs):
+    def update():
+        ProductJSONCache().invalidate(instance.pk)
+        FacetIndex().update_product(instance)
+        ProductIndex().update_product(instance)
+        # Cached visual results may be filtered on the old attributes.
+        VisualQueryCache().cache.clear()
+
+    transaction.on_commit(update)
+
+
+@receiver(post_delete, sender=Products)
+def unindex_deleted_product(sender, instance, **kwargs):
+    product_id = instance.pk
+
+    def remove():
+        ProductJSONCache().invalidate(product_id)
+        FacetIndex().remove_product(product_id)
+        ProductIndex().remove_product(product_id)
+        VisualQueryCache().cache.clear()
+
+    transaction.on_commit(remove)
@@ -1,3 +1,1334 @@
-from django.test import TestCase
+import asyncio
+import json
+import random
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+from pathlib import Path
+from unittest import mock, skipIf
 
-# Create your tests here.
+import cv2
+import numpy as np
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.exceptions import RequestAborted
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+
+from .ai_model import (
+    PERSONA,
+    ChatSessionPool,
+    Conversation,
+    GeminiClient,
+    SentenceSplitter,
+    estimate_tokens,
+    split_sentences,
+)
+from .cache import LRUCache
+from .facets import FacetIndex
+from .image_cache import VisualQueryCache, hamming_distance, perceptual_hash
+from .image_ann import AnnIndex, faiss, nearest_products
+from .image_descriptors import DESCRIPTOR_KINDS, Descriptors, Float32Descriptors
+from .image_features import FeatureStore, extract_chunk, image_features
+from .llm_backends import FakeBackend, GeminiBackend, LLMBackend
+from .models import Cart, Products
+from .product_json import ProductJSONCache
+from .search_index import (
+    description_digest,
+    fit_index,
+    load_index,
+    save_index,
+    update_index,
+)
+from .tfidf import ProductIndex, search_product_ids
+from .uploads import RequestBodyLimit
+from .views import _sse_response
+from .visual_search import VisualSearchBusy, VisualSearchPool
+
+CATALOG = [
+    ("Trail Runner Tee", "Black", "Men", "T-Shirts", "black cotton running shirt with reflective trim"),
+    ("Linen Button Down", "White", "Men", "Shirts", "white linen shirt for warm summer evenings"),
+    ("Ribbed Sweater", "Red", "Women", "Long Sleeve Shirts", "red wool sweater with ribbed cuffs"),
+    ("Studio Bodysuit", "Black", "Women", "Bodysuits", "black stretch bodysuit for yoga and studio"),
+    ("Denim Overshirt", "Blue", "Men", "Shirts", "blue denim overshirt with cotton lining"),
+    ("Training Tank", "Green", "Women", "Tank Tops", "green training tank top for running and gym"),
+    ("Oxford Shirt", "Blue", "Men", "Shirts", "blue oxford cotton shirt with button collar"),
+    ("Merino Long Sleeve", "Grey", "Women", "Long Sleeve Shirts", "grey merino wool long sleeve base layer"),
+]
+
+QUERIES = ["reflective", "linen", "wool sweater", "denim lining", "yoga", "merino base layer"]
+
+
+class CatalogTestCase(TestCase):
+    """
+    Tests against a small catalog, with the on-disk indexes in a temporary
+    directory and the process-wide indexes and caches reset.
+    """
+
+    def setUp(self):
+        workdir = tempfile.TemporaryDirectory()
+        self.addCleanup(workdir.cleanup)
+        self.workdir = Path(workdir.name)
+        overrides = override_settings(
+            SEARCH_INDEX_DIR=self.workdir / "search_index",
+            IMAGE_FEATURE_DIR=self.workdir / "image_features",
+            IMAGE_DERIVATIVE_DIR=self.workdir / "image_derivatives",
+        )
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        self.reset_indexes()
+        self.addCleanup(self.reset_indexes)
+        self.products = [
+            Products.objects.create(
+                name=name,
+                color=color,
+                gender=gender,
+                category=category,
+                description=description,
+                price=Decimal("19.99") + i,
+            )
+            for i, (name, color, gender, category, description) in enumerate(CATALOG)
+        ]
+
+    @staticmethod
+    def reset_indexes():
+        ProductIndex().reset()
+        FacetIndex().reset()
+        ProductJSONCache().cache.clear()
+        VisualQueryCache().cache.clear()
+
+    @staticmethod
+    def rows():
+        return list(Products.objects.order_by("id").values_list("id", "description"))
+
+
+class SearchIndexTests(CatalogTestCase):
+    def test_update_index_matches_revectorizing_with_the_stored_vocabulary(self):
+        directory = self.workdir / "search_index"
+        save_index(*fit_index(self.rows()), directory=directory)
+        previous = load_index(directory)
+
+        edited = self.products[2]
+        edited.description = "red wool sweater with reflective cuffs"
+        edited.save()
+        self.products[5].delete()
+        Products.objects.create(
+            name="Linen Tank", color="White", gender="Women", category="Tank Tops",
+            description="white linen tank for summer", price=Decimal("15.00"),
+        )
+        rows = self.rows()
+
+        vectorizer, postings, product_ids, digests = update_index(rows, previous)
+        self.assertEqual(product_ids.tolist(), [pk for pk, _ in rows])
+        self.assertEqual(
+            digests.tolist(), [description_digest(description) for _, description in rows]
+        )
+        expected = previous[0].transform([description for _, description in rows])
+        np.testing.assert_allclose(postings.toarray(), expected.toarray())
+
+    def test_update_index_asks_for_a_refit_when_too_much_changed(self):
+        previous = fit_index(self.rows())
+        rows = [(pk, f"{description} edited") for pk, description in self.rows()]
+        self.assertIsNone(update_index(rows, previous, max_changed_ratio=0.5))
+
+    @override_settings(SEARCH_INDEX_REFIT_RATIO=0.5)
+    def test_incremental_updates_rank_like_a_fresh_fit(self):
+        # Delta rows are weighted with the IDF of the last fit, so products
+        # with near-equal scores may swap places against a refit; which
+        # products match must not differ.
+        save_index(*fit_index(self.rows()))
+        ProductIndex().snapshot()  # attach the memory-mapped index
+
+        with self.captureOnCommitCallbacks(execute=True):
+            edited = self.products[1]
+            edited.description = "white linen shirt with a mandarin collar"
+            edited.save()
+            self.products[3].delete()
+            Products.objects.create(
+                name="Wool Beanie Tee", color="Grey", gender="Men", category="T-Shirts",
+                description="grey wool blend tee", price=Decimal("25.00"),
+            )
+        snapshot = ProductIndex().snapshot()
+        self.assertEqual(len(snapshot.delta), 2)
+        self.assertFalse(snapshot.stale)
+        ranked = QUERIES + ["mandarin collar", "wool"]
+        near_ties = ["linen shirt", "cotton shirt"]
+        incremental = {query: search_product_ids(query) for query in ranked + near_ties}
+
+        shutil.rmtree(self.workdir / "search_index")
+        ProductIndex().reset()
+        fresh = {query: search_product_ids(query) for query in ranked + near_ties}
+        for query in ranked:
+            self.assertEqual(incremental[query], fresh[query], query)
+        for query in near_ties:
+            self.assertCountEqual(incremental[query], fresh[query], query)
+        self.assertEqual(fresh["mandarin collar"][0], self.products[1].pk)
+        self.assertNotIn(self.products[3].pk, fresh["yoga"])
+
+    def test_readers_keep_their_generation_across_a_swap(self):
+        directory = self.workdir / "search_index"
+        save_index(*fit_index(self.rows()), directory=directory)
+        vectorizer, postings, product_ids, _ = load_index(directory)
+        before = (postings @ vectorizer.transform(["wool"]).T).toarray()
+
+        rows = [(pk, "completely different words") for pk, _ in self.rows()[:3]]
+        save_index(*fit_index(rows), directory=directory)
+
+        # The old generation is gone from disk but still mapped.
+        np.testing.assert_array_equal(
+            (postings @ vectorizer.transform(["wool"]).T).toarray(), before
+        )
+        self.assertEqual(load_index(directory)[2].tolist(), [pk for pk, _ in rows])
+
+    def test_current_never_points_at_a_partial_generation(self):
+        directory = self.workdir / "search_index"
+        catalogs = [self.rows(), self.rows()[:4], [(1, "alpha beta"), (2, "gamma")]]
+        save_index(*fit_index(catalogs[0]), directory=directory)
+        stop = threading.Event()
+
+        def write():
+            for i in range(30):
+                save_index(*fit_index(catalogs[i % len(catalogs)]), directory=directory)
+            stop.set()
+
+        writer = threading.Thread(target=write)
+        writer.start()
+        loaded = 0
+        while not stop.is_set():
+            index = load_index(directory)
+            if index is None:
+                # The generation was replaced between reading CURRENT and
+                # mapping it; callers fall back to fitting.
+                continue
+            vectorizer, postings, product_ids, digests = index
+            self.assertEqual(postings.shape, (len(product_ids), len(vectorizer.vocabulary_)))
+            self.assertEqual(len(vectorizer.idf_), len(vectorizer.vocabulary_))
+            self.assertEqual(len(digests), len(product_ids))
+            loaded += 1
+        writer.join()
+        self.assertGreater(loaded, 0)
+        self.assertIsNotNone(load_index(directory))
+
+    @override_settings(SEARCH_INDEX_REFIT_RATIO=0.5)
+    def test_stored_index_is_not_reattached_on_every_search(self):
+        save_index(*fit_index(self.rows()), directory=self.workdir / "search_index")
+        # 5 new products: within half of the 13 now in the catalog, but more
+        # than half of the 8 in the stored index.
+        for i in range(5):
+            Products.objects.create(
+                name=f"Added {i}", color="Grey", gender="Men", category="Shirts",
+                description=f"grey shirt number {i}", price=Decimal("10.00"),
+            )
+        index = ProductIndex()
+        with mock.patch("core.tfidf.load_index", wraps=load_index) as loads:
+            versions = set()
+            for _ in range(5):
+                search_product_ids("grey shirt")
+                versions.add(index.snapshot().version)
+        self.assertEqual(len(versions), 1)
+        self.assertLessEqual(loads.call_count, 1)
+        self.assertFalse(index.snapshot().stale)
+
+
+class BatchSearchViewTests(CatalogTestCase):
+    def post(self, body):
+        return self.client.post(
+            reverse("batch_search"), json.dumps(body), content_type="application/json"
+        )
+
+    def test_object_and_bare_list_bodies_give_the_same_results(self):
+        queries = ["linen", "wool sweater", "zzqx"]
+        as_object = self.post({"queries": queries})
+        as_list = self.post(queries)
+        self.assertEqual(as_object.status_code, 200)
+        self.assertEqual(as_list.status_code, 200)
+        self.assertEqual(as_object.json(), as_list.json())
+        results = as_object.json()["results"]
+        self.assertEqual([entry["query"] for entry in results], queries)
+        self.assertEqual(results[0]["results"][0]["id"], self.products[1].pk)
+        self.assertEqual(results[2]["results"], [])
+
+    def test_results_match_single_searches(self):
+        results = self.post({"queries": QUERIES, "k": 3}).json()["results"]
+        for query, entry in zip(QUERIES, results):
+            self.assertEqual(
+                [product["id"] for product in entry["results"]],
+                search_product_ids(query, k=3),
+            )
+
+    def test_rejects_bodies_that_are_not_an_object_or_list(self):
+        for body in ("linen", 5, None):
+            response = self.post(body)
+            self.assertEqual(response.status_code, 400, body)
+            self.assertIn("error", response.json())
+
+    def test_rejects_non_string_queries(self):
+        self.assertEqual(self.post([1, 2]).status_code, 400)
+
+
+class FacetIndexTests(CatalogTestCase):
+    def ids(self, **filters):
+        return FacetIndex().candidates(filters).tolist()
+
+    def test_values_of_a_field_are_ored_and_fields_are_anded(self):
+        by_name = {product.name: product.pk for product in self.products}
+        self.assertEqual(
+            self.ids(color=["Blue", "white"]),
+            sorted(
+                by_name[name] for name in ("Linen Button Down", "Denim Overshirt", "Oxford Shirt")
+            ),
+        )
+        self.assertEqual(
+            self.ids(color="Black", gender="Women"), [by_name["Studio Bodysuit"]]
+        )
+        self.assertEqual(self.ids(color="Black", category="Shirts"), [])
+
+    def test_candidates_match_the_database(self):
+        for filters in ({"gender": "Men"}, {"category": ["Shirts", "T-Shirts"], "gender": "Men"}):
+            query = Products.objects.all()
+            for field, values in filters.items():
+                values = [values] if isinstance(values, str) else values
+                query = query.filter(**{f"{field}__in": values})
+            self.assertEqual(
+                self.ids(**filters), sorted(query.values_list("id", flat=True))
+            )
+
+    def test_counts_ignore_the_filter_on_their_own_field(self):
+        counts = FacetIndex().counts({"gender": "Women"})
+        self.assertEqual(counts["gender"], {"Men": 4, "Women": 4})
+        self.assertEqual(counts["color"]["Black"], 1)
+        self.assertEqual(counts["color"]["Blue"], 0)
+
+    def test_saved_and_deleted_products_update_the_index(self):
+        FacetIndex().ensure_built()
+        with self.captureOnCommitCallbacks(execute=True):
+            product = self.products[0]
+            product.color = "Red"
+            product.save()
+            self.products[2].delete()
+        self.assertEqual(self.ids(color="Red"), [product.pk])
+        self.assertNotIn(self.products[0].pk, self.ids(color="Black"))
+
+
+class FilterValidationTests(CatalogTestCase):
+    def post(self, filters):
+        return self.client.post(
+            reverse("batch_search"),
+            json.dumps({"queries": ["shirt"], "filters": filters}),
+            content_type="application/json",
+        )
+
+    def test_filtered_batch_search(self):
+        results = self.post({"color": ["Blue"], "gender": "Men"}).json()["results"][0]["results"]
+        self.assertTrue(results)
+        self.assertTrue(all(product["color"] == "Blue" for product in results))
+
+    def test_invalid_filters_are_rejected_before_searching(self):
+        invalid = [
+            {"color": 5},
+            {"color": ["Blue", None]},
+            {"color": {"Blue": True}},
+            {"brand": "Acme"},
+            ["color", "Blue"],
+            "Blue",
+        ]
+        with mock.patch.object(FacetIndex, "candidates") as candidates:
+            for filters in invalid:
+                response = self.post(filters)
+                self.assertEqual(response.status_code, 400, filters)
+                self.assertIn("error", response.json())
+        candidates.assert_not_called()
+
+
+class ConcurrentSearchTests(CatalogTestCase):
+    @override_settings(SEARCH_INDEX_REFIT_RATIO=1000)
+    def test_searches_never_see_a_half_applied_snapshot(self):
+        index = ProductIndex()
+        # Threads other than the test's cannot see its uncommitted catalog,
+        # so they must not read the catalog stamp.
+        stamp = mock.patch.object(index.freshness, "stamp", return_value=None)
+        stamp.start()
+        self.addCleanup(stamp.stop)
+        index.snapshot()
+        catalogs = [
+            self.rows(),
+            [(pk, f"{description} extra vocabulary words") for pk, description in self.rows()],
+            self.rows()[:3],
+        ]
+        products = list(Products.objects.all())
+        stop = threading.Event()
+        errors = []
+
+        def write():
+            try:
+                for i in range(200):
+                    if i % 25 == 0:
+                        # A refit: new vocabulary, matrix and product ids.
+                        vectorizer, postings, product_ids, _ = fit_index(
+                            catalogs[(i // 25) % len(catalogs)]
+                        )
+                        index._publish(index._make_snapshot(vectorizer, postings, product_ids))
+                    else:
+                        product = products[i % len(products)]
+                        product.description = f"{product.description.split()[0]} variant {i}"
+                        index.update_product(product)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                stop.set()
+
+        def read():
+            try:
+                while not stop.is_set():
+                    snapshot = index.snapshot()
+                    vocabulary = len(snapshot.vectorizer.vocabulary_)
+                    assert snapshot.postings.shape == (len(snapshot.product_ids), vocabulary)
+                    if snapshot.delta:
+                        assert snapshot.delta_matrix.shape == (len(snapshot.delta_ids), vocabulary)
+                    known = set(snapshot.product_ids.tolist()) | set(snapshot.delta)
+                    for query in QUERIES:
+                        hits = index.search(query, snapshot=snapshot)
+                        assert {pk for pk, _ in hits} <= known
+                    index.search_many(QUERIES)
+            except Exception as e:
+                errors.append(e)
+
+        readers = [threading.Thread(target=read) for _ in range(4)]
+        writer = threading.Thread(target=write)
+        for thread in readers + [writer]:
+            thread.start()
+        for thread in readers + [writer]:
+            thread.join()
+        self.assertEqual(errors, [])
+
+
+class ProductJSONCacheTests(CatalogTestCase):
+    def fragment(self, product):
+        return json.loads(ProductJSONCache().fragment(product.pk))
+
+    def test_fragments_follow_the_requested_order_and_skip_missing_ids(self):
+        cache = ProductJSONCache()
+        ids = [self.products[3].pk, 999999, self.products[0].pk]
+        fragments = [json.loads(fragment) for fragment in cache.fragments(ids)]
+        self.assertEqual([item["id"] for item in fragments], [ids[0], ids[2]])
+        self.assertEqual(fragments[0]["name"], "Studio Bodysuit")
+
+    def test_saving_a_product_invalidates_its_fragment(self):
+        product = self.products[0]
+        self.assertEqual(self.fragment(product)["name"], "Trail Runner Tee")
+        with self.captureOnCommitCallbacks(execute=True):
+            product.name = "Trail Runner Tee II"
+            product.save()
+        self.assertEqual(self.fragment(product)["name"], "Trail Runner Tee II")
+
+    def test_deleting_a_product_drops_it_from_responses(self):
+        product = self.products[0]
+        pk = product.pk
+        self.fragment(product)
+        with self.captureOnCommitCallbacks(execute=True):
+            product.delete()
+        self.assertEqual(ProductJSONCache().fragments([pk]), [])
+
+    def test_fragment_rendered_before_an_invalidation_is_not_cached(self):
+        cache = ProductJSONCache()
+        product = self.products[0]
+        render = ProductJSONCache.render
+
+        def render_then_save(products, thumbnails=False):
+            rendered = render(products, thumbnails)
+            # The product changes while the old row is being serialized.
+            Products.objects.filter(pk=product.pk).update(name="Renamed")
+            cache.invalidate(product.pk)
+            return rendered
+
+        with mock.patch.object(ProductJSONCache, "render", side_effect=render_then_save):
+            self.assertEqual(self.fragment(product)["name"], "Trail Runner Tee")
+        self.assertIsNone(cache.cache.get((product.pk, False)))
+        self.assertEqual(self.fragment(product)["name"], "Renamed")
+
+    def test_entries_expire_after_the_ttl(self):
+        cache = ProductJSONCache()
+        product = self.products[0]
+        self.fragment(product)
+        # A change made by another process: no signal reaches this one.
+        Products.objects.filter(pk=product.pk).update(name="Renamed elsewhere")
+        self.assertEqual(self.fragment(product)["name"], "Trail Runner Tee")
+        later = time.monotonic() + cache.cache.ttl + 1
+        with mock.patch("core.cache.time.monotonic", return_value=later):
+            self.assertEqual(self.fragment(product)["name"], "Renamed elsewhere")
+
+
+@override_settings(PRODUCT_EXPORT_CHUNK_SIZE=3)
+class ProductExportTests(CatalogTestCase):
+    url = reverse("get_all_products")
+
+    def ids(self):
+        return [product.pk for product in self.products]
+
+    def test_json_array_export(self):
+        response = self.client.get(self.url)
+        self.assertTrue(response.streaming)
+        items = json.loads(b"".join(response.streaming_content))
+        self.assertEqual([item["id"] for item in items], self.ids())
+
+    def test_ndjson_export(self):
+        response = self.client.get(self.url, {"format": "ndjson"})
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+        lines = b"".join(response.streaming_content).splitlines()
+        self.assertEqual([json.loads(line)["id"] for line in lines], self.ids())
+
+    def test_keyset_pages_cover_the_catalog_once(self):
+        seen, cursor = [], 0
+        while cursor is not None:
+            page = self.client.get(self.url, {"cursor": cursor, "limit": 3}).json()
+            seen += [item["id"] for item in page["results"]]
+            cursor = page["next_cursor"]
+        self.assertEqual(seen, self.ids())
+
+    def test_invalid_cursor_is_rejected(self):
+        self.assertEqual(self.client.get(self.url, {"cursor": "x"}).status_code, 400)
+
+    async def test_asgi_export_streams_from_an_async_iterator(self):
+        for params in ({}, {"format": "ndjson"}):
+            response = await self.async_client.get(self.url, params)
+            self.assertTrue(response.is_async)
+            body = b"".join([chunk async for chunk in response.streaming_content])
+            if params:
+                items = [json.loads(line) for line in body.splitlines()]
+            else:
+                items = json.loads(body)
+            self.assertEqual([item["id"] for item in items], self.ids())
+
+
+class LRUCacheTests(SimpleTestCase):
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = LRUCache(maxsize=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual((cache.get("a"), cache.get("c")), (1, 3))
+        self.assertEqual(cache.stats()["hits"], 3)
+
+    def test_entries_expire_after_the_ttl(self):
+        cache = LRUCache(ttl=10)
+        with mock.patch("core.cache.time.monotonic", return_value=100.0):
+            cache.set("a", 1)
+        with mock.patch("core.cache.time.monotonic", return_value=109.0):
+            self.assertEqual(cache.get("a"), 1)
+        with mock.patch("core.cache.time.monotonic", return_value=111.0):
+            self.assertIsNone(cache.get("a"))
+        self.assertEqual(len(cache), 0)
+
+    def test_get_nearest_falls_back_to_the_closest_key(self):
+        cache = LRUCache()
+        cache.set(10, "ten")
+        cache.set(20, "twenty")
+        distance = lambda a, b: abs(a - b)
+        self.assertEqual(cache.get_nearest(12, distance, 3), "ten")
+        self.assertIsNone(cache.get_nearest(15, distance, 3))
+
+
+class SearchViewTests(CatalogTestCase):
+    def search(self, query, **params):
+        response = self.client.get(reverse("group_search"), {"q": query, **params})
+        self.assertEqual(response.status_code, 200)
+        return [item["id"] for item in response.json()["results"]]
+
+    def test_best_match_comes_first(self):
+        self.assertEqual(self.search("reflective")[0], self.products[0].pk)
+        self.assertEqual(self.search("merino base layer")[0], self.products[7].pk)
+
+    def test_filters_restrict_the_results(self):
+        women = {p.pk for p in self.products if p.gender == "Women"}
+        results = self.search("running", gender="Women")
+        self.assertTrue(results)
+        self.assertLessEqual(set(results), women)
+
+    def test_repeated_queries_are_answered_from_the_cache(self):
+        cache = ProductIndex().cache
+        first = self.search("Wool  Sweater")
+        hits = cache.hits
+        self.assertEqual(self.search("wool sweater"), first)
+        self.assertEqual(cache.hits, hits + 1)
+
+    def test_saved_products_are_searchable_without_a_stale_cache_entry(self):
+        self.assertEqual(self.search("corduroy"), [])
+        with self.captureOnCommitCallbacks(execute=True):
+            self.products[4].description = "blue corduroy overshirt"
+            self.products[4].save()
+        self.assertEqual(self.search("corduroy"), [self.products[4].pk])
+
+
+class VisualSearchPoolTests(SimpleTestCase):
+    def setUp(self):
+        self.pool = VisualSearchPool()
+        executor = ThreadPoolExecutor(max_workers=1)
+        self.addCleanup(executor.shutdown)
+        for name, value in (("executor", executor), ("max_in_flight", 2), ("queue_timeout", 0.2)):
+            patcher = mock.patch.object(self.pool, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.release = threading.Event()
+        self.addCleanup(self.release.set)
+
+    async def start_blocking_search(self):
+        running = threading.Event()
+
+        def block():
+            running.set()
+            return self.release.wait(5)
+
+        task = asyncio.ensure_future(self.pool.run(block))
+        while not running.is_set():
+            await asyncio.sleep(0.001)
+        return task
+
+    async def test_full_pool_refuses_at_once(self):
+        blocking = await self.start_blocking_search()
+        queued = asyncio.ensure_future(self.pool.run(lambda: "queued"))
+        await asyncio.sleep(0)
+        with self.assertRaises(VisualSearchBusy):
+            await asyncio.wait_for(self.pool.run(lambda: "refused"), 0.05)
+        self.release.set()
+        self.assertTrue(await blocking)
+        self.assertEqual(await queued, "queued")
+        self.assertEqual(self.pool.stats()["in_flight"], 0)
+
+    async def test_queued_search_times_out_unrun(self):
+        blocking = await self.start_blocking_search()
+        ran = threading.Event()
+        with self.assertRaises(VisualSearchBusy):
+            await self.pool.run(ran.set)
+        self.assertEqual(self.pool.stats()["in_flight"], 1)
+        self.release.set()
+        await blocking
+        self.assertFalse(ran.is_set())
+        self.assertEqual(self.pool.stats()["in_flight"], 0)
+
+    async def test_cancelled_request_keeps_its_slot_until_the_search_ends(self):
+        blocking = await self.start_blocking_search()
+        blocking.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await blocking
+        # The thread is still searching, so the slot is still taken.
+        self.assertEqual(self.pool.stats()["in_flight"], 1)
+        self.release.set()
+        for _ in range(500):
+            if self.pool.stats()["in_flight"] == 0:
+                break
+            await asyncio.sleep(0.01)
+        self.assertEqual(self.pool.stats()["in_flight"], 0)
+
+
+class RequestBodyLimitTests(SimpleTestCase):
+    async def call(self, chunks, headers=()):
+        read = []
+
+        async def app(scope, receive, send):
+            while True:
+                message = await receive()
+                read.append(message.get("body", b""))
+                if not message.get("more_body"):
+                    break
+            await send({"type": "http.response.start", "status": 200, "headers": []})
+            await send({"type": "http.response.body", "body": b"ok"})
+
+        messages = [
+            {"type": "http.request", "body": chunk, "more_body": i < len(chunks) - 1}
+            for i, chunk in enumerate(chunks)
+        ]
+
+        async def receive():
+            return messages.pop(0)
+
+        sent = []
+
+        async def send(message):
+            sent.append(message)
+
+        scope = {"type": "http", "headers": list(headers)}
+        try:
+            await RequestBodyLimit(app, max_bytes=10)(scope, receive, send)
+        except RequestAborted:
+            pass  # raised past the limit, after the 413 was sent
+        return sent[0]["status"], b"".join(read)
+
+    async def test_small_body_is_passed_through(self):
+        self.assertEqual(await self.call([b"12345", b"67890"]), (200, b"1234567890"))
+
+    async def test_large_content_length_is_refused_unread(self):
+        status, read = await self.call([b"x" * 20], [(b"content-length", b"20")])
+        self.assertEqual((status, read), (413, b""))
+
+    async def test_body_without_length_is_cut_off_at_the_limit(self):
+        status, read = await self.call([b"x" * 8, b"x" * 8, b"x" * 8])
+        self.assertEqual((status, read), (413, b"x" * 8))
+
+
+class ProductPayloadTests(CatalogTestCase):
+    def test_thumbnails_are_only_sent_on_request(self):
+        url = reverse("group_search")
+        plain = self.client.get(url, {"q": "linen"}).json()["results"][0]
+        self.assertNotIn("thumbnails", plain)
+        full = self.client.get(url, {"q": "linen", "thumbnails": "1"}).json()["results"][0]
+        self.assertEqual(full["thumbnails"], [])
+        self.assertEqual({**plain, "thumbnails": []}, full)
+
+    def test_description_prompt_leaves_out_links_and_ids(self):
+        product = self.products[0]
+        product.fabric = "Cotton"
+        product.image1_url = "https://example.com/tee.jpg"
+        product.save()
+        prompt = GeminiClient().product_description_prompt("reflective")
+        self.assertIn("Trail Runner Tee", prompt)
+        self.assertIn("'fabric': 'Cotton'", prompt)
+        self.assertNotIn("example.com", prompt)
+        self.assertNotIn("'id'", prompt)
+        self.assertNotIn("thumbnails", prompt)
+
+
+class TimingOutBackend(FakeBackend):
+    async def acomplete(self, messages, system=None):
+        raise asyncio.TimeoutError()
+
+
+@override_settings(LLM_RETRIES=0)
+class FilterConversationTests(CatalogTestCase):
+    def setUp(self):
+        super().setUp()
+        ai = GeminiClient()
+        ai.backend = FakeBackend("instant")
+        self.addCleanup(setattr, ai, "backend", None)
+        self.sessions = ai.sessions
+        for name in ("a", "b"):
+            self.addCleanup(self.sessions.discard, f"client:{name}")
+
+    def filter(self, message, session, **params):
+        params = {"filterMsg": message, "session": session, **params}
+        return self.client.get(reverse("filter_conversationalist"), params)
+
+    def test_filters_are_kept_per_session(self):
+        self.assertEqual(self.filter("only black", "a").json()["filters"], ["Black"])
+        self.assertEqual(self.filter("for women", "b").json()["filters"], ["Women"])
+        self.assertEqual(
+            sorted(self.filter("and shirts", "a").json()["filters"]), ["Black", "Shirts"]
+        )
+        self.assertEqual(self.sessions.filters("client:b"), ["Women"])
+
+    def test_streamed_filters_apply_once_the_reply_is_complete(self):
+        response = self.filter("only black", "a", stream="1")
+        self.assertEqual(self.sessions.filters("client:a"), [])
+        b"".join(response.streaming_content)
+        self.assertEqual(self.sessions.filters("client:a"), ["Black"])
+
+    async def test_failed_reply_leaves_the_filters_unchanged(self):
+        url = reverse("filter_conversationalist_async")
+        await self.async_client.get(url, {"filterMsg": "only black", "session": "a"})
+        GeminiClient().backend = TimingOutBackend("instant")
+        response = await self.async_client.get(url, {"filterMsg": "for women", "session": "a"})
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(self.sessions.filters("client:a"), ["Black"])
+
+
+class CrossProcessFreshnessTests(CatalogTestCase):
+    """
+    Writes whose ``on_commit`` signals never run here stand in for writes
+    made by another worker process.
+    """
+
+    def setUp(self):
+        super().setUp()
+        for index in (ProductIndex(), FacetIndex()):
+            patcher = mock.patch.object(index.freshness, "interval", 0)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_search_index_picks_up_changes_from_other_processes(self):
+        self.assertEqual(search_product_ids("corduroy"), [])
+        product = self.products[4]
+        product.description = "blue corduroy overshirt"
+        product.save()
+        self.assertEqual(search_product_ids("corduroy"), [product.pk])
+        Products.objects.filter(pk=product.pk).delete()
+        self.assertEqual(search_product_ids("corduroy"), [])
+
+    def test_facet_index_picks_up_changes_from_other_processes(self):
+        self.assertEqual(len(FacetIndex().candidates({"color": "Blue"})), 2)
+        Products.objects.filter(color="Blue").first().delete()
+        self.assertEqual(len(FacetIndex().candidates({"color": "Blue"})), 1)
+        product = self.products[0]
+        product.color = "Blue"
+        product.save()
+        self.assertIn(product.pk, FacetIndex().candidates({"color": "Blue"}))
+
+    def test_indexes_expire_after_their_max_age(self):
+        self.assertEqual(search_product_ids("corduroy"), [])
+        FacetIndex().ensure_built()
+        # A bulk update does not touch updated_at, so the stamp misses it.
+        Products.objects.filter(pk=self.products[4].pk).update(
+            description="blue corduroy overshirt", color="Navy"
+        )
+        self.assertEqual(search_product_ids("corduroy"), [])
+        later = time.monotonic() + settings.CATALOG_INDEX_MAX_AGE + 1
+        with mock.patch("core.cache.time.monotonic", return_value=later):
+            self.assertEqual(search_product_ids("corduroy"), [self.products[4].pk])
+            self.assertEqual(
+                FacetIndex().candidates({"color": "Navy"}).tolist(), [self.products[4].pk]
+            )
+
+    def test_local_saves_do_not_trigger_a_rebuild(self):
+        index = ProductIndex()
+        search_product_ids("wool")
+        with self.captureOnCommitCallbacks(execute=True):
+            self.products[2].description = "red wool sweater with toggles"
+            self.products[2].save()
+        version = index.snapshot().version
+        search_product_ids("wool")
+        self.assertEqual(index.snapshot().version, version)
+
+
+class AddToCartTests(CatalogTestCase):
+    url = reverse("add_to_cart")
+
+    def test_best_match_is_added(self):
+        response = self.client.get(self.url, {"q": "merino base layer"})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()["product"]["id"], self.products[7].pk)
+        self.assertEqual(
+            list(Cart.objects.values_list("product_id", flat=True)), [self.products[7].pk]
+        )
+
+    def test_product_deleted_by_another_process_gives_404(self):
+        self.assertEqual(search_product_ids("merino base layer")[0], self.products[7].pk)
+        # Without its on_commit signal the index still lists the product.
+        Products.objects.filter(pk=self.products[7].pk).delete()
+        response = self.client.get(self.url, {"q": "merino base layer"})
+        self.assertEqual(response.status_code, 404)
+        self.assertFalse(Cart.objects.exists())
+
+
+class VisualQueryCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.cache = VisualQueryCache()
+        self.cache.cache.clear()
+        self.addCleanup(self.cache.cache.clear)
+        self.image = cv2.imread(str(Path(settings.PRODUCT_IMAGE_DIR) / "product_12_image1.jpg"))
+
+    def lookup(self, image):
+        return self.cache.get("catalog", 1, (), perceptual_hash(image), image_features(image))
+
+    def test_reencoded_query_reuses_the_cached_results(self):
+        results = [(12, 0.0), (32, 0.88), (13, 1.0)]
+        self.cache.set(
+            "catalog", 1, (), perceptual_hash(self.image), image_features(self.image), results
+        )
+        _, encoded = cv2.imencode(".jpg", self.image, [cv2.IMWRITE_JPEG_QUALITY, 95])
+        self.assertEqual(self.lookup(cv2.imdecode(encoded, cv2.IMREAD_COLOR)), results)
+
+    def test_recoloured_query_with_a_near_hash_misses(self):
+        swapped = np.ascontiguousarray(self.image[:, :, ::-1])
+        # The greyscale hash barely changes...
+        hashes = [(None, perceptual_hash(image)) for image in (self.image, swapped)]
+        distance = hamming_distance(*hashes)
+        self.assertLessEqual(distance, self.cache.max_distance)
+        # ...but the colour histogram the results were ranked by does.
+        features = image_features(self.image)
+        self.cache.set("catalog", 1, (), perceptual_hash(self.image), features, [])
+        self.assertIsNone(self.lookup(swapped))
+
+
+class LLMBackendTests(SimpleTestCase):
+    @override_settings(GEMINI_API_KEY=None)
+    def test_gemini_backend_needs_an_api_key(self):
+        with mock.patch.dict("os.environ", {}, clear=True):
+            with self.assertRaisesMessage(ValueError, "Gemini API key not found"):
+                GeminiBackend()
+
+    @override_settings(LLM_BACKEND="gemini", GEMINI_API_KEY=None)
+    def test_assistant_backend_is_created_on_first_use(self):
+        ai = GeminiClient()
+        ai.backend = None
+        self.addCleanup(setattr, ai, "backend", None)
+        with mock.patch.dict("os.environ", {}, clear=True), self.assertLogs("core.ai_model"):
+            with self.assertRaises(ValueError):
+                ai.backend
+        ai.backend = FakeBackend("instant")
+        self.addCleanup(ai.sessions.discard, "client:backend-test")
+        self.assertTrue(ai.send("hello", "client:backend-test"))
+
+    def test_incomplete_backend_cannot_be_created(self):
+        class CompleteOnly(LLMBackend):
+            name = "complete-only"
+
+            def complete(self, messages, system=None):
+                return "Hello."
+
+        with self.assertRaises(TypeError):
+            CompleteOnly()
+
+    def test_whole_replies_are_joined_from_the_stream(self):
+        class Echo(LLMBackend):
+            name = "echo"
+
+            def stream(self, messages, system=None):
+                yield from ("You said: ", messages[-1]["content"])
+
+            async def astream(self, messages, system=None):
+                async def texts():
+                    for chunk in self.stream(messages, system):
+                        yield chunk
+
+                return texts()
+
+        messages = [{"role": "user", "content": "hi"}]
+        self.assertEqual(Echo().complete(messages), "You said: hi")
+        self.assertEqual(asyncio.run(Echo().acomplete(messages)), "You said: hi")
+
+
+class ProductDescriptionViewTests(CatalogTestCase):
+    def setUp(self):
+        super().setUp()
+        ai = GeminiClient()
+        ai.backend = FakeBackend("instant")
+        self.addCleanup(setattr, ai, "backend", None)
+        self.addCleanup(ai.sessions.discard, "client:describe")
+
+    def describe(self, query, name="product_description_conversationalist", **params):
+        params = {"search": query, "session": "describe", **params}
+        return self.client.get(reverse(name), params)
+
+    def test_matching_product_is_described(self):
+        response = self.describe("merino base layer")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.json()["message"])
+
+    def test_query_without_a_match_gives_404(self):
+        for params in ({}, {"stream": "1"}):
+            response = self.describe("zzzz", **params)
+            self.assertEqual(response.status_code, 404)
+            self.assertEqual(response.json()["message"], "No matching product found")
+
+    async def test_async_view_gives_404_without_a_match(self):
+        # The prompt is built in a thread of its own, which cannot see the
+        # test's uncommitted catalog; build the index here first.
+        await sync_to_async(search_product_ids)("wool")
+        response = await self.async_client.get(
+            reverse("product_description_conversationalist_async"),
+            {"search": "zzzz", "session": "describe"},
+        )
+        self.assertEqual(response.status_code, 404)
+
+
+class RecordingBackend(FakeBackend):
+    """
+    Fake backend that keeps every call it gets.
+    :param failures: Number of async calls that raise ``error`` before one
+        succeeds.
+    :param delay: Seconds each async call takes.
+    """
+
+    def __init__(self, failures=0, error=asyncio.TimeoutError, delay=0.0):
+        super().__init__("instant")
+        self.calls = []
+        self.failures = failures
+        self.error = error
+        self.delay = delay
+        self.active = self.max_active = 0
+
+    def complete(self, messages, system=None):
+        self.calls.append((list(messages), system))
+        return super().complete(messages, system)
+
+    async def acomplete(self, messages, system=None):
+        self.calls.append((list(messages), system))
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        try:
+            await asyncio.sleep(self.delay)
+            if self.failures:
+                self.failures -= 1
+                raise self.error()
+            return await super().acomplete(messages, system)
+        finally:
+            self.active -= 1
+
+
+class ConversationTests(SimpleTestCase):
+    def turn(self, i):
+        return f"Show me item number {i} in every colour you have. " + "detail " * 20
+
+    def test_history_stays_within_the_token_budget(self):
+        conversation = Conversation(token_budget=200, summary_budget=40)
+        for i in range(30):
+            conversation.record(self.turn(i), f"Here is item {i}. " + "words " * 20)
+            self.assertLessEqual(
+                sum(estimate_tokens(m["content"]) for m in conversation.messages), 200
+            )
+            self.assertLessEqual(sum(map(estimate_tokens, conversation.summary)), 40)
+        self.assertGreater(conversation.compacted_turns, 0)
+        # The latest turns are kept verbatim, the oldest summarised away.
+        self.assertEqual(conversation.messages[-2]["content"], self.turn(29))
+        self.assertTrue(conversation.messages[-1]["content"].startswith("Here is item 29."))
+        self.assertNotIn("item number 0 ", " ".join(conversation.summary))
+
+    def test_oversized_latest_turn_is_kept_whole(self):
+        conversation = Conversation(token_budget=20)
+        conversation.record("hello", "hi")
+        conversation.record("long " * 100, "reply")
+        self.assertEqual([m["content"] for m in conversation.messages], ["long " * 100, "reply"])
+        self.assertEqual(len(conversation.summary), 1)
+
+    def test_summary_rides_on_the_oldest_message(self):
+        conversation = Conversation(token_budget=60)
+        for i in range(4):
+            conversation.record(self.turn(i), f"Item {i} comes in red. It is lovely.")
+        messages = conversation.with_prompt("And in blue?")
+        self.assertTrue(messages[0]["content"].startswith("Earlier in this conversation:\n- User:"))
+        self.assertIn("NOVA: Item 0 comes in red.", messages[0]["content"])
+        self.assertEqual([m["role"] for m in messages][-3:], ["user", "assistant", "user"])
+        self.assertEqual(messages[-1]["content"], "And in blue?")
+
+    @override_settings(CHAT_HISTORY_TOKEN_BUDGET=150, CHAT_SUMMARY_TOKEN_BUDGET=40)
+    def test_requests_are_sent_compacted_with_the_persona(self):
+        ai = GeminiClient()
+        backend = RecordingBackend()
+        ai.backend = backend
+        self.addCleanup(setattr, ai, "backend", None)
+        self.addCleanup(ai.sessions.discard, "client:compaction")
+        for i in range(12):
+            ai.send(self.turn(i), "client:compaction")
+        for messages, system in backend.calls:
+            self.assertEqual(system, PERSONA)
+            history = messages[:-1]
+            # Only the summary header may push the history past the budget.
+            self.assertLessEqual(
+                sum(estimate_tokens(m["content"]) for m in history), 150 + 40 + 10
+            )
+        messages, _ = backend.calls[-1]
+        self.assertEqual(messages[-1]["content"], self.turn(11))
+        self.assertTrue(messages[-3]["content"].endswith(self.turn(10)))
+        self.assertTrue(messages[0]["content"].startswith("Earlier in this conversation:"))
+        self.assertNotIn(PERSONA, " ".join(m["content"] for m in messages))
+
+
+@override_settings(LLM_RETRIES=2, LLM_RETRY_BACKOFF=0.001, LLM_TIMEOUT=1.0)
+class AsyncSendTests(SimpleTestCase):
+    def setUp(self):
+        self.ai = GeminiClient()
+        self.addCleanup(setattr, self.ai, "backend", None)
+
+    def send(self, backend, *prompts):
+        self.ai.backend = backend
+        keys = [f"client:async-{i}" for i in range(len(prompts))]
+        for key in keys:
+            self.addCleanup(self.ai.sessions.discard, key)
+
+        async def run():
+            return await asyncio.gather(*(
+                self.ai.asend(prompt, key) for prompt, key in zip(prompts, keys)
+            ))
+
+        return asyncio.run(run())
+
+    def test_transient_failures_are_retried_with_jittered_backoff(self):
+        backend = RecordingBackend(failures=2)
+        with mock.patch("core.ai_model.random.uniform", wraps=random.uniform) as uniform, \
+                self.assertLogs("core.ai_model", "WARNING") as logs:
+            [reply] = self.send(backend, "hello")
+        self.assertEqual(len(logs.records), 2)
+        self.assertEqual(reply, FakeBackend("instant").complete(*backend.calls[-1]))
+        self.assertEqual(len(backend.calls), 3)
+        self.assertEqual(uniform.call_args_list, [mock.call(0, 0.001), mock.call(0, 0.002)])
+        # Every attempt sends the same request; nothing is recorded twice.
+        self.assertEqual(len({repr(call) for call in backend.calls}), 1)
+        with self.ai.sessions.session("client:async-0") as conversation:
+            self.assertEqual(len(conversation.messages), 2)
+
+    def test_error_is_raised_once_the_retries_are_used_up(self):
+        backend = RecordingBackend(failures=5)
+        with self.assertRaises(asyncio.TimeoutError), self.assertLogs("core.ai_model", "WARNING"):
+            self.send(backend, "hello")
+        self.assertEqual(len(backend.calls), 3)
+
+    def test_other_errors_are_not_retried(self):
+        backend = RecordingBackend(failures=1, error=ValueError)
+        with self.assertRaises(ValueError):
+            self.send(backend, "hello")
+        self.assertEqual(len(backend.calls), 1)
+
+    @override_settings(LLM_TIMEOUT=0.02, LLM_RETRIES=1)
+    def test_slow_calls_time_out(self):
+        backend = RecordingBackend(delay=1.0)
+        started = time.monotonic()
+        with self.assertRaises(asyncio.TimeoutError), self.assertLogs("core.ai_model", "WARNING"):
+            self.send(backend, "hello")
+        self.assertEqual(len(backend.calls), 2)
+        self.assertLess(time.monotonic() - started, 0.5)
+
+    @override_settings(LLM_MAX_CONCURRENCY=3)
+    def test_concurrent_calls_are_bounded(self):
+        backend = RecordingBackend(delay=0.02)
+        replies = self.send(backend, *(f"question {i}" for i in range(10)))
+        self.assertEqual(len(replies), 10)
+        self.assertEqual(len(backend.calls), 10)
+        self.assertEqual(backend.max_active, 3)
+
+
+class ChatSessionPoolTests(SimpleTestCase):
+    def conversation(self, pool, key):
+        with pool.session(key) as conversation:
+            return conversation
+
+    def test_least_recently_used_session_is_evicted(self):
+        pool = ChatSessionPool(Conversation, max_sessions=2)
+        a = self.conversation(pool, "a")
+        b = self.conversation(pool, "b")
+        self.assertIs(self.conversation(pool, "a"), a)
+        self.conversation(pool, "c")
+        self.assertEqual(len(pool), 2)
+        self.assertEqual(pool.evictions, 1)
+        # "b" was the least recently used; "a" survived because it was reused.
+        self.assertIs(self.conversation(pool, "a"), a)
+        self.assertEqual(pool.evictions, 1)
+        self.assertIsNot(self.conversation(pool, "b"), b)
+        self.assertEqual(pool.evictions, 2)
+
+    def test_idle_sessions_expire_after_the_ttl(self):
+        pool = ChatSessionPool(Conversation, ttl=10)
+        with mock.patch("core.ai_model.time.monotonic", return_value=100.0):
+            a = self.conversation(pool, "a")
+            self.conversation(pool, "b")
+        with mock.patch("core.ai_model.time.monotonic", return_value=109.0):
+            self.assertIs(self.conversation(pool, "a"), a)
+        with mock.patch("core.ai_model.time.monotonic", return_value=115.0):
+            # "b" has been idle for 15s and is dropped; "a" was used 6s ago.
+            self.assertIs(self.conversation(pool, "a"), a)
+            self.assertEqual(len(pool), 1)
+        with mock.patch("core.ai_model.time.monotonic", return_value=130.0):
+            self.assertIsNot(self.conversation(pool, "a"), a)
+        self.assertEqual(pool.evictions, 2)
+
+
+class Interrupted(Exception):
+    pass
+
+
+class FeatureStoreBuildTests(SimpleTestCase):
+    def setUp(self):
+        self.tmp = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.tmp)
+        self.folder = self.tmp / "images"
+        self.folder.mkdir()
+        for path in Path(settings.PRODUCT_IMAGE_DIR).glob("product_1[01]_image*.jpg"):
+            shutil.copy(path, self.folder / path.name)
+        overrides = override_settings(IMAGE_DERIVATIVE_DIR=self.tmp / "derivatives")
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+
+    def test_interrupted_build_resumes_from_its_checkpoints(self):
+        store = FeatureStore(self.folder, self.tmp / "store")
+
+        def interrupt(done, total):
+            raise Interrupted()
+
+        with self.assertRaises(Interrupted):
+            store.build(chunk_size=2, progress=interrupt)
+        self.assertIsNone(store.load())
+        self.assertEqual(len(list(store.checkpoint_dir.glob("chunk-*.npz"))), 1)
+
+        with mock.patch("core.image_features.extract_chunk", wraps=extract_chunk) as extract:
+            stats = store.build(chunk_size=2)
+        self.assertEqual(
+            stats, {"total": 6, "reused": 0, "resumed": 2, "extracted": 4, "failed": 0}
+        )
+        extracted = [path for call in extract.call_args_list for path in call.args[0]]
+        self.assertEqual(extracted, [str(p) for p in sorted(self.folder.glob("*.jpg"))[2:]])
+        self.assertFalse(store.checkpoint_dir.exists())
+
+        full = FeatureStore(self.folder, self.tmp / "full")
+        full.build(chunk_size=2)
+        (manifest, features), (full_manifest, full_features) = store.load(), full.load()
+        self.assertEqual(manifest["images"], full_manifest["images"])
+        np.testing.assert_array_equal(features, full_features)
+
+
+# Distances from the origin, the query: product 1 has the nearest image and
+# the farthest one, product 2 two middling ones. The last image belongs to no
+# product and is never returned.
+IMAGE_ROWS = [(1, 1.0), (1, 5.0), (2, 2.0), (2, 3.0), (3, 4.0), (None, 0.5)]
+
+
+class NearestProductsTests(SimpleTestCase):
+    def setUp(self):
+        self.features = np.array([[d, 0.0] for _, d in IMAGE_ROWS], dtype=np.float32)
+        # A fresh version so product_table does not reuse another test's rows.
+        self.manifest = {
+            "image_folder": "fixed",
+            "version": time.time_ns(),
+            "images": [{"product_id": product_id} for product_id, _ in IMAGE_ROWS],
+        }
+        patcher = mock.patch(
+            "core.image_ann.load_descriptors",
+            return_value=(self.manifest, Float32Descriptors(data=self.features)),
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.query = np.zeros(2, dtype=np.float32)
+
+    def nearest(self, k=3, **options):
+        return nearest_products("fixed", self.query, k, backend="exact", **options)
+
+    def test_min_scores_a_product_by_its_closest_image(self):
+        self.assertEqual(self.nearest(aggregate="min"), [(1, 1.0), (2, 2.0), (3, 4.0)])
+        self.assertEqual(self.nearest(k=1, aggregate="min"), [(1, 1.0)])
+
+    def test_mean_scores_a_product_by_all_its_images(self):
+        self.assertEqual(self.nearest(aggregate="mean"), [(2, 2.5), (1, 3.0), (3, 4.0)])
+
+    def test_unknown_aggregate_is_rejected(self):
+        with self.assertRaises(ValueError):
+            self.nearest(aggregate="max")
+
+    def test_prefilter_excludes_the_nearest_image(self):
+        with mock.patch.object(FacetIndex, "candidates", return_value=[2, 3]) as candidates:
+            self.assertEqual(
+                self.nearest(aggregate="min", filters={"color": "Red"}), [(2, 2.0), (3, 4.0)]
+            )
+            self.assertEqual(self.nearest(aggregate="mean", filters={"color": "Red"})[0], (2, 2.5))
+        candidates.assert_called_with({"color": "Red"})
+        with mock.patch.object(FacetIndex, "candidates", return_value=[]):
+            self.assertEqual(self.nearest(filters={"color": "Teal"}), [])
+
+    @skipIf(faiss is None, "faiss is not installed")
+    @override_settings(IMAGE_SEARCH_PREFILTER_EXACT_ROWS=0)
+    def test_ann_prefilter_only_nominates_matching_products(self):
+        ann = AnnIndex.build(self.features, "flat")
+        with mock.patch(
+            "core.image_ann.load_ann_index", return_value=(self.manifest, self.features, ann)
+        ), mock.patch.object(FacetIndex, "candidates", return_value=[2, 3]):
+            results = nearest_products(
+                "fixed", self.query, 2, backend="flat", filters={"color": "Red"}
+            )
+        self.assertEqual([product_id for product_id, _ in results], [2, 3])
+        self.assertAlmostEqual(results[0][1], 2.0, places=5)
+
+
+class SentenceSplitterTests(SimpleTestCase):
+    def test_sentences_are_emitted_as_soon_as_they_end(self):
+        splitter = SentenceSplitter()
+        self.assertEqual(splitter.feed("Hello there"), [])
+        self.assertEqual(splitter.feed("! This shirt is"), ["Hello there!"])
+        # The end of a sentence is only known once the next one starts.
+        self.assertEqual(splitter.feed(" lovely."), [])
+        self.assertEqual(splitter.feed(' "Really?" Yes'), ["This shirt is lovely.", '"Really?"'])
+        self.assertEqual(splitter.flush(), ["Yes"])
+        self.assertEqual(splitter.flush(), [])
+
+    def test_abbreviations_do_not_end_a_sentence(self):
+        text = (
+            "Ask Dr. Jones, e.g. the U.S. team lead. Mr. Smith agrees. "
+            "Try it in size M. It fits."
+        )
+        expected = [
+            "Ask Dr. Jones, e.g. the U.S. team lead.",
+            "Mr. Smith agrees.",
+            "Try it in size M.",
+            "It fits.",
+        ]
+        self.assertEqual(list(split_sentences([text])), expected)
+        # Streamed a few characters at a time, the split is the same.
+        self.assertEqual(
+            list(split_sentences(text[i : i + 3] for i in range(0, len(text), 3))), expected
+        )
+
+    def test_decimals_split_across_chunks_stay_whole(self):
+        self.assertEqual(
+            list(split_sentences(["It is $19.", "99 today. It was 2", "4.50."])),
+            ["It is $19.99 today.", "It was 24.50."],
+        )
+
+    def test_unterminated_rest_is_flushed(self):
+        self.assertEqual(
+            list(split_sentences(["One. Two", " without an end"])), ["One.", "Two without an end"]
+        )
+        self.assertEqual(list(split_sentences(["   "])), [])
+
+
+class SSEResponseTests(SimpleTestCase):
+    def events(self, response):
+        if response.is_async:
+            async def read():
+                return [chunk async for chunk in response.streaming_content]
+
+            chunks = asyncio.run(read())
+        else:
+            chunks = list(response.streaming_content)
+        return b"".join(chunks).decode()
+
+    def test_sentences_are_framed_as_events(self):
+        response = _sse_response(iter(["Hi.", 'Say "hello".']), meta={"filters": ["Red"]})
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        self.assertEqual(response["Cache-Control"], "no-cache")
+        self.assertEqual(
+            self.events(response),
+            'event: meta\ndata: {"filters": ["Red"]}\n\n'
+            'data: {"text": "Hi."}\n\n'
+            'data: {"text": "Say \\"hello\\"."}\n\n'
+            "event: done\ndata: {}\n\n",
+        )
+
+    def test_failure_ends_the_stream_with_an_error_event(self):
+        def sentences():
+            yield "Hi."
+            raise ValueError("model unavailable")
+
+        self.assertEqual(
+            self.events(_sse_response(sentences())),
+            'data: {"text": "Hi."}\n\n'
+            'event: error\ndata: {"error": "model unavailable"}\n\n',
+        )
+
+    def test_async_sentences_are_streamed_asynchronously(self):
+        async def sentences():
+            yield "Hi."
+            raise asyncio.TimeoutError()
+
+        response = _sse_response(sentences())
+        self.assertTrue(response.is_async)
+        self.assertEqual(
+            self.events(response),
+            'data: {"text": "Hi."}\n\n'
+            'event: error\ndata: {"error": "TimeoutError"}\n\n',
+        )
+
+
+class DescriptorsTests(SimpleTestCase):
+    def test_encodings_rank_like_the_stored_features(self):
+        rng = np.random.default_rng(0)
+        features = rng.random((20, 8), dtype=np.float32)
+        features /= np.linalg.norm(features, axis=1, keepdims=True)
+        query = features[3] + 0.01
+        exact = Float32Descriptors.encode(features).distances(query)
+        for kind, cls in DESCRIPTOR_KINDS.items():
+            with self.subTest(kind):
+                descriptors = cls.encode(features, dim=8, threshold=0.0)
+                self.assertEqual(len(descriptors), 20)
+                self.assertEqual(int(np.argmin(descriptors.distances(query))), 3)
+                np.testing.assert_allclose(
+                    descriptors.distances(query, [3, 5]), exact[[3, 5]], atol=0.02
+                )
+
+    def test_incomplete_encoding_cannot_be_created(self):
+        class Unfinished(Descriptors):
+            kind = "unfinished"
+
+            def __len__(self):
+                return 0
+
+        with self.assertRaises(TypeError):
+            Unfinished(data=np.zeros((0, 8), dtype=np.float32))
@@ -1,42 +1,392 @@
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
-from .models import Products
-from django.http import JsonResponse
+import itertools
 import json
+import threading
+from collections import namedtuple
 
-from .serializers import ProductSerializer
+import numpy as np
+import scipy.sparse as sp
+from django.conf import settings
+from .cache import LRUCache, StampCheck
+from .facets import FacetIndex, filters_key
+from .models import Products, catalog_stamp
+from .product_json import ProductJSONCache
+from .search_index import diff_index, fit_index, load_index
 
-global returnable_list
 
-def tfidf_search(query):
-    global returnable_list
+IndexSnapshot = namedtuple(
+    "IndexSnapshot",
+    [
+        "version",
+        "vectorizer",
+        "postings",  # CSC product matrix: one posting list per term
+        "product_ids",  # ascending; row i of ``postings`` is product_ids[i]
+        "removed",  # ids whose row in ``postings`` is stale
+        "delta",  # product id -> 1 x V row vectorized after the fit
+        "delta_ids",
+        "delta_matrix",
+        "stale",  # too much changed since the fit, rebuild before use
+    ],
+)
+
+
+class ProductIndex:
+    """
+    Long-lived TF-IDF index over product descriptions.
+
+    The vectorizer and the product matrix are fitted once and reused, so a
+    search only has to transform the query. If ``build_search_index`` has
+    written an index to ``SEARCH_INDEX_DIR`` it is memory-mapped instead of
+    fitted, and only products that changed since are re-vectorized with the
+    stored vocabulary. Products saved after the fit are
+    kept in a small delta segment vectorized with the fitted vocabulary; once
+    the delta grows past ``SEARCH_INDEX_REFIT_RATIO`` of the catalog the whole
+    index is refitted on the next search.
+
+    All index state lives in an immutable ``IndexSnapshot``. Writers build a
+    new snapshot under a lock and swap it in with a single assignment, and a
+    search only ever reads the snapshot it started with, so concurrent
+    searches need no locking and never see a half-applied update.
+
+    Result ids are cached per normalised query in ``cache``; the cache is
+    keyed by the snapshot version, which changes whenever the catalog does.
+
+    Saves in this process update the index through signals; changes made by
+    other processes are noticed by ``freshness`` and trigger a rebuild.
+    """
+
+    _instance = None
+    _lock = threading.Lock()
+    _initialized = False
+
+    def __new__(cls):
+        if cls._instance is None:
+            with cls._lock:
+                if cls._instance is None:
+                    cls._instance = super(ProductIndex, cls).__new__(cls)
+        return cls._instance
+
+    def __init__(self):
+        if self._initialized:
+            return
+        self._build_lock = threading.RLock()
+        self._versions = itertools.count(1)
+        self._snapshot = None
+        self.cache = LRUCache(
+            maxsize=getattr(settings, "SEARCH_CACHE_SIZE", 1024),
+            ttl=getattr(settings, "SEARCH_CACHE_TTL", 300),
+        )
+        self.freshness = StampCheck(
+            catalog_stamp,
+            interval=getattr(settings, "CATALOG_CHECK_INTERVAL", 2.0),
+            max_age=getattr(settings, "CATALOG_INDEX_MAX_AGE", 300),
+        )
+        self._initialized = True
+
+    def snapshot(self):
+        """
+        :return: The current ``IndexSnapshot``, building it first if needed.
+        """
+        snapshot = self._snapshot
+        if snapshot is not None and not snapshot.stale and self.freshness.expired():
+            with self._build_lock:
+                if self._snapshot is snapshot:
+                    self._snapshot = snapshot._replace(stale=True)
+                snapshot = self._snapshot
+        if snapshot is None or snapshot.stale:
+            snapshot = self.build()
+        return snapshot
+
+    def build(self):
+        with self._build_lock:
+            current = self._snapshot
+            if current is not None and not current.stale:
+                # Another thread rebuilt the index while we waited.
+                return current
+            stamp = self.freshness.take()
+            rows = list(
+                Products.objects.order_by("id").values_list("id", "description")
+            )
+            if not rows:
+                snapshot = self._make_snapshot(None, None, np.empty(0, dtype=np.int64))
+            else:
+                stored = load_index()
+                snapshot = self._attach(stored, rows) if stored is not None else None
+                if snapshot is None:
+                    vectorizer, postings, product_ids, _ = fit_index(rows)
+                    snapshot = self._make_snapshot(vectorizer, postings, product_ids)
+            self._publish(snapshot)
+            self.freshness.mark(stamp)
+            return snapshot
+
+    def _attach(self, stored, rows):
+        """
+        Serve from a memory-mapped index written by ``build_search_index``.
+
+        Products added or edited since it was written go into the delta
+        segment, deleted or edited ones are masked out.
+        :return: A snapshot, or ``None`` if too much changed and a refit is
+            preferable.
+        """
+        vectorizer, postings, product_ids, digests = stored
+        current_ids, _, reused, _ = diff_index(rows, product_ids, digests)
+        changed = np.flatnonzero(~reused)
+        stale = np.setdiff1d(product_ids, current_ids[reused], assume_unique=True)
+        # Judged exactly as the snapshot built from it would be, or a stale
+        # snapshot would be published and re-attached on every search.
+        if self._too_stale(len(changed) + len(stale), len(product_ids)):
+            return None
+
+        delta = {}
+        if len(changed):
+            vectors = vectorizer.transform([rows[i][1] or "" for i in changed]).tocsr()
+            delta = {int(current_ids[i]): vectors[row] for row, i in enumerate(changed)}
+        return self._make_snapshot(vectorizer, postings, product_ids, stale, delta)
+
+    def _make_snapshot(self, vectorizer, postings, product_ids, removed=(), delta=None):
+        delta = delta or {}
+        delta_ids = np.fromiter(delta.keys(), dtype=np.int64, count=len(delta))
+        delta_matrix = None
+        if delta:
+            delta_matrix = sp.vstack(list(delta.values())).tocsr()
+        removed = np.unique(np.asarray(removed, dtype=np.int64))
+        return IndexSnapshot(
+            version=next(self._versions),
+            vectorizer=vectorizer,
+            postings=postings,
+            product_ids=product_ids,
+            removed=removed,
+            delta=delta,
+            delta_ids=delta_ids,
+            delta_matrix=delta_matrix,
+            stale=self._too_stale(len(delta) + len(removed), len(product_ids)),
+        )
+
+    @staticmethod
+    def _too_stale(changed, indexed):
+        """
+        Whether ``changed`` products re-vectorized or masked out since the
+        fit are more than ``SEARCH_INDEX_REFIT_RATIO`` of the ``indexed`` ones.
+        """
+        ratio = getattr(settings, "SEARCH_INDEX_REFIT_RATIO", 0.1)
+        return changed > ratio * max(indexed, 1)
+
+    def _publish(self, snapshot):
+        self._snapshot = snapshot
+        self.cache.clear()
+
+    def reset(self):
+        """
+        Drop the index; the next search rebuilds it from the catalog.
+        """
+        with self._build_lock:
+            self._snapshot = None
+            self.cache.clear()
+
+    def update_product(self, product):
+        with self._build_lock:
+            current = self._snapshot
+            if current is None or current.stale:
+                return
+            if current.vectorizer is None:
+                # The index was fitted on an empty catalog, refit from scratch.
+                self._publish(current._replace(stale=True))
+                return
+            delta = dict(current.delta)
+            delta[product.pk] = current.vectorizer.transform([product.description or ""])
+            removed = current.removed
+            if self._indexed(current, product.pk):
+                removed = np.append(removed, product.pk)
+            self._publish(
+                self._make_snapshot(
+                    current.vectorizer, current.postings, current.product_ids, removed, delta
+                )
+            )
+            self.freshness.refresh()
+
+    def remove_product(self, product_id):
+        with self._build_lock:
+            current = self._snapshot
+            if current is None or current.stale:
+                return
+            delta = {pk: row for pk, row in current.delta.items() if pk != product_id}
+            removed = current.removed
+            if self._indexed(current, product_id):
+                removed = np.append(removed, product_id)
+            self._publish(
+                self._make_snapshot(
+                    current.vectorizer, current.postings, current.product_ids, removed, delta
+                )
+            )
+            self.freshness.refresh()
+
+    @staticmethod
+    def _indexed(snapshot, product_id):
+        product_ids = snapshot.product_ids
+        row = np.searchsorted(product_ids, product_id)
+        return row < len(product_ids) and product_ids[row] == product_id
+
+    def search(self, query, k=10, candidates=None, snapshot=None):
+        """
+        Return the ``k`` best matching products for ``query``.
+
+        Only products sharing at least one term with the query are scored:
+        their postings are gathered from the column-major product matrix and
+        the winners are picked with ``argpartition`` instead of sorting
+        the whole catalog.
+        :param candidates: Optional array of product ids to restrict the
+            search to, e.g. from ``FacetIndex.candidates``. Postings outside
+            it are dropped before scoring.
+        :param snapshot: Snapshot to search, defaults to the current one.
+        :return: List of ``(product_id, score)`` tuples, best first.
+        """
+        snapshot = snapshot or self.snapshot()
+        if snapshot.vectorizer is None:
+            return []
+
+        query_vector = snapshot.vectorizer.transform([query])
+        terms, weights = query_vector.indices, query_vector.data
+        if not len(terms):
+            return []
+
+        # TfidfVectorizer rows are L2-normalised, so the dot product is the
+        # cosine similarity.
+        postings = snapshot.postings
+        starts, ends = postings.indptr[terms], postings.indptr[terms + 1]
+        rows = np.concatenate(
+            [postings.indices[s:e] for s, e in zip(starts, ends)]
+        )
+        contributions = np.concatenate(
+            [postings.data[s:e] * w for s, e, w in zip(starts, ends, weights)]
+        )
+        if candidates is not None:
+            keep = np.isin(snapshot.product_ids[rows], candidates)
+            rows, contributions = rows[keep], contributions[keep]
+        rows, inverse = np.unique(rows, return_inverse=True)
+        scores = np.bincount(inverse, weights=contributions)
+        candidate_ids = snapshot.product_ids[rows]
+        if len(snapshot.removed):
+            keep = ~np.isin(candidate_ids, snapshot.removed)
+            candidate_ids, scores = candidate_ids[keep], scores[keep]
+
+        if snapshot.delta:
+            delta_ids, delta_matrix = self._delta_segment(snapshot, candidates)
+            delta_scores = (delta_matrix @ query_vector.T).toarray().ravel()
+            candidate_ids = np.concatenate([candidate_ids, delta_ids])
+            scores = np.concatenate([scores, delta_scores])
+
+        return self._top_k(candidate_ids, scores, k)
+
+    def search_many(self, queries, k=10, candidates=None, snapshot=None):
+        """
+        Return the ``k`` best matching products for each of ``queries``.
+
+        The queries are vectorized into one sparse matrix and scored against
+        the catalog with a single sparse matrix product.
+        :param candidates: Optional array of product ids shared by all queries.
+        :param snapshot: Snapshot to search, defaults to the current one.
+        :return: One list of ``(product_id, score)`` tuples per query.
+        """
+        snapshot = snapshot or self.snapshot()
+        if snapshot.vectorizer is None or not queries:
+            return [[] for _ in queries]
+
+        query_matrix = snapshot.vectorizer.transform(queries).T.tocsc()
+        scores = (snapshot.postings @ query_matrix).tocsc()
+        if snapshot.delta:
+            delta_ids, delta_matrix = self._delta_segment(snapshot, candidates)
+            delta_scores = (delta_matrix @ query_matrix).toarray()
+
+        hits = []
+        for column in range(len(queries)):
+            start, end = scores.indptr[column], scores.indptr[column + 1]
+            candidate_ids = snapshot.product_ids[scores.indices[start:end]]
+            column_scores = scores.data[start:end]
+            if len(snapshot.removed):
+                keep = ~np.isin(candidate_ids, snapshot.removed)
+                candidate_ids, column_scores = candidate_ids[keep], column_scores[keep]
+            if candidates is not None:
+                keep = np.isin(candidate_ids, candidates)
+                candidate_ids, column_scores = candidate_ids[keep], column_scores[keep]
+            if snapshot.delta:
+                candidate_ids = np.concatenate([candidate_ids, delta_ids])
+                column_scores = np.concatenate(
+                    [column_scores, delta_scores[:, column]]
+                )
+            hits.append(self._top_k(candidate_ids, column_scores, k))
+        return hits
+
+    @staticmethod
+    def _delta_segment(snapshot, candidates=None):
+        if candidates is None:
+            return snapshot.delta_ids, snapshot.delta_matrix
+        keep = np.isin(snapshot.delta_ids, candidates)
+        return snapshot.delta_ids[keep], snapshot.delta_matrix[keep]
+
+    @staticmethod
+    def _top_k(candidate_ids, scores, k):
+        matched = scores > 0
+        candidate_ids, scores = candidate_ids[matched], scores[matched]
+        if len(scores) > k:
+            top = np.argpartition(-scores, k - 1)[:k]
+            candidate_ids, scores = candidate_ids[top], scores[top]
+        order = np.lexsort((candidate_ids, -scores))
+        return list(zip(candidate_ids[order].tolist(), scores[order].tolist()))
+
+
+def normalize_query(query):
+    return " ".join(query.lower().split())
+
+
+def search_product_ids(query, k=10, filters=None):
+    """
+    Ids of the ``k`` best matching products for ``query``, best first.
+    :param filters: Optional facet filters, see ``FacetIndex.candidates``.
+    """
     if not query:
-        return {"query": query, "results": []}
+        return []
+
+    index = ProductIndex()
+    snapshot = index.snapshot()
+    key = (snapshot.version, normalize_query(query), k, filters_key(filters))
+    product_ids = index.cache.get(key)
+    if product_ids is None:
+        candidates = FacetIndex().candidates(filters) if filters else None
+        hits = index.search(query, k, candidates, snapshot)
+        product_ids = tuple(pk for pk, _ in hits)
+        index.cache.set(key, product_ids)
+    return list(product_ids)
+
 
-    products = Products.objects.all()
-    if not products.exists():
+def batch_search_product_ids(queries, k=10, filters=None):
+    """
+    Search several queries at once.
+
+    Cached queries are answered from the search cache; the rest are scored
+    together with ``ProductIndex.search_many``.
+    :return: One list of product ids per query, in order.
+    """
+    index = ProductIndex()
+    snapshot = index.snapshot()
+    key_filters = filters_key(filters)
+    keys = [(snapshot.version, normalize_query(query), k, key_filters) for query in queries]
+    results = [index.cache.get(key) if query else () for query, key in zip(queries, keys)]
+
+    missing = [i for i, cached in enumerate(results) if cached is None]
+    if missing:
+        candidates = FacetIndex().candidates(filters) if filters else None
+        hits = index.search_many([queries[i] for i in missing], k, candidates, snapshot)
+        for i, query_hits in zip(missing, hits):
+            results[i] = tuple(pk for pk, _ in query_hits)
+            index.cache.set(keys[i], results[i])
+    return [list(product_ids) for product_ids in results]
+
+
+def tfidf_search(query, k=10, filters=None):
+    """
+    :param filters: Optional facet filters, see ``FacetIndex.candidates``.
+    """
+    if not query:
         return {"query": query, "results": []}
 
-    descriptions = [product.description for product in products]
-    descriptions.append(query)
-
-    vectorizer = TfidfVectorizer()
-    tfidf_matrix = vectorizer.fit_transform(descriptions)
-
-    query_vector = tfidf_matrix[-1]  # The last row corresponds to the query
-    product_vectors = tfidf_matrix[
-        :-1
-    ]  # All rows except the last are product descriptions
-    similarity_scores = cosine_similarity(query_vector, product_vectors).flatten()
-
-    product_similarity = list(zip(products, similarity_scores))
-    sorted_products = sorted(product_similarity, key=lambda x: x[1], reverse=True)
-    if len(sorted_products):
-        returnable_list = sorted_products
-    results = [
-        ProductSerializer(product).data  # Use the serializer here
-        for product, score in returnable_list
-        if score > 0
-    ][:10]
-
-    return {"results": results}
+    fragments = ProductJSONCache().fragments(search_product_ids(query, k, filters))
+    return {"results": [json.loads(fragment) for fragment in fragments]}
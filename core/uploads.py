@@ -0,0 +1,106 @@
+import json
+from io import BytesIO
+
+from django.core.exceptions import RequestAborted
+from django.core.files.uploadedfile import InMemoryUploadedFile
+from django.core.files.uploadhandler import FileUploadHandler, StopUpload
+
+
+class BoundedMemoryUploadHandler(FileUploadHandler):
+    """
+    Keep uploaded files in memory, whatever their size, and stop reading the
+    request as soon as more than ``max_bytes`` of file data has arrived.
+
+    Unlike Django's default handlers this never spools to a temporary file,
+    so it works on read-only filesystems. Check ``exceeded`` after accessing
+    ``request.FILES``.
+
+    Under ASGI, Django reads the whole body before the view runs, so this
+    only bounds what is parsed; ``RequestBodyLimit`` bounds what is read.
+    """
+
+    def __init__(self, request=None, max_bytes=5 * 1024 * 1024):
+        super().__init__(request)
+        self.max_bytes = max_bytes
+        self.received = 0
+        self.exceeded = False
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.file = BytesIO()
+
+    def receive_data_chunk(self, raw_data, start):
+        self.received += len(raw_data)
+        if self.received > self.max_bytes:
+            self.exceeded = True
+            raise StopUpload(connection_reset=False)
+        self.file.write(raw_data)
+
+    def file_complete(self, file_size):
+        self.file.seek(0)
+        return InMemoryUploadedFile(
+            file=self.file,
+            field_name=self.field_name,
+            name=self.file_name,
+            content_type=self.content_type,
+            size=file_size,
+            charset=self.charset,
+            content_type_extra=self.content_type_extra,
+        )
+
+
+class RequestBodyLimit:
+    """
+    ASGI middleware answering 413 to request bodies over ``max_bytes``.
+
+    Django's ASGI handler reads the whole body (spooling it to a temporary
+    file past ``FILE_UPLOAD_MAX_MEMORY_SIZE``) before any upload handler
+    runs. This refuses a too large Content-Length up front, and stops
+    reading a body sent without one as soon as it passes the limit.
+    """
+
+    def __init__(self, app, max_bytes):
+        self.app = app
+        self.max_bytes = max_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        headers = dict(scope.get("headers") or ())
+        try:
+            too_large = int(headers.get(b"content-length", 0)) > self.max_bytes
+        except ValueError:
+            too_large = False  # left for Django to refuse
+        if too_large:
+            return await self.reject(send)
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_bytes:
+                    await self.reject(send)
+                    # Django's handler drops a request aborted while its
+                    # body is read, without sending a response of its own.
+                    raise RequestAborted()
+            return message
+
+        return await self.app(scope, limited_receive, send)
+
+    async def reject(self, send):
+        body = json.dumps({"error": f"Request body must be at most {self.max_bytes} bytes"})
+        await send(
+            {
+                "type": "http.response.start",
+                "status": 413,
+                "headers": [
+                    (b"content-type", b"application/json"),
+                    (b"content-length", str(len(body)).encode()),
+                    (b"connection", b"close"),
+                ],
+            }
+        )
+        await send({"type": "http.response.body", "body": body.encode()})
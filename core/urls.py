@@ -2,6 +2,8 @@ from django.urls import path
 from .views import (
     home,
     group_search_view,
+    batch_search_view,
+    facets_view,
     particular_search_view,
     add_to_cart,
     finalize_cart,
@@ -19,6 +21,13 @@ from .views import (
 
 
     product_details_page_conversationalist, image_similarity_view, recommendations_view,
+    image_similarity_async_view,
+    home_page_conversationalist_async,
+    product_list_page_conversationalist_async,
+    filter_conversationalist_async,
+    product_details_page_conversationalist_async,
+    product_description_conversationalist_async,
+    product_image_view,
 
 )
 
@@ -51,14 +60,47 @@ path('api/recommendations/', recommendations_view, name='recommendations'),
         product_description_conversationalist,
         name="product_description_conversationalist",
     ),
+    path(
+        "api/home_page_conversationalist/async/",
+        home_page_conversationalist_async,
+        name="home_page_conversationalist_async",
+    ),
+    path(
+        "api/product_list_page_conversationalist/async/",
+        product_list_page_conversationalist_async,
+        name="product_list_page_conversationalist_async",
+    ),
+    path(
+        "api/filter_conversationalist/async/",
+        filter_conversationalist_async,
+        name="filter_conversationalist_async",
+    ),
+    path(
+        "api/product_details_page_conversationalist/async/",
+        product_details_page_conversationalist_async,
+        name="product_details_page_conversationalist_async",
+    ),
+    path(
+        "api/product_description_conversationalist/async/",
+        product_description_conversationalist_async,
+        name="product_description_conversationalist_async",
+    ),
 
 path('image-similarity/', image_similarity_view, name='image_similarity'),
 
 
     path('image-similarity/', image_similarity_view, name='image_similarity'),
+    path(
+        "image-similarity/async/",
+        image_similarity_async_view,
+        name="image_similarity_async",
+    ),
 
+    path("images/<str:digest>/<str:name>", product_image_view, name="product_image"),
     path("api/get_all_products/", get_all_products, name="get_all_products"),
     path("api/group_search/", group_search_view, name="group_search"),
+    path("api/batch_search/", batch_search_view, name="batch_search"),
+    path("api/facets/", facets_view, name="facets"),
     path("api/particular_search/", particular_search_view, name="particular_search"),
     path("api/add_to_cart/", add_to_cart, name="add_to_cart"),
     path("api/finalize_cart/", finalize_cart, name="finalize_cart"),
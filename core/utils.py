@@ -1,19 +1,23 @@
-from django.db.models import Q
 from django.http import JsonResponse
 
+from .facets import FacetIndex, filters_key
 from .models import Products
 from .models  import PreviousOrders
+from .product_json import ProductJSONCache, json_array, json_response
 from collections import Counter
 import numpy as np
 from sklearn.cluster import KMeans
 from datetime import datetime
+import logging
 
 
-import os
 import numpy as np
-import cv2
-from scipy.spatial.distance import cdist
-import matplotlib.pyplot as plt
+from django.conf import settings
+from .image_ann import nearest_products
+from .image_cache import VisualQueryCache, perceptual_hash
+from .image_features import extract_features, image_features, load_feature_store
+
+logger = logging.getLogger(__name__)
 
 
 def image_similarity_search(
@@ -21,99 +25,55 @@ def image_similarity_search(
     query_image_path="core/product_images/product_2_image1.jpg",
     bins=(16, 16, 16),
     top_n=5,
+    query_image=None,
+    filters=None,
 ):
-    def get_products_for_paths(image_paths):
-        products = Products.objects.filter(
-            Q(image1_url__in=image_paths)
-            | Q(image2_url__in=image_paths)
-            | Q(image3_url__in=image_paths)
-        )
-        return products
-
-    def remove_background(image):
-        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        _, mask = cv2.threshold(gray, 1, 255, cv2.THRESH_BINARY)
-        kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (5, 5))
-        mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, kernel)
-        mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, kernel)
-        result = cv2.bitwise_and(image, image, mask=mask)
-        return result
-
-    def extract_features(image_path, bins=(16, 16, 16)):
-        image = cv2.imread(image_path)
-        if image is None:
-            print(f"Error reading image: {image_path}")
-            return None
-        image = remove_background(image)
-        image = cv2.resize(image, (256, 256))
-        hist = cv2.calcHist([image], [0, 1, 2], None, bins, [0, 256, 0, 256, 0, 256])
-        hist = cv2.normalize(hist, hist).flatten()
-        return hist
-
-    def build_feature_database(image_folder):
-        features = []
-        image_paths = []
-        for filename in os.listdir(image_folder):
-            if filename.endswith(".jpg"):
-                path = os.path.join(image_folder, filename)
-                print(f"Processing {filename}...")
-                feature = extract_features(path)
-                if feature is not None:
-                    image_paths.append(path)
-                    features.append(feature)
-        return np.array(features), image_paths
-
-    def search_similar_images(query_image_path, features, image_paths, top_n=5):
-        query_features = extract_features(query_image_path)
+    """
+    Find the products that look most like the query image.
+    :param query_image: Decoded BGR image; if given, ``query_image_path``
+        is not read, and results are cached by the image's perceptual hash
+        and checked against its histogram.
+    :param top_n: Number of distinct products to return.
+    :param filters: Optional facet filters, e.g. ``{"gender": "Women"}``;
+        only matching products are compared.
+    :return: ``[(product_id, distance), ...]``, closest first.
+    """
+    def search_similar_products(query_features):
         if query_features is None:
-            print("Error processing query image.")
+            logger.debug("Could not extract features from the query image")
             return []
-        distances = cdist([query_features], features, metric="euclidean")[0]
-        sorted_indices = np.argsort(distances)
-        results = [(image_paths[idx], distances[idx]) for idx in sorted_indices]
-        return results[:top_n]
-
-    def display_results(query_image_path, results):
-        query_image = cv2.imread(query_image_path)
-        query_image = cv2.cvtColor(query_image, cv2.COLOR_BGR2RGB)
-        plt.figure(figsize=(15, 5))
-        plt.subplot(1, len(results) + 1, 1)
-        plt.imshow(query_image)
-        plt.title("Query Image")
-        plt.axis("off")
-        for i, (path, distance) in enumerate(results):
-            result_image = cv2.imread(path)
-            result_image = cv2.cvtColor(result_image, cv2.COLOR_BGR2RGB)
-            plt.subplot(1, len(results) + 1, i + 2)
-            plt.imshow(result_image)
-            plt.title(f"Dist: {distance:.2f}")
-            plt.axis("off")
-        plt.show()
+        return nearest_products(image_folder, query_features, top_n, bins, filters=filters)
 
     # Main function logic
-    print("Building feature database...")
-    features, image_paths = build_feature_database(image_folder)
-
-    print("Searching for similar images...")
-    results = search_similar_images(query_image_path, features, image_paths, top_n)
-    ids = []
-    for tup in results:
-        stri = tup[0]
-        id = stri[28]
-        if stri[29].isdigit():
-            id += stri[29]
-        ids.append(id)
-        id = ""
-    print(ids)
+    if query_image is None:
+        results = search_similar_products(extract_features(query_image_path, bins))
+    else:
+        query_features = image_features(query_image, bins)
+        cache = VisualQueryCache()
+        version = load_feature_store(image_folder, bins)[0]["version"]
+        context = (
+            tuple(bins),
+            top_n,
+            getattr(settings, "IMAGE_SEARCH_BACKEND", "exact"),
+            getattr(settings, "IMAGE_DESCRIPTOR", "float32"),
+            getattr(settings, "IMAGE_SEARCH_AGGREGATE", "min"),
+            filters_key(filters),
+        )
+        image_hash = perceptual_hash(query_image)
+        results = cache.get(image_folder, version, context, image_hash, query_features)
+        if results is None:
+            results = search_similar_products(query_features)
+            cache.set(image_folder, version, context, image_hash, query_features, results)
+        results = list(results)
+    logger.debug("Image search matched %d products", len(results))
 
-    return ids
+    return results
 
 
 def get_combined_descriptions():
     # Retrieve all product descriptions and concatenate them into a single string
     products = Products.objects.all()
     combined_description = " ".join(product.description for product in products)
-    print(combined_description)
     return combined_description
 
 
@@ -211,15 +171,7 @@ def recommend_filters(previous_orders=PreviousOrders.objects.all()):
 
 
 def filter_extractor(query, returnable_filters):
-    products = Products.objects.all()
-    filters = set()
-
-    for product in products:
-        filters.add(product.activity)
-        filters.add(product.color)
-        filters.add(product.gender)
-        filters.add(product.category)
-        filters.add(product.fit)
+    filters = FacetIndex().values(("activity", "color", "gender", "category", "fit"))
 
     query_words = query.split()  # Split the query into words
     query_phrases = set()
@@ -320,49 +272,17 @@ def recommend_filters():
         if key == "seasonal":
             seasonal_filtered_products = seasonal_filtered_products.filter(category__in=values)
 
-    # Convert the filtered products to a list of dictionaries for JSON response
-    frequency_product_list = [
-        {
-            "id": product.id,
-            "name": product.name,
-            "gender": product.gender,
-            "color": product.color,
-            "fabric": product.fabric,
-            "activity": product.activity,
-            "fit": product.fit,
-            "length": product.length,
-            "category": product.category,
-            "price": product.price,
-            "image1_url": product.image1_url,
-            "image2_url": product.image2_url,
-            "image3_url": product.image3_url,
-            "description": product.description
-        }
-        for product in frequency_filtered_products
-    ]
-
-    seasonal_product_list = [
-        {
-            "id": product.id,
-            "name": product.name,
-            "gender": product.gender,
-            "color": product.color,
-            "fabric": product.fabric,
-            "activity": product.activity,
-            "fit": product.fit,
-            "length": product.length,
-            "category": product.category,
-            "price": product.price,
-            "image1_url":product.image1_url,
-            "image2_url": product.image2_url,
-            "image3_url": product.image3_url,
-            "description":product.description
-        }
-        for product in seasonal_filtered_products
-    ]
-
-    return JsonResponse({
-        "frequency_based_products": frequency_product_list,
-        "seasonal_based_products": seasonal_product_list
-    }, safe=False)
+    # Assemble the response from the pre-rendered product JSON
+    cache = ProductJSONCache()
+    frequency_product_list = cache.fragments(
+        frequency_filtered_products.values_list("id", flat=True)
+    )
+    seasonal_product_list = cache.fragments(
+        seasonal_filtered_products.values_list("id", flat=True)
+    )
+
+    return json_response({
+        "frequency_based_products": json_array(frequency_product_list),
+        "seasonal_based_products": json_array(seasonal_product_list)
+    })
 
@@ -1,12 +1,23 @@
+from django.conf import settings
+from django.db import IntegrityError, transaction
 from django.db.models import Q
 from django.shortcuts import render
-from django.http import JsonResponse
+from django.http import (
+    FileResponse,
+    Http404,
+    HttpResponseNotModified,
+    JsonResponse,
+    StreamingHttpResponse,
+)
 from .models import Products, Cart, PreviousOrders
-from .ai_model import GeminiClient
-from .serializers import ProductSerializer
-from .tfidf import tfidf_search
+from .ai_model import TRANSIENT_ERRORS, GeminiClient, ProductNotFound
+from .facets import FacetIndex, clean_filters, filters_from_querydict
+from .product_json import ProductJSONCache, json_array, json_response
+from .tfidf import batch_search_product_ids, search_product_ids
 from rest_framework.decorators import api_view
+import asyncio
 import json
+import logging
 from django.views.decorators.csrf import csrf_exempt
 
 from .utils import image_similarity_search, filter_extractor
@@ -15,11 +26,15 @@ from .utils import image_similarity_search, filter_extractor, recommend_filters
 
 
 ai = GeminiClient()
-filter_var = []
-import os
 from django.views.decorators.csrf import csrf_exempt
-from django.core.files.storage import default_storage
-from django.core.files.base import ContentFile
+from .image_derivatives import thumbnail_path
+from .image_features import decode_image
+from .uploads import BoundedMemoryUploadHandler
+from .visual_search import VisualSearchBusy, VisualSearchPool, search_upload
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIRequest
+
+logger = logging.getLogger(__name__)
 
 
 
@@ -31,84 +46,110 @@ def recommendations_view(request):
     :return: JsonResponse with the recommendations.
     """
     return recommend_filters()
+def _read_query_upload(request):
+    """
+    Read the ``image`` upload into memory, enforcing IMAGE_UPLOAD_MAX_BYTES.
+    :return: ``(data, None)`` or ``(None, error_response)``.
+    """
+    max_bytes = getattr(settings, "IMAGE_UPLOAD_MAX_BYTES", 5 * 1024 * 1024)
+    too_large = JsonResponse({"error": f"Image must be at most {max_bytes} bytes"}, status=413)
+    try:
+        # Refuse oversized bodies before reading them; the multipart
+        # framing adds a little on top of the file itself.
+        if int(request.META.get("CONTENT_LENGTH") or 0) > max_bytes + 64 * 1024:
+            return None, too_large
+    except ValueError:
+        return None, JsonResponse({"error": "Invalid Content-Length"}, status=400)
+
+    # Keep the upload in memory and stop reading past the cap.
+    handler = BoundedMemoryUploadHandler(request, max_bytes)
+    request.upload_handlers = [handler]
+    files = request.FILES
+    if handler.exceeded:
+        return None, too_large
+
+    # Check if an image is provided in the request
+    if "image" not in files:
+        return None, JsonResponse({"error": "No image provided"}, status=400)
+    return files["image"].read(), None
+
+
+def product_image_view(request, digest, name):
+    """
+    Serve a content-addressed product thumbnail. The URL changes whenever
+    the image does, so responses can be cached indefinitely.
+    """
+    resolved = thumbnail_path(digest, name)
+    if resolved is None:
+        raise Http404("Unknown image")
+    path, content_type = resolved
+    etag = f'"{digest}-{name}"'
+    if request.headers.get("If-None-Match") == etag:
+        response = HttpResponseNotModified()
+    else:
+        try:
+            response = FileResponse(open(path, "rb"), content_type=content_type)
+        except FileNotFoundError:
+            raise Http404("Unknown image")
+    response["ETag"] = etag
+    response["Cache-Control"] = "public, max-age=31536000, immutable"
+    return response
+
+
+def _wants_thumbnails(*params):
+    """
+    Whether the client asked for thumbnail links in product payloads with
+    ``thumbnails=1`` in any of ``params`` (query dicts). They are left out
+    by default: each image has several.
+    """
+    return any(p.get("thumbnails") in ("1", "true") for p in params)
+
+
+def _image_search_filters(request):
+    """
+    Facet constraints for visual search, from the form fields sent with the
+    upload (``-F gender=Women``) or else the query string.
+    """
+    return filters_from_querydict(request.POST) or filters_from_querydict(request.GET)
+
+
+def _image_similarity_response(results, thumbnails=False):
+    product_list = ProductJSONCache().fragments([pk for pk, _ in results], thumbnails)
+    return json_response(
+        {
+            "products": json_array(product_list),
+            "scores": {str(pk): round(score, 6) for pk, score in results},
+        },
+        status=200,
+    )
+
+
 @csrf_exempt
 def image_similarity_view(request):
     if request.method == "POST":
         try:
-            # Check if an image is provided in the request
-            if "image" not in request.FILES:
-                return JsonResponse({"error": "No image provided"}, status=400)
-
-            # Save the uploaded image to a temporary directory
-            uploaded_image = request.FILES["image"]
-            temp_image_path = default_storage.save(
-                f"temp/{uploaded_image.name}", ContentFile(uploaded_image.read())
-            )
+            data, error = _read_query_upload(request)
+            if error:
+                return error
+
+            image = decode_image(data)
+            if image is None:
+                return JsonResponse({"error": "Could not decode image"}, status=400)
 
             # Define the folder containing product images
-            image_folder = "core/product_images"
+            image_folder = settings.PRODUCT_IMAGE_DIR
 
             # Run the similarity search
-            ids = image_similarity_search(
+            results = image_similarity_search(
                 image_folder=image_folder,
-                query_image_path=temp_image_path,
+                query_image=image,
                 bins=(16, 16, 16),
-                top_n=7,
+                top_n=3,
+                filters=_image_search_filters(request),
+            )
+            return _image_similarity_response(
+                results, _wants_thumbnails(request.POST, request.GET)
             )
-
-            # Cleanup: Remove the temporary image after processing
-            if os.path.exists(temp_image_path):
-                os.remove(temp_image_path)
-            ids = list(set(ids))
-            ids = ids[:3]
-            # Fetch products with IDs in the given list
-            products = Products.objects.filter(id__in=ids)
-
-            # Convert products to a list of dictionaries (for JSON response)
-            product_list = [
-                {
-
-                    "id": product.id,
-                    "name": product.name,
-                    "color": product.color,
-                    "price": float(
-                        product.price
-                    ),  # Converting Decimal to float for JSON serialization
-                    "gender": product.gender,
-                    "category": product.category,
-                    "length": product.length,
-                    "fit": product.fit,
-                    "activity": product.activity,
-                    "fabric": product.fabric,
-                    "description": product.description,
-                    "images": {
-                        "image1": product.image1_url,
-                        "image2": product.image2_url,
-                        "image3": product.image3_url,
-                    },
-
-                    'id': product.id,
-                    'name': product.name,
-                    'color': product.color,
-                    'price': float(product.price),
-                    'gender': product.gender,
-                    'category': product.category,
-                    'length': product.length,
-                    'fit': product.fit,
-                    'activity': product.activity,
-                    'fabric': product.fabric,
-                    'description': product.description,
-                    'images': {
-                        'image1': product.image1_url,
-                        'image2': product.image2_url,
-                        'image3': product.image3_url,
-                    }
-
-                }
-                for product in products
-            ]
-
-            return JsonResponse({"products": product_list}, status=200)
 
         except Exception as e:
             return JsonResponse({"error": str(e)}, status=500)
@@ -116,28 +157,142 @@ def image_similarity_view(request):
     return JsonResponse({"error": "Invalid request method"}, status=405)
 
 
-def filter_reset():
-    global filter_var
-    filter_var.clear()
+@csrf_exempt
+async def image_similarity_async_view(request):
+    """
+    Same contract as ``image_similarity_view``, but decoding and ranking run
+    on the bounded ``VisualSearchPool`` so the event loop is never blocked.
+    Serve it through ``voixnova/asgi.py``; under WSGI it still works, with
+    one worker thread held per request.
+    Returns 503 with ``Retry-After`` when the pool is saturated.
+    """
+    if request.method != "POST":
+        return JsonResponse({"error": "Invalid request method"}, status=405)
+    try:
+        data, error = _read_query_upload(request)
+        if error:
+            return error
+        try:
+            results = await VisualSearchPool().run(
+                search_upload, data, 3, _image_search_filters(request)
+            )
+        except VisualSearchBusy as e:
+            response = JsonResponse({"error": str(e)}, status=503)
+            response["Retry-After"] = "1"
+            return response
+        if results is None:
+            return JsonResponse({"error": "Could not decode image"}, status=400)
+        return await sync_to_async(_image_similarity_response)(
+            results, _wants_thumbnails(request.POST, request.GET)
+        )
+
+    except Exception as e:
+        return JsonResponse({"error": str(e)}, status=500)
+
+
+def _chat_session_key(request):
+    """
+    Key of the caller's conversation with the assistant: the client's own
+    ``X-Chat-Session`` header or ``?session=`` id if it sends one, otherwise
+    its Django session (created on first use).
+    """
+    client_id = request.headers.get("X-Chat-Session") or request.GET.get("session")
+    if client_id:
+        return f"client:{client_id[:128]}"
+    if not request.session.session_key:
+        request.session.save()
+    return f"session:{request.session.session_key}"
+
+
+def _wants_stream(request):
+    return request.GET.get("stream") in ("1", "true") or "text/event-stream" in request.headers.get(
+        "Accept", ""
+    )
+
+
+def _sse_event(data, event=None):
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data)}\n\n"
+
+
+def _sse_response(sentences, meta=None):
+    """
+    Stream an assistant reply as Server-Sent Events: an optional ``meta``
+    event, one ``{"text": ...}`` message per sentence as soon as it is
+    complete, then ``done`` (or ``error``).
+    :param sentences: An iterator, or an async iterator. Under ASGI only
+        the latter is sent incrementally; Django buffers sync iterators.
+    """
+
+    def events():
+        if meta is not None:
+            yield _sse_event(meta, "meta")
+        try:
+            for sentence in sentences:
+                yield _sse_event({"text": sentence})
+        except Exception as e:
+            yield _sse_event({"error": str(e)}, "error")
+            return
+        yield _sse_event({}, "done")
+
+    async def aevents():
+        if meta is not None:
+            yield _sse_event(meta, "meta")
+        try:
+            async for sentence in sentences:
+                yield _sse_event({"text": sentence})
+        except Exception as e:
+            yield _sse_event({"error": str(e) or type(e).__name__}, "error")
+            return
+        yield _sse_event({}, "done")
+
+    stream = aevents() if hasattr(sentences, "__aiter__") else events()
+    response = StreamingHttpResponse(stream, content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"  # don't let a proxy hold the sentences back
+    return response
+
+
+def _on_completion(sentences, callback):
+    """
+    Wrap a (sync or async) sentence iterator so that ``callback()`` runs once
+    the whole reply has been read, and not if it fails or is abandoned.
+    """
+
+    def wrapped():
+        yield from sentences
+        callback()
+
+    async def awrapped():
+        async for sentence in sentences:
+            yield sentence
+        callback()
+
+    return awrapped() if hasattr(sentences, "__aiter__") else wrapped()
+
+
+def filter_reset(session_key):
+    ai.sessions.set_filters(session_key, [])
 
 
 def home_page_conversationalist(request):
     if request.method == "GET":
-        transcript = ai.home_page()
+        if _wants_stream(request):
+            return _sse_response(ai.home_page(_chat_session_key(request), stream=True))
+        transcript = ai.home_page(_chat_session_key(request))
         return JsonResponse({"message": transcript})
     return JsonResponse({"message": "Invalid request"})
 
 
 def home(request):
-    similar_products = image_similarity_search()
-    print(len(similar_products))
-    print(similar_products)
     return render(request, "search.html")
 
 
 def home_page_conversationalist(request):
     if request.method == "GET":
-        transcript = ai.home_page()
+        if _wants_stream(request):
+            return _sse_response(ai.home_page(_chat_session_key(request), stream=True))
+        transcript = ai.home_page(_chat_session_key(request))
         return JsonResponse({"message": transcript})
     return JsonResponse({"message": "Invalid request"})
 
@@ -145,95 +300,411 @@ def home_page_conversationalist(request):
 def product_list_page_conversationalist(request):
     if request.method == "GET":
         query = request.GET.get("search")
-        transcript = ai.product_list_page(query)
+        if _wants_stream(request):
+            return _sse_response(
+                ai.product_list_page(query, _chat_session_key(request), stream=True)
+            )
+        transcript = ai.product_list_page(query, _chat_session_key(request))
         return JsonResponse({"message": transcript})
     return JsonResponse({"message": "Invalid request"})
 
 
 def filter_conversationalist(request):
-    global filter_var
     if request.method == "GET":
         query = request.GET.get("filterMsg")
-        transcript = ai.filtering_interaction(query, filter_var)
-        filter_extractor(query, filter_var)
-        return JsonResponse({"message": transcript, "filters": filter_var})
+        session_key = _chat_session_key(request)
+        # Filters are kept per chat session, and only take effect once the
+        # assistant has replied to the message that set them.
+        current = ai.sessions.filters(session_key)
+        filters = filter_extractor(query, list(current))
+        if _wants_stream(request):
+            sentences = ai.filtering_interaction(query, current, session_key, stream=True)
+            sentences = _on_completion(
+                sentences, lambda: ai.sessions.set_filters(session_key, filters)
+            )
+            return _sse_response(sentences, {"filters": filters})
+        transcript = ai.filtering_interaction(query, current, session_key)
+        ai.sessions.set_filters(session_key, filters)
+        return JsonResponse({"message": transcript, "filters": filters})
     return JsonResponse({"message": "Invalid request"})
 
 
 def product_details_page_conversationalist(request):
     if request.method == "GET":
         query = request.GET.get("search")
-        transcript = ai.product_details_page(query)
+        if _wants_stream(request):
+            return _sse_response(
+                ai.product_details_page(query, _chat_session_key(request), stream=True)
+            )
+        transcript = ai.product_details_page(query, _chat_session_key(request))
         return JsonResponse({"message": transcript})
     return JsonResponse({"message": "Invalid request"})
 
 
+def _product_not_found():
+    return JsonResponse({"message": "No matching product found"}, status=404)
+
+
 def product_description_conversationalist(request):
     if request.method == "GET":
         query = request.GET.get("search")
-        transcript = ai.product_description(query)
+        try:
+            if _wants_stream(request):
+                return _sse_response(
+                    ai.product_description(query, _chat_session_key(request), stream=True)
+                )
+            transcript = ai.product_description(query, _chat_session_key(request))
+        except ProductNotFound:
+            return _product_not_found()
         return JsonResponse({"message": transcript})
     return JsonResponse({"message": "Invalid request"})
 
 
+# Async variants of the conversational views, for ASGI. Model calls go
+# through ``GeminiClient.asend``: bounded concurrency, per-call timeouts and
+# retries, and no worker held while waiting on the model. Work that does
+# not feed the prompt runs alongside the model call.
+
+
+async def _conversation_reply(
+    prompt, session_key, stream, meta=None, overlap=None, on_reply=None
+):
+    """
+    Answer one conversational turn, as JSON or (``stream``) SSE.
+    :param meta: Extra fields of the reply.
+    :param overlap: Awaitable run concurrently with the model call; it
+        must not depend on the reply.
+    :param on_reply: Called once the whole reply has been received; not
+        called if the model call fails.
+    """
+    if stream:
+        if overlap is not None:
+            await overlap
+        sentences = await ai.asend(prompt, session_key, stream=True)
+        if on_reply is not None:
+            sentences = _on_completion(sentences, on_reply)
+        return _sse_response(sentences, meta)
+    try:
+        if overlap is None:
+            transcript = await ai.asend(prompt, session_key)
+        else:
+            transcript, _ = await asyncio.gather(ai.asend(prompt, session_key), overlap)
+    except TRANSIENT_ERRORS as e:
+        response = JsonResponse(
+            {"error": f"The assistant did not respond ({type(e).__name__})"}, status=503
+        )
+        response["Retry-After"] = "1"
+        return response
+    if on_reply is not None:
+        on_reply()
+    return JsonResponse({"message": transcript, **(meta or {})})
+
+
+async def home_page_conversationalist_async(request):
+    if request.method != "GET":
+        return JsonResponse({"message": "Invalid request"})
+    session_key = await sync_to_async(_chat_session_key)(request)
+    return await _conversation_reply(ai.home_page_prompt(), session_key, _wants_stream(request))
+
+
+async def product_list_page_conversationalist_async(request):
+    if request.method != "GET":
+        return JsonResponse({"message": "Invalid request"})
+    prompt = ai.product_list_page_prompt(request.GET.get("search"))
+    session_key = await sync_to_async(_chat_session_key)(request)
+    return await _conversation_reply(prompt, session_key, _wants_stream(request))
+
+
+async def filter_conversationalist_async(request):
+    if request.method != "GET":
+        return JsonResponse({"message": "Invalid request"})
+    query = request.GET.get("filterMsg")
+    session_key = await sync_to_async(_chat_session_key)(request)
+    # The prompt describes the filters before this message; extracting the
+    # new ones only needs the query, so it runs during the model call.
+    current = ai.sessions.filters(session_key)
+    prompt = ai.filtering_interaction_prompt(query, current)
+    filters = list(current)
+    extraction = sync_to_async(filter_extractor)(query, filters)
+    # A timed out or failed reply leaves the session's filters as they were.
+    return await _conversation_reply(
+        prompt,
+        session_key,
+        _wants_stream(request),
+        {"filters": filters},
+        extraction,
+        on_reply=lambda: ai.sessions.set_filters(session_key, filters),
+    )
+
+
+async def product_details_page_conversationalist_async(request):
+    if request.method != "GET":
+        return JsonResponse({"message": "Invalid request"})
+    prompt = ai.product_details_page_prompt(request.GET.get("search"))
+    session_key = await sync_to_async(_chat_session_key)(request)
+    return await _conversation_reply(prompt, session_key, _wants_stream(request))
+
+
+async def product_description_conversationalist_async(request):
+    if request.method != "GET":
+        return JsonResponse({"message": "Invalid request"})
+    # The catalog lookup and the session lookup (a database write for new
+    # sessions) are independent; run them side by side.
+    try:
+        prompt, session_key = await asyncio.gather(
+            sync_to_async(ai.product_description_prompt, thread_sensitive=False)(
+                request.GET.get("search")
+            ),
+            sync_to_async(_chat_session_key)(request),
+        )
+    except ProductNotFound:
+        return _product_not_found()
+    return await _conversation_reply(prompt, session_key, _wants_stream(request))
+
+
 def get_all_products(request):
-    print("here")
-    products = Products.objects.all()
-    serializer = ProductSerializer(products, many=True)
-    return JsonResponse(serializer.data, safe=False)
+    """
+    Catalog export.
+
+    Without parameters the whole catalog is streamed as a JSON array, as
+    before. ``?format=ndjson`` streams one product per line instead.
+    ``?cursor=<last id>&limit=<n>`` returns a single keyset page of the form
+    ``{"results": [...], "next_cursor": <id or null>}``. Thumbnail links
+    are included with ``?thumbnails=1``.
+    """
+    thumbnails = _wants_thumbnails(request.GET)
+    if "cursor" in request.GET or "limit" in request.GET:
+        try:
+            cursor = int(request.GET.get("cursor") or 0)
+            limit = int(request.GET.get("limit") or settings.REST_FRAMEWORK["PAGE_SIZE"])
+        except ValueError:
+            return JsonResponse({"error": "cursor and limit must be integers"}, status=400)
+        limit = min(max(limit, 1), settings.PRODUCT_EXPORT_MAX_PAGE_SIZE)
+        product_ids = list(
+            Products.objects.filter(id__gt=cursor)
+            .order_by("id")
+            .values_list("id", flat=True)[:limit]
+        )
+        next_cursor = product_ids[-1] if len(product_ids) == limit else None
+        return json_response(
+            {
+                "results": json_array(ProductJSONCache().fragments(product_ids, thumbnails)),
+                "next_cursor": next_cursor,
+            }
+        )
+
+    ndjson = request.GET.get("format") == "ndjson"
+    # Under ASGI, Django buffers a sync iterator whole before sending it, so
+    # the export is streamed from an async generator of keyset pages there.
+    if isinstance(request, ASGIRequest):
+        chunks = _arendered_product_chunks(thumbnails)
+        stream = _astream_products_ndjson if ndjson else _astream_products_json
+    else:
+        chunks = _rendered_product_chunks(thumbnails)
+        stream = _stream_products_ndjson if ndjson else _stream_products_json
+    content_type = "application/x-ndjson" if ndjson else "application/json"
+    return StreamingHttpResponse(stream(chunks), content_type=content_type)
+
+
+def _rendered_product_chunks(thumbnails=False):
+    """
+    Yield the catalog in id order as lists of JSON fragments, so memory stays
+    bounded by ``PRODUCT_EXPORT_CHUNK_SIZE`` whatever the catalog size.
+    """
+    chunk_size = settings.PRODUCT_EXPORT_CHUNK_SIZE
+    chunk = []
+    for product in Products.objects.order_by("id").iterator(chunk_size=chunk_size):
+        chunk.append(product)
+        if len(chunk) == chunk_size:
+            yield list(ProductJSONCache.render(chunk, thumbnails).values())
+            chunk = []
+    if chunk:
+        yield list(ProductJSONCache.render(chunk, thumbnails).values())
+
+
+def _rendered_product_page(after, limit, thumbnails=False):
+    """
+    :return: ``(fragments, last_id)`` of the first ``limit`` products with
+        an id above ``after``; ``last_id`` is None past the end.
+    """
+    products = list(Products.objects.filter(id__gt=after).order_by("id")[:limit])
+    if not products:
+        return [], None
+    return list(ProductJSONCache.render(products, thumbnails).values()), products[-1].id
+
+
+async def _arendered_product_chunks(thumbnails=False):
+    """
+    Async counterpart of ``_rendered_product_chunks``: each chunk is a keyset
+    page read in a worker thread, so no cursor stays open across awaits.
+    """
+    chunk_size = settings.PRODUCT_EXPORT_CHUNK_SIZE
+    after = 0
+    while True:
+        fragments, after = await sync_to_async(_rendered_product_page)(
+            after, chunk_size, thumbnails
+        )
+        if fragments:
+            yield fragments
+        if after is None or len(fragments) < chunk_size:
+            return
+
+
+def _stream_products_json(chunks):
+    yield b"["
+    separator = b""
+    for fragments in chunks:
+        yield separator + b",".join(fragments)
+        separator = b","
+    yield b"]"
+
+
+def _stream_products_ndjson(chunks):
+    for fragments in chunks:
+        yield b"".join(fragment + b"\n" for fragment in fragments)
+
+
+async def _astream_products_json(chunks):
+    yield b"["
+    separator = b""
+    async for fragments in chunks:
+        yield separator + b",".join(fragments)
+        separator = b","
+    yield b"]"
+
+
+async def _astream_products_ndjson(chunks):
+    async for fragments in chunks:
+        yield b"".join(fragment + b"\n" for fragment in fragments)
 
 
 def group_search_view(request):
     query = request.GET.get("q", "")
-    print(f"Search Query: {query}")
-    results = tfidf_search(query)
-    relevant_data = str(results["results"])
-    print(len(results["results"]))
-    return JsonResponse(
+    product_ids = search_product_ids(query, filters=filters_from_querydict(request.GET))
+    results = ProductJSONCache().fragments(product_ids, _wants_thumbnails(request.GET))
+    logger.debug("Search query %r matched %d products", query, len(results))
+    return json_response(
         {
             "query": query,
-            "results": results.get("results", []),
-        },
-        safe=False,
+            "results": json_array(results),
+        }
+    )
+
+
+@csrf_exempt
+def batch_search_view(request):
+    """
+    Resolve several search phrases in one round trip.
+
+    Accepts repeated ``q`` query parameters on GET, or a JSON body of the
+    form ``{"queries": [...], "k": 10, "filters": {"color": ["Black"]}}`` on
+    POST; a bare JSON list is taken as the queries. Facet filters apply to
+    every query in the batch. Thumbnail links are included with
+    ``?thumbnails=1`` or ``"thumbnails": true``.
+    """
+    thumbnails = _wants_thumbnails(request.GET)
+    if request.method == "GET":
+        queries = request.GET.getlist("q")
+        k = request.GET.get("k", 10)
+        filters = filters_from_querydict(request.GET)
+    elif request.method == "POST":
+        try:
+            body = json.loads(request.body or b"{}")
+        except ValueError:
+            return JsonResponse({"error": "Invalid JSON body"}, status=400)
+        if isinstance(body, list):
+            body = {"queries": body}
+        if not isinstance(body, dict):
+            return JsonResponse(
+                {"error": "Body must be a JSON object or a list of queries"}, status=400
+            )
+        queries = body.get("queries", [])
+        k = body.get("k", 10)
+        filters = body.get("filters")
+        thumbnails = thumbnails or body.get("thumbnails") is True
+    else:
+        return JsonResponse({"error": "Invalid request method"}, status=405)
+
+    if not isinstance(queries, list) or not all(isinstance(q, str) for q in queries):
+        return JsonResponse({"error": "queries must be a list of strings"}, status=400)
+    if len(queries) > settings.SEARCH_BATCH_MAX_QUERIES:
+        return JsonResponse(
+            {"error": f"At most {settings.SEARCH_BATCH_MAX_QUERIES} queries per batch"},
+            status=400,
+        )
+    try:
+        k = min(max(int(k), 1), settings.SEARCH_BATCH_MAX_RESULTS)
+    except (TypeError, ValueError):
+        return JsonResponse({"error": "k must be an integer"}, status=400)
+    try:
+        filters = clean_filters(filters)
+    except ValueError as e:
+        return JsonResponse({"error": str(e)}, status=400)
+
+    cache = ProductJSONCache()
+    return json_response(
+        {
+            "results": [
+                {"query": query, "results": json_array(cache.fragments(product_ids, thumbnails))}
+                for query, product_ids in zip(
+                    queries, batch_search_product_ids(queries, k, filters)
+                )
+            ]
+        }
     )
 
 
+def facets_view(request):
+    """
+    Facet counts for the catalog, optionally narrowed by the same
+    ``?color=...&gender=...`` filters the search endpoints accept.
+    """
+    filters = filters_from_querydict(request.GET)
+    return JsonResponse({"filters": filters, "facets": FacetIndex().counts(filters)})
+
+
 def particular_search_view(request):
     query = request.GET.get("q", "")
-    print(f"Search Query: {query}")
-    results = tfidf_search(query)
-    temp = results["results"]
-    results["results"] = temp[0]
-    return JsonResponse(
+    logger.debug("Search query %r", query)
+    product_ids = search_product_ids(query, filters=filters_from_querydict(request.GET))
+    results = ProductJSONCache().fragments(product_ids, _wants_thumbnails(request.GET))
+    return json_response(
         {
             "query": query,
-            "results": results.get("results", []),
-        },
-        safe=False,
+            "results": results[0] if results else [],
+        }
     )
 
 
 def add_to_cart(request):
     if request.method == "GET":
         query = request.GET.get("q", "")
-        print(f"Search Query bsias: {query}")
+        logger.debug("Add to cart query %r", query)
 
         # Perform the search
-        results = tfidf_search(query)["results"]
+        results = search_product_ids(query)
 
         if not results:
             return JsonResponse(
                 {"message": "No products found to add to cart"}, status=404
             )
 
-        add_to_cart_id = results[0]["id"]
-        product = Products.objects.get(id=add_to_cart_id)
-        cart_item = Cart(product=product)
-        cart_item.save()
+        add_to_cart_id = results[0]
+        # The index may still list a product another process just deleted.
+        try:
+            with transaction.atomic():
+                product = Products.objects.filter(id=add_to_cart_id).first()
+                if product is not None:
+                    Cart.objects.create(product=product)
+        except IntegrityError:
+            product = None
+        if product is None:
+            return JsonResponse(
+                {"message": "No products found to add to cart"}, status=404
+            )
 
-        # Serialize the product data to return
-        product_data = ProductSerializer(product).data
-        return JsonResponse(
+        product_data = ProductJSONCache().fragment(add_to_cart_id)
+        return json_response(
             {"message": "Added to cart", "product": product_data}, status=201
         )
     else:
@@ -281,11 +752,10 @@ def get_cart_products(request):
         if not cart_items.exists():
             return JsonResponse({"cart": [], "message": "Cart is empty."}, status=200)
 
-        # Serialize the products in the cart using ProductSerializer
-        products = [cart_item.product for cart_item in cart_items]
-        serialized_products = ProductSerializer(products, many=True).data
+        product_ids = cart_items.values_list("product_id", flat=True)
+        serialized_products = ProductJSONCache().fragments(product_ids)
 
-        return JsonResponse({"cart": serialized_products}, status=200)
+        return json_response({"cart": json_array(serialized_products)}, status=200)
 
     # If the request method is not GET, return an error response
     return JsonResponse({"error": "Invalid request method"}, status=400)
@@ -0,0 +1,128 @@
+"""
+Bounded worker pool for visual search requests.
+
+Decoding an upload and ranking it against the catalog is CPU-bound. The
+async image view hands that work to this pool, so the event loop (and with
+it the cheap JSON endpoints) stays responsive under ASGI. OpenCV, numpy and
+faiss release the GIL in their heavy loops, so threads run in parallel
+without pickling images or re-mapping the feature store per process.
+
+At most ``IMAGE_SEARCH_MAX_IN_FLIGHT`` searches are running or queued;
+further requests are refused straight away, and queued requests that wait
+longer than ``IMAGE_SEARCH_QUEUE_TIMEOUT`` seconds are dropped unrun. Both
+surface as ``VisualSearchBusy`` for the view to turn into a 503.
+"""
+
+import asyncio
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+from .image_features import decode_image
+from .utils import image_similarity_search
+
+
+class VisualSearchBusy(Exception):
+    pass
+
+
+class VisualSearchPool:
+    _instance = None
+    _lock = threading.Lock()
+    _initialized = False
+
+    def __new__(cls):
+        if cls._instance is None:
+            with cls._lock:
+                if cls._instance is None:
+                    cls._instance = super(VisualSearchPool, cls).__new__(cls)
+        return cls._instance
+
+    def __init__(self):
+        if self._initialized:
+            return
+        workers = getattr(settings, "IMAGE_SEARCH_WORKERS", None) or os.cpu_count() or 2
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="visual-search")
+        self.max_in_flight = getattr(settings, "IMAGE_SEARCH_MAX_IN_FLIGHT", 2 * workers)
+        self.queue_timeout = getattr(settings, "IMAGE_SEARCH_QUEUE_TIMEOUT", 5.0)
+        self.in_flight = 0
+        self.rejected = 0
+        self._counter_lock = threading.Lock()
+        self._initialized = True
+
+    async def run(self, function, *args):
+        """
+        Run ``function(*args)`` on the pool and await its result.
+        :raises VisualSearchBusy: If the pool is full or the call waited in
+            the queue longer than the queue timeout.
+        """
+        with self._counter_lock:
+            if self.in_flight >= self.max_in_flight:
+                self.rejected += 1
+                raise VisualSearchBusy("Too many visual searches in flight")
+            self.in_flight += 1
+        loop = asyncio.get_running_loop()
+        started = loop.create_future()
+
+        def mark_started():
+            if not started.done():
+                started.set_result(None)
+
+        def job():
+            loop.call_soon_threadsafe(mark_started)
+            return function(*args)
+
+        try:
+            future = self.executor.submit(job)
+        except BaseException:
+            self._release()
+            raise
+        # The slot is held until the search itself is over, even if the
+        # request awaiting it is cancelled first.
+        future.add_done_callback(self._release)
+        try:
+            try:
+                await asyncio.wait_for(started, self.queue_timeout)
+            except asyncio.TimeoutError:
+                # Only a search that has not started yet can be dropped.
+                if future.cancel():
+                    with self._counter_lock:
+                        self.rejected += 1
+                    raise VisualSearchBusy("Visual search queue timed out")
+            return await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            # A cancelled request does not leave its search queued.
+            future.cancel()
+            raise
+
+    def _release(self, future=None):
+        with self._counter_lock:
+            self.in_flight -= 1
+
+    def stats(self):
+        with self._counter_lock:
+            return {
+                "in_flight": self.in_flight,
+                "max_in_flight": self.max_in_flight,
+                "rejected": self.rejected,
+            }
+
+
+def search_upload(data, top_n=3, filters=None):
+    """
+    Decode uploaded image bytes and find the closest products.
+    :return: ``[(product_id, distance), ...]``, or ``None`` if the bytes are
+        not an image.
+    """
+    image = decode_image(data)
+    if image is None:
+        return None
+    return image_similarity_search(
+        image_folder=settings.PRODUCT_IMAGE_DIR,
+        query_image=image,
+        bins=(16, 16, 16),
+        top_n=top_n,
+        filters=filters,
+    )
@@ -2,6 +2,8 @@
 ASGI config for voixnova project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+Serve it with ``uvicorn voixnova.asgi:application`` so that async views such
+as the visual search endpoint do not hold a worker thread while they wait.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/4.2/howto/deployment/asgi/
@@ -9,8 +11,11 @@ https://docs.djangoproject.com/en/4.2/howto/deployment/asgi/
 
 import os
 
+from django.conf import settings
 from django.core.asgi import get_asgi_application
 
+from core.uploads import RequestBodyLimit
+
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'voixnova.settings')
 
-application = get_asgi_application()
+application = RequestBodyLimit(get_asgi_application(), settings.ASGI_MAX_REQUEST_BODY_BYTES)
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 from django.conf.global_settings import APPEND_SLASH, CSRF_TRUSTED_ORIGINS
@@ -94,6 +95,123 @@ DATABASES = {
 }
 
 
+# Product search
+# Written by `manage.py build_search_index` and memory-mapped by every worker.
+SEARCH_INDEX_DIR = BASE_DIR / "search_index"
+
+# Refit the TF-IDF index once this fraction of the catalog changed since the last fit.
+SEARCH_INDEX_REFIT_RATIO = 0.1
+
+# The in-memory search and facet indexes compare a cheap catalog stamp with
+# the one they were built from at most every CATALOG_CHECK_INTERVAL seconds,
+# to pick up products changed by other worker processes, and are rebuilt
+# after CATALOG_INDEX_MAX_AGE seconds regardless.
+CATALOG_CHECK_INTERVAL = 2.0  # seconds
+CATALOG_INDEX_MAX_AGE = 300  # seconds
+
+# Search results are cached per normalised query; saving or deleting a product clears the cache.
+SEARCH_CACHE_SIZE = 1024
+SEARCH_CACHE_TTL = 300  # seconds
+
+# Pre-rendered product JSON fragments kept in memory, dropped when a product is
+# saved in this process; other processes see the change after the TTL.
+PRODUCT_JSON_CACHE_SIZE = 50000
+PRODUCT_JSON_CACHE_TTL = 60  # seconds
+
+# /api/get_all_products/: rows rendered per streamed chunk, and the largest keyset page.
+PRODUCT_EXPORT_CHUNK_SIZE = 2000
+PRODUCT_EXPORT_MAX_PAGE_SIZE = 1000
+
+# Limits for /api/batch_search/.
+SEARCH_BATCH_MAX_QUERIES = 50
+SEARCH_BATCH_MAX_RESULTS = 50
+
+
+# Assistant conversations: one chat per user session, least recently used
+# dropped beyond CHAT_MAX_SESSIONS, idle ones after CHAT_SESSION_TTL seconds.
+CHAT_MAX_SESSIONS = 1000
+CHAT_SESSION_TTL = 1800
+# History sent with each turn, in estimated tokens: recent turns verbatim,
+# older ones collapsed into a summary of at most CHAT_SUMMARY_TOKEN_BUDGET.
+CHAT_HISTORY_TOKEN_BUDGET = 2000
+CHAT_SUMMARY_TOKEN_BUDGET = 300
+
+# Model behind the assistant: "gemini", "ollama", or "fake" - a deterministic
+# stand-in replying with the latency of LLM_FAKE_PROFILE ("instant", "flash",
+# "slow"). See core/llm_backends.py.
+LLM_BACKEND = "gemini"
+GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY")  # never commit the key itself
+LLM_MODEL = "gemini-1.5-flash"
+OLLAMA_HOST = None  # the ollama default, http://localhost:11434
+OLLAMA_MODEL = "llama3.2"
+LLM_FAKE_PROFILE = "flash"
+
+# Async model calls: at most LLM_MAX_CONCURRENCY in flight per process, each
+# attempt cut off after LLM_TIMEOUT seconds, timeouts and transient API
+# errors retried LLM_RETRIES times with jittered backoff from LLM_RETRY_BACKOFF.
+LLM_TIMEOUT = 20.0
+LLM_MAX_CONCURRENCY = 8
+LLM_RETRIES = 2
+LLM_RETRY_BACKOFF = 0.5
+
+# Visual search
+# Catalog images, named product_<id>_image<n>.jpg.
+PRODUCT_IMAGE_DIR = "core/product_images"
+
+# Written by `manage.py build_image_features` and memory-mapped by every worker.
+IMAGE_FEATURE_DIR = BASE_DIR / "image_features"
+
+# Analysis images and display thumbnails derived once per catalog image,
+# stored by content hash and served from /images/<sha1>/w<width>.<webp|jpg>.
+IMAGE_DERIVATIVES = True
+IMAGE_DERIVATIVE_DIR = BASE_DIR / "image_derivatives"
+IMAGE_THUMBNAIL_WIDTHS = (160, 320, 640)
+
+# Largest accepted query image; uploads are decoded in memory, never saved.
+IMAGE_UPLOAD_MAX_BYTES = 5 * 1024 * 1024
+
+# Under ASGI, Django reads a whole request body before any view runs, so
+# voixnova.asgi refuses larger bodies up front: the image limit plus room
+# for the multipart framing. Under WSGI the image view stops reading itself.
+ASGI_MAX_REQUEST_BODY_BYTES = IMAGE_UPLOAD_MAX_BYTES + 64 * 1024
+
+# Pool behind the async image view: worker threads (default: CPU count),
+# searches running or queued before new ones get a 503, and how long a
+# queued search may wait before it is dropped.
+IMAGE_SEARCH_WORKERS = None
+IMAGE_SEARCH_MAX_IN_FLIGHT = 8
+IMAGE_SEARCH_QUEUE_TIMEOUT = 5.0
+
+# Visual search results cached by perceptual hash of the upload; queries
+# within IMAGE_QUERY_CACHE_MAX_DISTANCE of 64 bits reuse a cached result if
+# their colour histogram is also within IMAGE_QUERY_CACHE_MAX_FEATURE_DISTANCE
+# (L2) of the cached query's. The greyscale hash alone cannot tell recoloured
+# images apart.
+IMAGE_QUERY_CACHE_SIZE = 1024
+IMAGE_QUERY_CACHE_TTL = 3600  # seconds
+IMAGE_QUERY_CACHE_MAX_DISTANCE = 4
+IMAGE_QUERY_CACHE_MAX_FEATURE_DISTANCE = 0.02
+
+# Nearest-neighbour backend: "exact" (cdist), or a faiss index kind - "flat",
+# "flat-ip", "ivf" or "hnsw". See core/image_ann.py.
+IMAGE_SEARCH_BACKEND = "exact"
+# How a product's image distances combine into its score: "min" or "mean".
+IMAGE_SEARCH_AGGREGATE = "min"
+# Facet-filtered visual searches over at most this many images skip the ANN
+# index and scan the matching rows exactly.
+IMAGE_SEARCH_PREFILTER_EXACT_ROWS = 50000
+
+# Encoding visual search ranks with: "float32" (the stored features),
+# "float16", "uint8", "pca" or "sparse". See core/image_descriptors.py.
+IMAGE_DESCRIPTOR = "float32"
+IMAGE_DESCRIPTOR_PCA_DIM = 128
+IMAGE_DESCRIPTOR_SPARSE_THRESHOLD = 1e-3
+IMAGE_ANN_NLIST = None  # IVF cells; defaults to 4 * sqrt(images)
+IMAGE_ANN_NPROBE = 8
+IMAGE_ANN_HNSW_M = 32
+IMAGE_ANN_EF_SEARCH = 64
+
+
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
 
@@ -159,6 +277,7 @@ CORS_ALLOW_HEADERS = [
     "authorization",
     "x-csrftoken",
     "x-requested-with",
+    "x-chat-session",
     "access-control-allow-origin",
     "access-control-allow-headers",
     "access-control-allow-methods",